@@ -13,6 +13,7 @@ import geospatial_mods as gs
 import data_transform as dt
 import data_output as do
 import data_ingest as di
+import robustness_mods as rm
 
 
 # Start pipeline
@@ -34,6 +35,9 @@ CALCULATION_YEAR = str(config["calculation_year"])
 # Load constants
 OUTPUT_DIR = config["data_output"]
 OUTFILE = config['outfile']
+QUERY_METRICS_OUTFILE = config['query_metrics_outfile']
+RUN_ROBUSTNESS = config['run_robustness']
+ROBUSTNESS_OUTFILE = config['outfile_robustness']
 DEFAULT_CRS = config['default_crs']
 ENG_WALES_PREPROCESSED_OUTPUT = config["eng_wales_preprocessed_output"]
 
@@ -87,11 +91,15 @@ if __name__ == "__main__":
     urb_rur_df_dict = {}
     disab_df_dict = {}
     age_df_dict = {}
+    robustness_df_dict = {}
 
     for local_auth in list_local_auth:
 
         print(f"Processing: {local_auth}")
 
+        # Tag the spatial query metrics with this LA
+        gs.set_query_tags(country="eng_wales", local_auth=local_auth)
+
         # Get a polygon of the selected local authority
         la_poly = gs.get_polygons_of_loccode(geo_df=ew_la_df,
                                              dissolveby=lad_col,
@@ -99,7 +107,8 @@ if __name__ == "__main__":
 
         # Creating a Geo Dataframe of only stops in selected la
         stops_in_la_poly = gs.find_points_in_poly(geo_df=stops_geo_df,
-                                                  polygon_obj=la_poly)
+                                                  polygon_obj=la_poly,
+                                                  query_name="stops_in_la")
 
         # Create a buffer around the stops
         stops_in_la_poly_buffer = gs.buffer_points(stops_in_la_poly)
@@ -123,14 +132,13 @@ if __name__ == "__main__":
         # -------------------------------------------------
 
         # find all the pop centroids which are in the buffered stops
-        pwc_in_stops_buffer_df = (
-            gs.find_points_in_poly(ew_df, stops_in_la_poly_buffer)
-        )
-
         # Dedupe the df because many OAs are appearing multiple times
         # (i.e. they are served by multiple stops)
         pwc_in_stops_buffer_df = (
-            pwc_in_stops_buffer_df.drop_duplicates(subset="OA11CD"))
+            gs.find_points_in_poly(ew_df, stops_in_la_poly_buffer,
+                                   dedupe_subset="OA11CD",
+                                   query_name="pop_in_stop_buffers")
+        )
 
         # Count the population served by public transport
         served = pwc_in_stops_buffer_df.pop_count.sum()
@@ -295,6 +303,16 @@ if __name__ == "__main__":
 
         urb_rur_df_dict[local_auth] = urb_rur_servd_df_out
 
+        # Centroid robustness
+        # -------------------
+        # Spread of the served percentage when the centroids are moved
+        if RUN_ROBUSTNESS:
+            robustness_df_dict[local_auth] = rm.served_pct_intervals(
+                pop_geo_df=ew_df,
+                stops_geo_df=stops_in_la_poly,
+                la_geo_df=ew_la_df,
+                lad_col=lad_col)
+
     # Outputting results to CSV
     # -------------------------
     # Create dataframes for dissaggregations accross all local authorities
@@ -324,4 +342,12 @@ if __name__ == "__main__":
     output_path = os.path.join(OUTPUT_DIR, OUTFILE)
     final_result.to_csv(output_path, index=False)
 
+    if RUN_ROBUSTNESS:
+        robustness_df = pd.concat(robustness_df_dict.values())
+        robustness_df.to_csv(os.path.join(OUTPUT_DIR, ROBUSTNESS_OUTFILE),
+                             index=False)
+
+    # Outputting the spatial query metrics for this run
+    gs.write_query_metrics(os.path.join(OUTPUT_DIR, QUERY_METRICS_OUTFILE))
+
     print(f"Time taken is {time.time()-start_time:.2f} seconds")
@@ -33,6 +33,7 @@ boundary_year = "2021"
 DEFAULT_CRS = config["default_crs"]
 OUTFILE = config['outfile_ni']
 OUTPUT_DIR = config["data_output"]
+QUERY_METRICS_OUTFILE = config['query_metrics_outfile']
 CLOUD_LOCAL = config["cloud_local"]
 
 # grabs northern ireland bus stops path
@@ -231,6 +232,9 @@ sex_df_dict = {}
 for local_auth in ni_auth:
     print(f"Processing: {local_auth}")
 
+    # Tag the spatial query metrics with this LA
+    gs.set_query_tags(country="northern_ireland", local_auth=local_auth)
+
     # Get a polygon of la based on the Location Code
     la_poly = (gs.get_polygons_of_loccode(
         geo_df=ni_la_file,
@@ -240,7 +244,8 @@ for local_auth in ni_auth:
     # Creating a Geo Dataframe of only stops in la
     la_stops_geo_df = (gs.find_points_in_poly
                        (geo_df=stops_geo_df,
-                        polygon_obj=la_poly))
+                        polygon_obj=la_poly,
+                        query_name="stops_in_la"))
 
     # buffer around the stops
     la_stops_geo_df = gs.buffer_points(la_stops_geo_df)
@@ -254,11 +259,11 @@ for local_auth in ni_auth:
     only_la_pwc_with_pop = dt.disab_disagg(disability_df, only_la_pwc_with_pop)
 
     # find all the pop centroids which are in the la_stops_geo_df
-    pop_in_poly_df = gs.find_points_in_poly(
-        only_la_pwc_with_pop, la_stops_geo_df)
-
     # Deduplicate the df as OA appear multiple times
-    pop_in_poly_df = pop_in_poly_df.drop_duplicates(subset="OA11CD")
+    pop_in_poly_df = gs.find_points_in_poly(
+        only_la_pwc_with_pop, la_stops_geo_df,
+        dedupe_subset="OA11CD",
+        query_name="pop_in_stop_buffers")
 
     # all the figures we need
     served = pop_in_poly_df["pop_count"].astype(int).sum()
@@ -357,6 +362,9 @@ final_result["Year"] = pop_year
 output_path = os.path.join(OUTPUT_DIR, OUTFILE)
 final_result.to_csv(output_path, index=False)
 
+# Outputting the spatial query metrics for this run
+gs.write_query_metrics(os.path.join(OUTPUT_DIR, QUERY_METRICS_OUTFILE))
+
 
 # end time
 end = time.time()
@@ -0,0 +1,94 @@
+# Core imports
+import os
+import time
+
+# Third party imports
+import geopandas as gpd
+import pandas as pd
+import yaml
+
+# Module imports
+import pop_grid as pg
+import data_ingest as di
+
+
+# Start pipeline
+start_time = time.time()
+
+# Get current working directory
+CWD = os.getcwd()
+
+# Load config
+with open(os.path.join(CWD, "config.yaml"), encoding="utf-8") as yamlfile:
+    config = yaml.load(yamlfile, Loader=yaml.FullLoader)
+    module = os.path.basename(__file__)
+    print(f"Config loaded in {module}")
+
+# Load years
+CALCULATION_YEAR = str(config["calculation_year"])
+
+# Load constants
+OUTPUT_DIR = config["data_output"]
+OUTFILE = config["outfile_grid"]
+ENG_WALES_PREPROCESSED_OUTPUT = config["eng_wales_preprocessed_output"]
+POP_GRID_PATH = config["pop_grid_path"]
+POP_GRID_CELL_SIZE = config["pop_grid_cell_size"]
+POP_GRID_VINTAGE = config["pop_grid_vintage"]
+
+
+# Load preprocessed datasets
+# --------------------------
+stops_geo_df_path = os.path.join(ENG_WALES_PREPROCESSED_OUTPUT,
+                                 'stops_geo_df.geojson')
+ew_la_df_path = os.path.join(ENG_WALES_PREPROCESSED_OUTPUT,
+                             'ew_la_df.geojson')
+
+stops_geo_df = di.read_file_if_exists(stops_geo_df_path, gpd.read_file)
+ew_la_df = di.read_file_if_exists(ew_la_df_path, gpd.read_file)
+
+
+if __name__ == "__main__":
+
+    lad_col = f'LAD{CALCULATION_YEAR[-2:]}NM'
+
+    # Read the population grid
+    # ------------------------
+    grid = di.read_file_if_exists(
+        POP_GRID_PATH,
+        lambda path: pg.read_pop_grid(path,
+                                      POP_GRID_CELL_SIZE,
+                                      POP_GRID_VINTAGE))
+
+    # Mark the cells served by public transport
+    # -----------------------------------------
+    # The buffers use the easting and northing of the stops directly
+    stops_df = pd.DataFrame({"easting": stops_geo_df.geometry.x,
+                             "northing": stops_geo_df.geometry.y,
+                             "capacity_type": stops_geo_df.capacity_type})
+    coverage_mask = pg.stop_coverage_mask(grid, stops_df)
+
+    # Aggregate to local authorities
+    # ------------------------------
+    la_labels, la_names = pg.la_label_array(grid, ew_la_df, lad_col)
+    grid_results_df = pg.served_pop_by_la(grid, coverage_mask,
+                                          la_labels, la_names)
+
+    # Add a row for all the local authorities together, for comparison
+    # with the EU figure
+    total_row = grid_results_df[["Total", "Served", "Unserved"]].sum()
+    total_row["Local Authority"] = "All"
+    total_row["Percentage served"] = round(
+        total_row["Served"] / total_row["Total"] * 100, 2)
+    total_row["Percentage unserved"] = round(
+        total_row["Unserved"] / total_row["Total"] * 100, 2)
+    grid_results_df = pd.concat([grid_results_df,
+                                 total_row.to_frame().T])
+
+    grid_results_df["Year"] = CALCULATION_YEAR
+    grid_results_df["Grid"] = POP_GRID_VINTAGE
+
+    # Outputting to CSV
+    output_path = os.path.join(OUTPUT_DIR, OUTFILE)
+    grid_results_df.to_csv(output_path, index=False)
+
+    print(f"Time taken is {time.time()-start_time:.2f} seconds")
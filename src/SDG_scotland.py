@@ -13,6 +13,7 @@ import geospatial_mods as gs
 import data_ingest as di
 import data_transform as dt
 import data_output as do
+import pop_grid as pg
 
 # Data object import
 # from main import stops_geo_df
@@ -33,7 +34,9 @@ DEFAULT_CRS = config["default_crs"]
 DATA_DIR = config["data_dir"]
 OUTFILE = config['outfile_sc']
 OUTPUT_DIR = config["data_output"]
+QUERY_METRICS_OUTFILE = config['query_metrics_outfile']
 ENG_WALES_PREPROCESSED_OUTPUT = config["eng_wales_preprocessed_output"]
+URB_RUR_SOURCE = config["urb_rur_source"]
 
 pop_year = "2011"
 boundary_year = "2021"
@@ -108,7 +111,16 @@ pwc_with_pop_with_la = pd.merge(left=pwc_with_pop,
 urb_rur_path = os.path.join("data", "urban_rural", "scotland",
                             "oa2011_urban_rural_2013_2014.csv")
 
-urb_rur = di.read_urb_rur_class_scotland(urb_rur_path)
+if URB_RUR_SOURCE == "grid":
+    # Harmonised UK definition from the population grid, rather than the
+    # Scottish 6-fold classification
+    grid = pg.read_pop_grid(config["pop_grid_path"],
+                            config["pop_grid_cell_size"],
+                            config["pop_grid_vintage"])
+    urb_rur = pg.oa_urb_rur_from_grid(grid, sc_pop_wtd_centr_df, "code")
+    urb_rur = urb_rur.rename(columns={"code": "OA2011"})
+else:
+    urb_rur = di.read_urb_rur_class_scotland(urb_rur_path)
 
 pwc_with_pop_with_la = pd.merge(left=pwc_with_pop_with_la,
                                 right=urb_rur,
@@ -192,6 +204,9 @@ urb_rur_df_dict = {}
 for local_auth in sc_auth:
     print(f"Processing: {local_auth}")
 
+    # Tag the spatial query metrics with this LA
+    gs.set_query_tags(country="scotland", local_auth=local_auth)
+
     # Get a polygon of la based on the Location Code
     la_poly = (gs.get_polygons_of_loccode(
         geo_df=sc_la_file,
@@ -201,7 +216,8 @@ for local_auth in sc_auth:
     # Creating a Geo Dataframe of only stops in la
     la_stops_geo_df = (gs.find_points_in_poly
                        (geo_df=stops_geo_df,
-                        polygon_obj=la_poly))
+                        polygon_obj=la_poly,
+                        query_name="stops_in_la"))
 
     # buffer around the stops
     buffd_la_stops_geo_df = gs.buffer_points(la_stops_geo_df)
@@ -221,12 +237,11 @@ for local_auth in sc_auth:
         only_la_pwc_with_pop.drop(['easting', 'northing'], axis=1)
     )
 
-    pop_in_poly_df = gs.find_points_in_poly(
-        only_la_pwc_with_pop, la_stops_geo_df)
-
-
     # Deduplicate the df as OA appear multiple times
-    pop_in_poly_df = pop_in_poly_df.drop_duplicates(subset="OA11CD")
+    pop_in_poly_df = gs.find_points_in_poly(
+        only_la_pwc_with_pop, la_stops_geo_df,
+        dedupe_subset="OA11CD",
+        query_name="pop_in_stop_buffers")
 
     # all the figures we need
     served = pop_in_poly_df["pop_count"].astype(int).sum()
@@ -339,6 +354,9 @@ final_result = do.reorder_final_df(final_result)
 output_path = os.path.join(OUTPUT_DIR, OUTFILE)
 final_result.to_csv(output_path, index=False)
 
+# Outputting the spatial query metrics for this run
+gs.write_query_metrics(os.path.join(OUTPUT_DIR, QUERY_METRICS_OUTFILE))
+
 end = time.time()
 
 print(f"This took {(end-start)/60} minutes to run")
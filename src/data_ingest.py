@@ -666,22 +666,17 @@ def dl_stops_make_df(today, url):
     return stops_df
 
 
-def get_stops_file(url, dir):
-    """Gets the latest stop dataset.
-
-    If the latest stop df from the api is older then 28 days
-    then function grabs a new version of file from API and
-    saves this as a feather file.
-
-    If the latest stop df from the api is less then 28 days old
-    then just grabs the feather file.
+def _refresh_stops_file(url, dir):
+    """Downloads the stop dataset if there is none saved, or the saved one
+    is 28 days old or more.
 
     Args:
         url (str): NAPTAN API url.
         dir (str): directory where the stop data is stored.
 
     Returns:
-        pd.DataFrame
+        Tuple[str, pd.DataFrame]: path of the stops feather file, and the
+            downloaded stops, or None if no download was needed.
     """
 
     # gets todays date and latest date of stops df
@@ -693,16 +688,56 @@ def get_stops_file(url, dir):
                                 "stops",
                                 "Stops.feather")
     # Check that the feather exists
+    stops_df = None
     if not persistent_exists(feather_path):
         print(f"Downloading stops file from {url}")
         stops_df = dl_stops_make_df(today, url)
     else:  # does exist
         latest_date = _get_latest_stop_file_date(dir)
-        if today - latest_date < 28:
-            stops_df = pd.read_feather(feather_path)
-        else:
+        if today - latest_date >= 28:
             stops_df = dl_stops_make_df(today, url)
 
+    return feather_path, stops_df
+
+
+def update_stops_file(url, dir):
+    """Makes sure the saved stop dataset is the latest, without loading it.
+
+    If the latest stop df from the api is older then 28 days, or there
+    is none, then function grabs a new version of file from API and
+    saves this as a feather file.
+
+    Args:
+        url (str): NAPTAN API url.
+        dir (str): directory where the stop data is stored.
+
+    Returns:
+        str: path of the stops feather file.
+    """
+    feather_path, _ = _refresh_stops_file(url, dir)
+    return feather_path
+
+
+def get_stops_file(url, dir):
+    """Gets the latest stop dataset.
+
+    If the latest stop df from the api is older then 28 days
+    then function grabs a new version of file from API and
+    saves this as a feather file.
+
+    If the latest stop df from the api is less then 28 days old
+    then just grabs the feather file.
+
+    Args:
+        url (str): NAPTAN API url.
+        dir (str): directory where the stop data is stored.
+
+    Returns:
+        pd.DataFrame
+    """
+    feather_path, stops_df = _refresh_stops_file(url, dir)
+    if stops_df is None:
+        stops_df = pd.read_feather(feather_path)
     return stops_df
 
 
@@ -1,6 +1,19 @@
 import pandas as pd
 import numpy as np
 
+# Columns of the final output, in order
+FINAL_COLS = ["Year",
+              "Sex",
+              "Age",
+              "Disability Status",
+              "Local Authority",
+              "Urban/Rural",
+              "Series",
+              "Observation Status",
+              "Unit Multiplier",
+              "Unit Measure",
+              "Value"]
+
 
 def reshape_for_output(df, id_col, local_auth, id_rename=None):
     """ Reshapes the output of served_proportions_disagg to data team requirements.
@@ -95,15 +108,5 @@ def reorder_final_df(df):
     Returns:
         pd.DataFrame: Reordered dataframe.
     """
-    df = df[["Year",
-             "Sex",
-             "Age",
-             "Disability Status",
-             "Local Authority",
-             "Urban/Rural",
-             "Series",
-             "Observation Status",
-             "Unit Multiplier",
-             "Unit Measure",
-             "Value"]]
+    df = df[FINAL_COLS]
     return df
@@ -2,8 +2,12 @@
 import geopandas as gpd
 import numpy as np
 import os
+import pandas as pd
+import shapely
 import yaml
+from datetime import datetime
 from shapely.geometry import Point
+from time import perf_counter
 
 # get current working directory
 CWD = os.getcwd()
@@ -18,6 +22,12 @@ with open(os.path.join(CWD, "config.yaml")) as yamlfile:
 LOWERBUFFER = config["low_cap_buffer"]
 UPPERBUFFER = config["high_cap_buffer"]
 
+# Statistics for every spatial query made in this run, used to find out
+# why some local authorities are slow
+RUN_STARTED = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+QUERY_METRICS = []
+QUERY_TAGS = {"country": None, "local_auth": None}
+
 
 def get_polygons_of_loccode(geo_df: gpd.GeoDataFrame,
                             dissolveby='OA11CD',
@@ -78,36 +88,152 @@ def buffer_points(geo_df: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
     return geo_df
 
 
-def find_points_in_poly(geo_df: gpd.GeoDataFrame, polygon_obj):
-    """Find points in polygon using geopandas' spatial join
-    which joins the supplied geo_df (as left_df) and the
-    polygon (as right_df).
+def set_query_tags(country=None, local_auth=None):
+    """Sets the country and local authority recorded with spatial queries.
+
+    Args:
+        country (str, optional): the country being processed,
+            e.g. "eng_wales".
+        local_auth (str, optional): the local authority being processed.
+    """
+    QUERY_TAGS["country"] = country
+    QUERY_TAGS["local_auth"] = local_auth
+
+
+def query_metrics_df() -> pd.DataFrame:
+    """Gets the statistics of the spatial queries made in this run.
+
+    Returns:
+        pd.DataFrame: one row per spatial query with the country and local
+            authority tags, the number of left and right geometries, the
+            time taken to build the tree and to query it, the candidate
+            pairs from the tree, the true hits and the rows dropped by
+            deduplication.
+    """
+    return pd.DataFrame(QUERY_METRICS)
+
+
+def write_query_metrics(path):
+    """Writes the statistics of the spatial queries in this run to csv.
+
+    Args:
+        path (str): path of the csv to write.
+    """
+    print(f"Writing spatial query metrics to {path}")
+    query_metrics_df().to_csv(path, index=False)
+
+
+def query_pairs(query_geoms, tree_geo_df: gpd.GeoDataFrame,
+                predicate='intersects', query_name=None):
+    """Finds every pair of geometries that meet the spatial predicate.
 
-    Then drops all rows where the point is not in the polygon
-    (based on column index_right not being NaN). Finally it
-    drop all column names from that were created in the join,
-    leaving only the columns of the original geo_df.
+    Queries the spatial index of `tree_geo_df` with all of the
+    `query_geoms` at once. The query is done in two steps, bounding box
+    candidates from the tree and then the exact predicate on those
+    candidates, so both can be recorded in the query metrics.
+
+    Args:
+        query_geoms (gpd.GeoSeries or array of shapely geometries): the
+            left geometries.
+        tree_geo_df (gpd.GeoDataFrame): the right geometries, the tree is
+            built on these.
+        predicate (str, optional): shapely predicate to test.
+            Defaults to 'intersects'.
+        query_name (str, optional): name recorded with the metrics.
+            Defaults to None.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: positional indices into
+            `query_geoms` and `tree_geo_df` for each pair.
+    """
+    # The tree is built the first time sindex is used, then cached
+    tic = perf_counter()
+    tree = tree_geo_df.sindex
+    toc = perf_counter()
+    build_time = toc - tic
+
+    tic = perf_counter()
+    left_idx, right_idx = tree.query(query_geoms)
+    left_geoms = np.asarray(query_geoms)[left_idx]
+    right_geoms = np.asarray(tree_geo_df.geometry.array)[right_idx]
+    hits = getattr(shapely, predicate)(left_geoms, right_geoms)
+    toc = perf_counter()
+
+    QUERY_METRICS.append({"run_started": RUN_STARTED,
+                          "country": QUERY_TAGS["country"],
+                          "local_auth": QUERY_TAGS["local_auth"],
+                          "query_name": query_name,
+                          "n_left": len(query_geoms),
+                          "n_right": len(tree_geo_df),
+                          "tree_build_s": build_time,
+                          "query_s": toc - tic,
+                          "candidate_pairs": len(left_idx),
+                          "hits": int(hits.sum()),
+                          "dedupe_dropped": 0})
+
+    return left_idx[hits], right_idx[hits]
+
+
+def find_points_in_poly(geo_df: gpd.GeoDataFrame, polygon_obj,
+                        dedupe_subset=None, query_name=None):
+    """Find points in polygon using a spatial index query
+    of the supplied geo_df (as left) against the polygon (as right).
+
+    Keeps a row of geo_df for every polygon the point is in, like an inner
+    spatial join, leaving only the columns of the original geo_df.
+    Optionally then drops duplicated rows, e.g. where an output area is
+    inside many stop buffers.
+
+    The statistics of the query are recorded in the query metrics.
 
     Args:
         geo_df (gpg.DatFrame): a geo pandas dataframe.
         polygon_obj (str): a geopandas dataframe with a polygon column.
+        dedupe_subset (str or list, optional): columns to drop duplicates
+            on. Defaults to None, which keeps duplicates.
+        query_name (str, optional): name recorded with the metrics.
+            Defaults to None.
 
     Returns:
         gpd.GeoDataFrame: A geodata frame with the points inside the supplied
         polygon.
     """
-    wanted_cols = geo_df.columns.to_list()
-    joined_df = (gpd.sjoin
-                 (geo_df,
-                  polygon_obj,
-                  how='left',
-                  predicate='intersects'))  # op = 'within'
-    filtered_df = (joined_df
-                   [joined_df
-                    ['index_right'].notna()])
-    filtered_df = filtered_df[wanted_cols]
+    left_idx, _ = query_pairs(geo_df.geometry, polygon_obj,
+                              predicate='intersects',
+                              query_name=query_name)
+    # Keep the order of geo_df, as a spatial join would
+    filtered_df = geo_df.iloc[np.sort(left_idx, kind='stable')]
+
+    if dedupe_subset is not None:
+        rows_before = len(filtered_df)
+        filtered_df = filtered_df.drop_duplicates(subset=dedupe_subset)
+        QUERY_METRICS[-1]["dedupe_dropped"] = rows_before - len(filtered_df)
+
     return filtered_df
 
+
+def buffer_pairs(points, buffered_geo_df: gpd.GeoDataFrame):
+    """Finds every (point, buffer) pair where the point lies in the buffer.
+
+    Uses the spatial index of the buffered geodataframe to run one
+    vectorised query for all of the points, rather than a spatial join
+    per point or per local authority.
+
+    Args:
+        points (gpd.GeoSeries or array of shapely Points): the points to
+            test, e.g. population weighted centroids.
+        buffered_geo_df (gpd.GeoDataFrame): polygons such as the output of
+            `buffer_points`.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: positional indices into `points` and
+            `buffered_geo_df` for each pair that intersects.
+    """
+    return query_pairs(points, buffered_geo_df,
+                       predicate='intersects',
+                       query_name='buffer_pairs')
+
+
 def geo_df_from_pd_df(pd_df, geom_x, geom_y, crs):
     """Function to create a Geo-dataframe from a Pandas DataFrame.
 
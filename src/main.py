@@ -11,6 +11,7 @@ sys.path.append(os.path.dirname(os.path.realpath(__file__)))
 
 run_timetables = True
 pre_processing = True
+run_pop_grid = False
 countries = ['eng_wales', 'scotland', 'northern_ireland']
 
 # Set up logging 
@@ -61,4 +62,9 @@ for country in countries:
     logger.info(f'Running pipeline for {country}')
     runpy.run_module(f'SDG_{country}', run_name='__main__')
 
+# Run the population grid (EU method) calculation for comparison
+if run_pop_grid:
+    logger.info('Running population grid pipeline')
+    runpy.run_module('SDG_pop_grid', run_name='__main__')
+
 logger.info("Pipeline complete")
\ No newline at end of file
@@ -0,0 +1,457 @@
+"""Functions for the population grid (EU method) calculation.
+
+The EU method counts the population of grid cells, rather than of output
+areas, inside the stop service areas. The grid is held as a dense NumPy
+array in British National Grid coordinates, with row 0 at the southern
+edge. A cell is served if its centre is within the buffer distance of a
+stop.
+
+The grid can also be used to classify output areas as urban or rural
+with the Eurostat degree of urbanisation, giving the same definition for
+every UK nation.
+"""
+# Core imports
+import os
+import hashlib
+import logging
+
+# Third party imports
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+import yaml
+from scipy import ndimage
+
+# Module imports
+import geospatial_mods as gs
+
+# Get current working directory
+CWD = os.getcwd()
+
+# Load config
+with open(os.path.join(CWD, "config.yaml"), encoding="utf-8") as yamlfile:
+    config = yaml.load(yamlfile, Loader=yaml.FullLoader)
+    module = os.path.basename(__file__)
+    print(f"Config loaded in {module}")
+
+# Create logger
+logger = logging.getLogger(__name__)
+
+# Constants
+LOWERBUFFER = config["low_cap_buffer"]
+UPPERBUFFER = config["high_cap_buffer"]
+POP_GRID_DIR = config["pop_grid_dir"]
+
+# Degree of urbanisation classes
+URBAN_CENTRE = 3
+URBAN_CLUSTER = 2
+RURAL = 1
+DEGURBA_NAMES = {URBAN_CENTRE: "Urban centre",
+                 URBAN_CLUSTER: "Urban cluster",
+                 RURAL: "Rural"}
+
+
+class PopGrid:
+    """A population grid in British National Grid coordinates.
+
+    Args:
+        pop (np.ndarray): 2D array of population counts. Row 0 is the
+            southern edge of the grid and column 0 the western edge.
+        x_min (float): easting of the western edge of the grid.
+        y_min (float): northing of the southern edge of the grid.
+        cell_size (float): width of a cell in metres, e.g. 1000 or 100.
+        vintage (str): name of the grid release, used to name cached
+            files made from the grid.
+    """
+
+    def __init__(self, pop, x_min, y_min, cell_size, vintage):
+        self.pop = pop
+        self.x_min = x_min
+        self.y_min = y_min
+        self.cell_size = cell_size
+        self.vintage = vintage
+
+    @property
+    def shape(self):
+        return self.pop.shape
+
+    def cell_of(self, x, y):
+        """Gets the row and column of the cells containing the points.
+
+        Args:
+            x (np.ndarray): eastings.
+            y (np.ndarray): northings.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: rows and columns. Points outside
+                the grid are given -1.
+        """
+        rows = np.floor((np.asarray(y) - self.y_min)
+                        / self.cell_size).astype(np.int64)
+        cols = np.floor((np.asarray(x) - self.x_min)
+                        / self.cell_size).astype(np.int64)
+        outside = ((rows < 0) | (rows >= self.shape[0])
+                   | (cols < 0) | (cols >= self.shape[1]))
+        rows[outside] = -1
+        cols[outside] = -1
+        return rows, cols
+
+    def cell_centres(self, rows, cols):
+        """Gets the easting and northing of the centre of cells.
+
+        Args:
+            rows (np.ndarray): cell rows.
+            cols (np.ndarray): cell columns.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: eastings and northings.
+        """
+        x = self.x_min + (np.asarray(cols) + 0.5) * self.cell_size
+        y = self.y_min + (np.asarray(rows) + 0.5) * self.cell_size
+        return x, y
+
+
+def read_pop_grid_csv(path, cell_size, vintage,
+                      x_col="easting", y_col="northing", pop_col="pop"):
+    """Reads a gridded population csv into a PopGrid.
+
+    The csv has one row per populated cell, with the coordinates of the
+    south-west corner of the cell in British National Grid.
+
+    Args:
+        path (str): path to the csv.
+        cell_size (float): width of a cell in metres.
+        vintage (str): name of the grid release.
+        x_col (str, optional): easting column. Defaults to "easting".
+        y_col (str, optional): northing column. Defaults to "northing".
+        pop_col (str, optional): population column. Defaults to "pop".
+
+    Returns:
+        PopGrid: the population grid.
+    """
+    grid_df = pd.read_csv(path, usecols=[x_col, y_col, pop_col])
+
+    x_min = grid_df[x_col].min()
+    y_min = grid_df[y_col].min()
+    cols = ((grid_df[x_col] - x_min) // cell_size).to_numpy(dtype=np.int64)
+    rows = ((grid_df[y_col] - y_min) // cell_size).to_numpy(dtype=np.int64)
+
+    pop = np.zeros((rows.max() + 1, cols.max() + 1), dtype=np.float64)
+    # add rather than assign in case a cell is listed more than once
+    np.add.at(pop, (rows, cols), grid_df[pop_col].to_numpy(dtype=np.float64))
+
+    return PopGrid(pop, x_min, y_min, cell_size, vintage)
+
+
+def read_pop_grid_raster(path, vintage):
+    """Reads a gridded population raster (e.g. GeoTIFF or ASCII grid).
+
+    Needs the rasterio package, which is only imported when a raster is
+    read. The raster must already be in British National Grid.
+
+    Args:
+        path (str): path to the raster.
+        vintage (str): name of the grid release.
+
+    Returns:
+        PopGrid: the population grid.
+    """
+    try:
+        import rasterio
+    except ImportError as e:
+        raise ImportError(
+            "rasterio is needed to read a raster population grid."
+            " Install it or supply the grid as a csv.") from e
+
+    with rasterio.open(path) as src:
+        pop = src.read(1, masked=True).filled(0).astype(np.float64)
+        cell_size = src.transform.a
+        x_min = src.bounds.left
+        y_min = src.bounds.bottom
+
+    # Rasters are stored north to south so flip to put row 0 in the south
+    return PopGrid(np.flipud(pop), x_min, y_min, cell_size, vintage)
+
+
+def read_pop_grid(path, cell_size, vintage):
+    """Reads a population grid from a csv or a raster based on extension.
+
+    Args:
+        path (str): path to the grid file.
+        cell_size (float): width of a cell in metres. Only used for csv.
+        vintage (str): name of the grid release.
+
+    Returns:
+        PopGrid: the population grid.
+    """
+    if path.endswith(".csv"):
+        return read_pop_grid_csv(path, cell_size, vintage)
+    return read_pop_grid_raster(path, vintage)
+
+
+def _disc_offsets(radius, cell_size):
+    """Row and column offsets of every cell a buffer could reach."""
+    reach = int(np.ceil(radius / cell_size)) + 1
+    steps = np.arange(-reach, reach + 1)
+    d_rows, d_cols = np.meshgrid(steps, steps, indexing="ij")
+    return d_rows.ravel(), d_cols.ravel()
+
+
+def stop_coverage_mask(grid: PopGrid,
+                       stops_df: pd.DataFrame,
+                       chunk_size: int = 10000) -> np.ndarray:
+    """Marks grid cells whose centre is within a stop's buffer distance.
+
+    Each stop is compared with the cells in a square around it, using the
+    same 500m / 1000m distances as `geospatial_mods.buffer_points`. Stops
+    are processed in chunks to limit memory use.
+
+    Args:
+        grid (PopGrid): the population grid.
+        stops_df (pd.DataFrame): stops with easting, northing and
+            capacity_type columns.
+        chunk_size (int, optional): number of stops per chunk.
+            Defaults to 10000.
+
+    Returns:
+        np.ndarray: boolean array the same shape as the grid.
+    """
+    mask = np.zeros(grid.shape, dtype=bool)
+
+    for capacity_type, radius in [("low", LOWERBUFFER),
+                                  ("high", UPPERBUFFER)]:
+        cap_stops = stops_df[stops_df["capacity_type"] == capacity_type]
+        stop_x = cap_stops["easting"].to_numpy(dtype=np.float64)
+        stop_y = cap_stops["northing"].to_numpy(dtype=np.float64)
+        d_rows, d_cols = _disc_offsets(radius, grid.cell_size)
+
+        for start in range(0, len(stop_x), chunk_size):
+            x = stop_x[start:start + chunk_size]
+            y = stop_y[start:start + chunk_size]
+            # Not using cell_of as stops just off the grid can still
+            # reach cells on it
+            rows = np.floor((y - grid.y_min) / grid.cell_size).astype(int)
+            cols = np.floor((x - grid.x_min) / grid.cell_size).astype(int)
+            # Candidate cells around each stop, shape (stops, offsets)
+            cand_rows = rows[:, None] + d_rows
+            cand_cols = cols[:, None] + d_cols
+            centre_x, centre_y = grid.cell_centres(cand_rows, cand_cols)
+            within = ((centre_x - x[:, None]) ** 2
+                      + (centre_y - y[:, None]) ** 2) <= radius ** 2
+            within &= ((cand_rows >= 0) & (cand_rows < grid.shape[0])
+                       & (cand_cols >= 0) & (cand_cols < grid.shape[1]))
+            mask[cand_rows[within], cand_cols[within]] = True
+
+    return mask
+
+
+def _boundary_stamp(la_geo_df: gpd.GeoDataFrame, lad_col: str) -> str:
+    """Hashes the LA names and the bounds of their boundaries, to spot a
+    change of boundary file."""
+    stamp = hashlib.sha1()
+    stamp.update("\n".join(la_geo_df[lad_col].astype(str)).encode())
+    stamp.update(np.ascontiguousarray(la_geo_df.bounds.to_numpy(),
+                                      dtype=np.float64).tobytes())
+    return stamp.hexdigest()
+
+
+def la_label_array(grid: PopGrid,
+                   la_geo_df: gpd.GeoDataFrame,
+                   lad_col: str):
+    """Labels each populated grid cell with the LA its centre falls in.
+
+    The labels are cached in the pop_grid_dir, one file per grid vintage
+    and local authority column, as they only need to be made once. The
+    cache is made again if the LA names or the bounds of their boundaries
+    change, e.g. for a new boundary year.
+
+    Args:
+        grid (PopGrid): the population grid.
+        la_geo_df (gpd.GeoDataFrame): local authority boundaries.
+        lad_col (str): name of the local authority name column.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: int32 array the same shape as the
+            grid holding an index into the LA names (-1 for cells with no
+            population or outside every LA), and the LA names.
+    """
+    cache_path = os.path.join(POP_GRID_DIR,
+                              f"la_labels_{grid.vintage}_{lad_col}.npz")
+    boundary_stamp = _boundary_stamp(la_geo_df, lad_col)
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            if ("boundary_stamp" in cached.files
+                    and str(cached["boundary_stamp"]) == boundary_stamp):
+                logger.info(f"Reading LA labels from {cache_path}")
+                return cached["labels"], cached["la_names"]
+        logger.info(f"LA boundaries have changed since {cache_path} was "
+                    "made, making the LA labels again")
+
+    la_names = np.asarray(la_geo_df[lad_col].unique(), dtype=str)
+    la_codes = pd.Index(la_names).get_indexer(la_geo_df[lad_col])
+
+    labels = np.full(grid.shape, -1, dtype=np.int32)
+    rows, cols = np.nonzero(grid.pop > 0)
+    centre_x, centre_y = grid.cell_centres(rows, cols)
+    centres = shapely.points(centre_x, centre_y)
+
+    cell_idx, poly_idx = gs.query_pairs(centres,
+                                        la_geo_df.reset_index(drop=True),
+                                        query_name='grid_la_labels')
+    labels[rows[cell_idx], cols[cell_idx]] = la_codes[poly_idx]
+
+    os.makedirs(POP_GRID_DIR, exist_ok=True)
+    np.savez_compressed(cache_path, labels=labels, la_names=la_names,
+                        boundary_stamp=boundary_stamp)
+    return labels, la_names
+
+
+def served_pop_by_la(grid: PopGrid,
+                     mask: np.ndarray,
+                     labels: np.ndarray,
+                     la_names: np.ndarray) -> pd.DataFrame:
+    """Sums the total and served grid population for each LA.
+
+    Args:
+        grid (PopGrid): the population grid.
+        mask (np.ndarray): boolean coverage mask from `stop_coverage_mask`.
+        labels (np.ndarray): LA labels from `la_label_array`.
+        la_names (np.ndarray): LA names the labels index into.
+
+    Returns:
+        pd.DataFrame: one row per LA with the total, served and unserved
+            population and the percentages served and unserved.
+    """
+    labelled = labels >= 0
+    la_idx = labels[labelled]
+    pop = grid.pop[labelled]
+    n_la = len(la_names)
+
+    total = np.bincount(la_idx, weights=pop, minlength=n_la)
+    served = np.bincount(la_idx, weights=pop * mask[labelled],
+                         minlength=n_la)
+
+    results_df = pd.DataFrame({"Local Authority": la_names,
+                               "Total": total.round(),
+                               "Served": served.round()})
+    results_df["Unserved"] = results_df["Total"] - results_df["Served"]
+    results_df["Percentage served"] = round(
+        results_df["Served"] / results_df["Total"] * 100, 2)
+    results_df["Percentage unserved"] = round(
+        results_df["Unserved"] / results_df["Total"] * 100, 2)
+    return results_df
+
+
+def _to_km_cells(grid: PopGrid):
+    """Sums a fine grid into 1km cells, as the classification expects."""
+    factor = int(round(1000 / grid.cell_size))
+    n_rows = -(-grid.shape[0] // factor) * factor
+    n_cols = -(-grid.shape[1] // factor) * factor
+    padded = np.zeros((n_rows, n_cols))
+    padded[:grid.shape[0], :grid.shape[1]] = grid.pop
+    km_pop = (padded
+              .reshape(n_rows // factor, factor, n_cols // factor, factor)
+              .sum(axis=(1, 3)))
+    return km_pop, factor
+
+
+def _clusters(dense: np.ndarray, pop: np.ndarray, min_pop: float,
+              structure: np.ndarray) -> np.ndarray:
+    """Keeps the connected groups of dense cells with enough population."""
+    labels, n_labels = ndimage.label(dense, structure=structure)
+    cluster_pop = np.bincount(labels.ravel(), weights=pop.ravel(),
+                              minlength=n_labels + 1)
+    big_enough = cluster_pop >= min_pop
+    # label 0 is the background
+    big_enough[0] = False
+    return big_enough[labels]
+
+
+def degree_of_urbanisation(grid: PopGrid) -> np.ndarray:
+    """Classifies grid cells as urban centre, urban cluster or rural.
+
+    Follows the Eurostat degree of urbanisation grid classification:
+
+    | 1) Urban centres are groups of contiguous cells (not counting
+    |    diagonals) with a density of at least 1,500 people per km² and a
+    |    total population of at least 50,000. Holes in the group are
+    |    filled.
+    | 2) Urban clusters are groups of contiguous cells (counting
+    |    diagonals) with a density of at least 300 people per km² and a
+    |    total population of at least 5,000.
+    | 3) All other cells are rural.
+
+    The classification is defined on 1km cells, so a finer grid is summed
+    to 1km first and the classes copied back to the fine cells. The result
+    is cached in the pop_grid_dir for each grid vintage.
+
+    Args:
+        grid (PopGrid): the population grid.
+
+    Returns:
+        np.ndarray: int8 array the same shape as the grid holding
+            URBAN_CENTRE, URBAN_CLUSTER or RURAL.
+    """
+    cache_path = os.path.join(POP_GRID_DIR, f"degurba_{grid.vintage}.npy")
+    if os.path.exists(cache_path):
+        logger.info(f"Reading degree of urbanisation from {cache_path}")
+        return np.load(cache_path)
+
+    if grid.cell_size < 1000:
+        km_pop, factor = _to_km_cells(grid)
+    else:
+        km_pop, factor = grid.pop, 1
+    density = km_pop / (max(grid.cell_size, 1000) / 1000) ** 2
+
+    rook = ndimage.generate_binary_structure(2, 1)
+    queen = ndimage.generate_binary_structure(2, 2)
+
+    centres = _clusters(density >= 1500, km_pop, 50000, rook)
+    centres = ndimage.binary_fill_holes(centres)
+    clusters = _clusters(density >= 300, km_pop, 5000, queen)
+
+    classes = np.full(km_pop.shape, RURAL, dtype=np.int8)
+    classes[clusters] = URBAN_CLUSTER
+    classes[centres] = URBAN_CENTRE
+
+    if factor > 1:
+        classes = np.repeat(np.repeat(classes, factor, axis=0),
+                            factor, axis=1)[:grid.shape[0], :grid.shape[1]]
+
+    os.makedirs(POP_GRID_DIR, exist_ok=True)
+    np.save(cache_path, classes)
+    return classes
+
+
+def oa_urb_rur_from_grid(grid: PopGrid,
+                         centroids_geo_df: gpd.GeoDataFrame,
+                         code_col: str) -> pd.DataFrame:
+    """Classifies output areas as urban or rural from the grid.
+
+    Each output area takes the degree of urbanisation of the grid cell its
+    population weighted centroid falls in. Urban centres and urban
+    clusters are "urban", everything else is "rural".
+
+    Args:
+        grid (PopGrid): the population grid.
+        centroids_geo_df (gpd.GeoDataFrame): population weighted centroids.
+        code_col (str): name of the output area code column.
+
+    Returns:
+        pd.DataFrame: the output area code, the degree of urbanisation
+            class name and the urb_rur_class column used by the pipeline.
+    """
+    classes = degree_of_urbanisation(grid)
+
+    rows, cols = grid.cell_of(centroids_geo_df.geometry.x.to_numpy(),
+                              centroids_geo_df.geometry.y.to_numpy())
+    # Centroids off the grid have no population in it so count as rural
+    oa_classes = np.where(rows >= 0, classes[rows, cols], RURAL)
+
+    urb_rur_df = pd.DataFrame(
+        {code_col: centroids_geo_df[code_col].to_numpy(),
+         "degurba_class": pd.Series(oa_classes).map(DEGURBA_NAMES)})
+    urb_rur_df["urb_rur_class"] = np.where(oa_classes == RURAL,
+                                           "rural", "urban")
+    return urb_rur_df
@@ -23,6 +23,7 @@ import data_ingest as di
 import data_transform as dt
 import data_valid_clean as dvc
 import geospatial_mods as gs
+import pop_grid as pg  # noqa E402
 
 # get current working directory
 CWD = os.getcwd()
@@ -41,6 +42,7 @@ TRAIN_IN_DIR = config['train_in_dir']
 URB_RUR_ZIP_LINK = config["urb_rur_zip_link"]
 URB_RUR_TYPES = config["urb_rur_types"]
 ENG_WALES_PREPROCESSED_OUTPUT = config["eng_wales_preprocessed_output"]
+URB_RUR_SOURCE = config["urb_rur_source"]
 
 # Years
 CALCULATION_YEAR = str(config["calculation_year"])
@@ -292,22 +294,34 @@ ew_disability_df.to_feather(path)
 # -------------------------
 PreProcessLogger.info('Processing rural urban classification data')
 
-ew_urb_rur_df = pd.read_csv(di.path_or_url(os.path.join('data', 'RUC11_OA11_EW.csv')), 
-                            dtype={'OA11CD':'str', 'RU11CD':'category'})
-
-# These are the codes (RUC11CD) mapping to rural and urban descriptions (RUC11)
-# I could make this more succinct, but leaving here
-# for clarity and maintainability
-urban_dictionary = {'A1': 'Urban major conurbation',
-                    'C1': 'Urban city and town',
-                    'B1': 'Urban minor conurbation',
-                    'C2': 'Urban city and town in a sparse setting'}
-
-# mapping to a simple urban or rural classification
-ew_urb_rur_df["urb_rur_class"] = (
-    ew_urb_rur_df.RUC11CD.map(lambda x: "urban"
-                              if x in urban_dictionary.keys()
-                              else "rural"))
+if URB_RUR_SOURCE == "grid":
+    # Harmonised UK definition, from the degree of urbanisation of the
+    # population grid cell each centroid is in
+    grid = pg.read_pop_grid(config["pop_grid_path"],
+                            config["pop_grid_cell_size"],
+                            config["pop_grid_vintage"])
+    ew_urb_rur_df = pg.oa_urb_rur_from_grid(grid,
+                                            ew_pop_wtd_centr_df,
+                                            "OA11CD")
+else:
+    ew_urb_rur_df = pd.read_csv(
+        di.path_or_url(os.path.join('data', 'RUC11_OA11_EW.csv')),
+        dtype={'OA11CD': 'str', 'RU11CD': 'category'})
+
+    # These are the codes (RUC11CD) mapping to rural and urban
+    # descriptions (RUC11)
+    # I could make this more succinct, but leaving here
+    # for clarity and maintainability
+    urban_dictionary = {'A1': 'Urban major conurbation',
+                        'C1': 'Urban city and town',
+                        'B1': 'Urban minor conurbation',
+                        'C2': 'Urban city and town in a sparse setting'}
+
+    # mapping to a simple urban or rural classification
+    ew_urb_rur_df["urb_rur_class"] = (
+        ew_urb_rur_df.RUC11CD.map(lambda x: "urban"
+                                  if x in urban_dictionary.keys()
+                                  else "rural"))
 
 # filter the df. We only want OA11CD and an urban/rurual classification
 ew_urb_rur_df = ew_urb_rur_df[['OA11CD', 'urb_rur_class']]
@@ -0,0 +1,231 @@
+"""Functions for testing how robust the results are to centroid placement.
+
+Each output area is represented by a single population weighted centroid,
+so an output area near the edge of a stop buffer can flip between served
+and unserved with a small shift of its centroid. These functions move the
+centroids (or sample points inside the output area polygons) many times
+and report the spread of the served percentage for each local authority.
+"""
+# Core imports
+import os
+
+# Third party imports
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+import yaml
+
+# Module imports
+import geospatial_mods as gs
+
+# Get current working directory
+CWD = os.getcwd()
+
+# Load config
+with open(os.path.join(CWD, "config.yaml"), encoding="utf-8") as yamlfile:
+    config = yaml.load(yamlfile, Loader=yaml.FullLoader)
+    module = os.path.basename(__file__)
+    print(f"Config loaded in {module}")
+
+# Constants
+MC_SAMPLES = config["mc_samples"]
+MC_BATCH_SIZE = config["mc_batch_size"]
+MC_JITTER_RADIUS = config["mc_jitter_radius"]
+
+
+def jitter_points(x: np.ndarray,
+                  y: np.ndarray,
+                  n_samples: int,
+                  radius: float,
+                  rng: np.random.Generator):
+    """Moves each point to a random position within a circle around it.
+
+    Positions are uniform over the area of the circle.
+
+    Args:
+        x (np.ndarray): eastings of the original points.
+        y (np.ndarray): northings of the original points.
+        n_samples (int): number of jittered copies of each point.
+        radius (float): radius of the circle in metres.
+        rng (np.random.Generator): random number generator.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: eastings and northings with shape
+            (n_samples, number of points).
+    """
+    shape = (n_samples, len(x))
+    # sqrt so points are not bunched towards the centre of the circle
+    dist = radius * np.sqrt(rng.random(shape))
+    angle = rng.uniform(0, 2 * np.pi, shape)
+    return x + dist * np.cos(angle), y + dist * np.sin(angle)
+
+
+def sample_points_in_polygons(polygons: gpd.GeoSeries,
+                              n_samples: int,
+                              rng: np.random.Generator,
+                              max_rounds: int = 100):
+    """Draws random points inside each polygon.
+
+    Uses rejection sampling from each polygon's bounding box. Every round
+    draws a candidate for all of the points still to be filled and tests
+    them in one vectorised call.
+
+    Args:
+        polygons (gpd.GeoSeries): e.g. output area boundaries.
+        n_samples (int): number of points to draw in each polygon.
+        rng (np.random.Generator): random number generator.
+        max_rounds (int, optional): rounds of rejection sampling before
+            giving up. Defaults to 100.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: eastings and northings with shape
+            (n_samples, number of polygons).
+    """
+    geoms = polygons.to_numpy()
+    bounds = polygons.bounds.to_numpy()
+    n_polys = len(geoms)
+
+    x = np.full((n_samples, n_polys), np.nan)
+    y = np.full((n_samples, n_polys), np.nan)
+
+    # Flat positions of the slots still to fill
+    todo = np.arange(n_samples * n_polys)
+    for _ in range(max_rounds):
+        poly_idx = todo % n_polys
+        min_x, min_y, max_x, max_y = bounds[poly_idx].T
+        cand_x = rng.uniform(min_x, max_x)
+        cand_y = rng.uniform(min_y, max_y)
+        inside = shapely.contains_xy(geoms[poly_idx], cand_x, cand_y)
+        x.flat[todo[inside]] = cand_x[inside]
+        y.flat[todo[inside]] = cand_y[inside]
+        todo = todo[~inside]
+        if todo.size == 0:
+            break
+    else:
+        raise ValueError(f"""Could not sample points in {todo.size} slots
+                         after {max_rounds} rounds""")
+    return x, y
+
+
+def served_pct_intervals(pop_geo_df: gpd.GeoDataFrame,
+                         stops_geo_df: gpd.GeoDataFrame,
+                         la_geo_df: gpd.GeoDataFrame,
+                         lad_col: str,
+                         mode: str = "jitter",
+                         oa_polygons: gpd.GeoSeries = None,
+                         n_samples: int = MC_SAMPLES,
+                         batch_size: int = MC_BATCH_SIZE,
+                         radius: float = MC_JITTER_RADIUS,
+                         quantiles=(0.025, 0.975),
+                         seed: int = None) -> pd.DataFrame:
+    """Calculates per-LA intervals of the served percentage.
+
+    The stop buffers are built and indexed once. Each batch of samples is
+    then tested against them with one spatial index query, rather than
+    running the pipeline once per sample.
+
+    As in `SDG_eng_wales.py`, a stop only serves output areas in the
+    local authority it sits in.
+
+    Args:
+        pop_geo_df (gpd.GeoDataFrame): population weighted centroids with
+            pop_count and the local authority column.
+        stops_geo_df (gpd.GeoDataFrame): stops with a capacity_type column.
+        la_geo_df (gpd.GeoDataFrame): local authority boundaries.
+        lad_col (str): name of the local authority name column.
+        mode (str, optional): "jitter" to move centroids within `radius`,
+            or "polygon" to sample points inside `oa_polygons`.
+            Defaults to "jitter".
+        oa_polygons (gpd.GeoSeries, optional): output area boundaries in
+            the same row order as `pop_geo_df`. Needed for "polygon" mode.
+        n_samples (int, optional): number of samples. Defaults to the
+            mc_samples config value.
+        batch_size (int, optional): samples evaluated per query. Defaults
+            to the mc_batch_size config value.
+        radius (float, optional): jitter radius in metres. Defaults to the
+            mc_jitter_radius config value.
+        quantiles (tuple, optional): lower and upper quantiles of the
+            interval. Defaults to (0.025, 0.975).
+        seed (int, optional): seed for the random number generator.
+
+    Returns:
+        pd.DataFrame: one row per local authority with the served
+            percentage at the actual centroids, and the lower, median and
+            upper percentage across the samples.
+    """
+    if mode not in ["jitter", "polygon"]:
+        raise ValueError(f"""{mode} is not a valid mode,
+                         should be either jitter or polygon""")
+    if mode == "polygon" and oa_polygons is None:
+        raise ValueError("oa_polygons are needed for polygon mode")
+
+    rng = np.random.default_rng(seed)
+    pop_geo_df = pop_geo_df.reset_index(drop=True)
+    stops_geo_df = stops_geo_df.reset_index(drop=True)
+
+    # LA codes of each OA and each stop
+    la_names = pd.Index(pop_geo_df[lad_col].unique())
+    pop_la = la_names.get_indexer(pop_geo_df[lad_col])
+    in_la_stop, in_la_poly = gs.query_pairs(stops_geo_df.geometry,
+                                            la_geo_df,
+                                            query_name='robustness_stop_la')
+    stop_la = la_names.get_indexer(
+        la_geo_df[lad_col].to_numpy()[in_la_poly])
+    n_la = len(la_names)
+    stop_la_keys = (in_la_stop[stop_la >= 0] * n_la
+                    + stop_la[stop_la >= 0])
+
+    # Buffer the stops once for every batch. Their spatial index is built
+    # on the first query and reused after that
+    buffered = gs.buffer_points(
+        stops_geo_df[['capacity_type', 'geometry']].copy())
+
+    pop_count = pop_geo_df["pop_count"].to_numpy(dtype=float)
+    la_total = np.bincount(pop_la, weights=pop_count, minlength=n_la)
+    n_oas = len(pop_geo_df)
+
+    def _served_pct(x, y):
+        """Served percentage per LA for each row of sampled points."""
+        rows = x.shape[0]
+        points = shapely.points(x.ravel(), y.ravel())
+        point_idx, stop_idx = gs.buffer_pairs(points, buffered)
+        oa_idx = point_idx % n_oas
+        same_la = np.isin(stop_idx * n_la + pop_la[oa_idx], stop_la_keys)
+
+        served = np.zeros(rows * n_oas, dtype=bool)
+        served[point_idx[same_la]] = True
+        served = served.reshape(rows, n_oas)
+
+        # Sum served population per (sample, LA) with a single bincount
+        sample_la = (np.arange(rows)[:, None] * n_la + pop_la).ravel()
+        served_pop = np.bincount(sample_la,
+                                 weights=(served * pop_count).ravel(),
+                                 minlength=rows * n_la).reshape(rows, n_la)
+        return served_pop / la_total * 100
+
+    # Served percentage at the actual centroids
+    actual_pct = _served_pct(pop_geo_df.geometry.x.to_numpy()[None, :],
+                             pop_geo_df.geometry.y.to_numpy()[None, :])[0]
+
+    sample_pcts = []
+    for start in range(0, n_samples, batch_size):
+        rows = min(batch_size, n_samples - start)
+        if mode == "jitter":
+            x, y = jitter_points(pop_geo_df.geometry.x.to_numpy(),
+                                 pop_geo_df.geometry.y.to_numpy(),
+                                 rows, radius, rng)
+        else:
+            x, y = sample_points_in_polygons(oa_polygons, rows, rng)
+        sample_pcts.append(_served_pct(x, y))
+    sample_pcts = np.vstack(sample_pcts)
+
+    lower, median, upper = np.quantile(
+        sample_pcts, [quantiles[0], 0.5, quantiles[1]], axis=0)
+
+    return pd.DataFrame({"Local Authority": la_names,
+                         "Percentage served": actual_pct.round(2),
+                         "Lower": lower.round(2),
+                         "Median": median.round(2),
+                         "Upper": upper.round(2),
+                         "Samples": n_samples})
@@ -0,0 +1,329 @@
+"""Functions for what-if analysis of proposed stop additions and withdrawals.
+
+A baseline is built once from the preprocessed population and stops data.
+The baseline holds, for each output area, the number of stop buffers that
+reach its population weighted centroid. A scenario is a list of stops to
+add or remove; only the output areas near those stops are re-counted, and
+only the local authorities they fall in are re-calculated.
+"""
+# Core imports
+import os
+
+# Third party imports
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import yaml
+
+# Module imports
+import geospatial_mods as gs
+import data_transform as dt
+import data_output as do
+
+# Get current working directory
+CWD = os.getcwd()
+
+# Load config
+with open(os.path.join(CWD, "config.yaml"), encoding="utf-8") as yamlfile:
+    config = yaml.load(yamlfile, Loader=yaml.FullLoader)
+    module = os.path.basename(__file__)
+    print(f"Config loaded in {module}")
+
+# Constants
+DEFAULT_CRS = config["default_crs"]
+CALCULATION_YEAR = str(config["calculation_year"])
+
+AGE_BINS = ['0-4', '5-9', '10-14', '15-19', '20-24',
+            '25-29', '30-34', '35-39', '40-44', '45-49', '50-54',
+            '55-59', '60-64', '65-69', '70-74', '75-79',
+            '80-84', '85-89', '90+']
+SEX_COLS = ['male', 'female']
+STOP_KEY_COLS = ['easting', 'northing', 'capacity_type']
+DELTA_COLS = STOP_KEY_COLS + ['action']
+SUMMARY_COLS = ['Local Authority', 'Total', 'Baseline served',
+                'Scenario served']
+
+
+class ScenarioEngine:
+    """Holds the per output area reach counts of a baseline run.
+
+    The counts follow the same rules as `SDG_eng_wales.py`: a stop only
+    serves the output areas of the local authority it sits in, and an
+    output area is served if its centroid is inside at least one buffer.
+
+    Args:
+        pop_geo_df (gpd.GeoDataFrame): population weighted centroids with
+            the local authority column, population counts and the
+            disaggregation columns. Disability numbers must already have
+            been added with `dt.disab_disagg` and the sex columns renamed to
+            "male" and "female", as in `SDG_eng_wales.py`.
+        stops_geo_df (gpd.GeoDataFrame): the baseline stops, with a
+            capacity_type column.
+        la_geo_df (gpd.GeoDataFrame): local authority boundaries.
+        lad_col (str): name of the local authority name column, e.g.
+            "LAD11NM".
+    """
+
+    def __init__(self, pop_geo_df, stops_geo_df, la_geo_df, lad_col):
+        self.lad_col = lad_col
+        self.pop_geo_df = pop_geo_df.reset_index(drop=True)
+        self.la_geo_df = (la_geo_df[[lad_col, 'geometry']]
+                          .reset_index(drop=True))
+
+        # Integer codes for each local authority so that stop-LA and
+        # OA-LA pairs can be compared as arrays
+        self.la_names = pd.Index(self.la_geo_df[lad_col].unique())
+        self._la_code = self.la_names.get_indexer(self.la_geo_df[lad_col])
+        self._pop_la = self.la_names.get_indexer(self.pop_geo_df[lad_col])
+
+        # Removals are matched to these stops on their exact location
+        # and capacity type
+        self._stop_keys = _occurrence_keys(pd.DataFrame(
+            {"easting": stops_geo_df.geometry.x,
+             "northing": stops_geo_df.geometry.y,
+             "capacity_type": stops_geo_df["capacity_type"]}))
+
+        oa_idx, _ = self._reach_pairs(stops_geo_df)
+        self.baseline_reach = np.bincount(oa_idx,
+                                          minlength=len(self.pop_geo_df))
+
+    def _reach_pairs(self, stops_geo_df):
+        """Finds (output area, stop) pairs where the stop serves the OA.
+
+        Args:
+            stops_geo_df (gpd.GeoDataFrame): stops with a capacity_type
+                column.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: positional indices of the output
+                areas and of the stops in each pair.
+        """
+        stops_geo_df = stops_geo_df.reset_index(drop=True)
+        buffered = gs.buffer_points(
+            stops_geo_df[['capacity_type', 'geometry']].copy())
+
+        # Query the centroid index with the buffers. The index is built
+        # on the first query and reused by every scenario after that
+        stop_idx, oa_idx = gs.query_pairs(buffered.geometry,
+                                          self.pop_geo_df,
+                                          query_name='scenario_reach')
+
+        # The pipeline only buffers stops inside the LA being processed,
+        # so a stop can only serve the OAs of the LA(s) it is in
+        n_la = len(self.la_names)
+        in_la_stop, in_la_poly = gs.query_pairs(stops_geo_df.geometry,
+                                                self.la_geo_df,
+                                                query_name='scenario_stop_la')
+        stop_la_keys = in_la_stop * n_la + self._la_code[in_la_poly]
+        pair_keys = stop_idx * n_la + self._pop_la[oa_idx]
+        same_la = np.isin(pair_keys, stop_la_keys)
+
+        return oa_idx[same_la], stop_idx[same_la]
+
+    def apply_delta(self, delta_df: pd.DataFrame):
+        """Applies stop additions and removals to the baseline reach counts.
+
+        Args:
+            delta_df (pd.DataFrame): one row per changed stop with the
+                columns easting, northing, capacity_type ("high" or "low")
+                and action ("add" or "remove"). A removed stop must have
+                the exact easting, northing and capacity type of a
+                baseline stop.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: the scenario reach count for
+                every output area, and the positional indices of the
+                output areas whose count changed.
+        """
+        missing_cols = [col for col in DELTA_COLS
+                        if col not in delta_df.columns]
+        if missing_cols:
+            raise ValueError(f"Delta is missing columns: {missing_cols}")
+
+        bad_actions = set(delta_df["action"]) - {"add", "remove"}
+        if bad_actions:
+            raise ValueError(f"""{bad_actions} are not valid actions,
+                             should be either add or remove""")
+
+        delta_df = delta_df.reset_index(drop=True)
+        is_add = (delta_df["action"] == "add").to_numpy()
+
+        # Each removal takes out one baseline stop, so a stop listed
+        # twice must be in the baseline twice
+        remove_keys = _occurrence_keys(
+            delta_df.loc[~is_add, STOP_KEY_COLS])
+        matched = remove_keys.merge(self._stop_keys,
+                                    on=STOP_KEY_COLS + ['occurrence'],
+                                    how='left',
+                                    suffixes=('', '_baseline'))
+        unmatched = matched['row_baseline'].isna().to_numpy()
+        if unmatched.any():
+            unmatched_stops = (delta_df[~is_add][unmatched][DELTA_COLS]
+                               .to_dict('records'))
+            raise ValueError(f"""Removed stops are not in the baseline stops
+                             data: {unmatched_stops}""")
+
+        # Added stops are buffered as given, removed stops as the baseline
+        # stops they matched
+        removed_df = self._stop_keys.iloc[
+            matched['row_baseline'].astype(int)]
+        delta_geo_df = gs.geo_df_from_pd_df(
+            pd_df=pd.concat([delta_df.loc[is_add, STOP_KEY_COLS],
+                             removed_df[STOP_KEY_COLS]],
+                            ignore_index=True),
+            geom_x='easting',
+            geom_y='northing',
+            crs=DEFAULT_CRS)
+
+        # Added stops count up, removed stops count down
+        sign = np.repeat([1, -1], [is_add.sum(), len(removed_df)])
+
+        oa_idx, stop_idx = self._reach_pairs(delta_geo_df)
+
+        scenario_reach = self.baseline_reach.copy()
+        np.add.at(scenario_reach, oa_idx, sign[stop_idx])
+
+        return scenario_reach, np.unique(oa_idx)
+
+    def run(self, delta_df: pd.DataFrame):
+        """Runs a scenario and calculates results for the affected LAs.
+
+        Args:
+            delta_df (pd.DataFrame): the changed stops, see `apply_delta`.
+
+        Returns:
+            Tuple[pd.DataFrame, pd.DataFrame]: a summary of the served
+                percentage before and after for each affected local
+                authority, and the full scenario results (totals and
+                disaggregations) for those local authorities in the
+                same layout as the pipeline's output csv. Both are empty
+                when the delta reaches no output area.
+        """
+        scenario_reach, changed_oas = self.apply_delta(delta_df)
+
+        affected_las = self.la_names[np.unique(self._pop_la[changed_oas])]
+
+        summary_rows = []
+        results_dfs = []
+        for local_auth in affected_las:
+            la_mask = (self.pop_geo_df[self.lad_col] == local_auth).to_numpy()
+            la_pop_df = self.pop_geo_df[la_mask]
+
+            baseline_srvd = la_pop_df[self.baseline_reach[la_mask] > 0]
+            scenario_srvd = la_pop_df[scenario_reach[la_mask] > 0]
+
+            full_pop = la_pop_df.pop_count.sum()
+            summary_rows.append(
+                {"Local Authority": local_auth,
+                 "Total": full_pop,
+                 "Baseline served": baseline_srvd.pop_count.sum(),
+                 "Scenario served": scenario_srvd.pop_count.sum()})
+
+            results_dfs.append(
+                la_results(la_pop_df, scenario_srvd, local_auth))
+
+        summary_df = pd.DataFrame(summary_rows, columns=SUMMARY_COLS)
+        for run_type in ["Baseline", "Scenario"]:
+            summary_df[f"{run_type} percentage served"] = round(
+                summary_df[f"{run_type} served"] / summary_df["Total"] * 100,
+                2)
+        summary_df["Change in percentage served"] = (
+            summary_df["Scenario percentage served"]
+            - summary_df["Baseline percentage served"])
+
+        if not results_dfs:
+            return summary_df, pd.DataFrame(columns=do.FINAL_COLS)
+
+        results_df = pd.concat(results_dfs)
+        results_df["Year"] = CALCULATION_YEAR
+        results_df = do.reorder_final_df(results_df.reset_index(drop=True))
+
+        return summary_df, results_df
+
+
+def _occurrence_keys(stops_df: pd.DataFrame) -> pd.DataFrame:
+    """Makes keys to match stops on their location and capacity type.
+
+    Stops at the same location with the same capacity type are numbered
+    in the order they appear, so each one can only be matched once.
+
+    Args:
+        stops_df (pd.DataFrame): stops with easting, northing and
+            capacity_type columns.
+
+    Returns:
+        pd.DataFrame: the easting, northing, capacity_type and occurrence
+            of each stop, and its position in `stops_df` in a row column.
+    """
+    keys_df = pd.DataFrame(
+        {"easting": stops_df["easting"].astype(float).to_numpy(),
+         "northing": stops_df["northing"].astype(float).to_numpy(),
+         "capacity_type": stops_df["capacity_type"].to_numpy()})
+    keys_df["occurrence"] = keys_df.groupby(STOP_KEY_COLS).cumcount()
+    keys_df["row"] = np.arange(len(keys_df))
+    return keys_df
+
+
+def la_results(la_pop_df: gpd.GeoDataFrame,
+               served_pop_df: gpd.GeoDataFrame,
+               local_auth: str) -> pd.DataFrame:
+    """Calculates the total and disaggregated results for one LA.
+
+    Follows the same steps as the local authority loop in
+    `SDG_eng_wales.py`.
+
+    Args:
+        la_pop_df (gpd.GeoDataFrame): every output area in the LA.
+        served_pop_df (gpd.GeoDataFrame): the output areas in the LA which
+            are served by public transport, one row per output area.
+        local_auth (str): The local authority of interest.
+
+    Returns:
+        pd.DataFrame: the total, age, sex, disability and urban/rural
+            results for the local authority, stacked.
+    """
+    # Totals
+    served = served_pop_df.pop_count.sum()
+    full_pop = la_pop_df.pop_count.sum()
+    not_served = full_pop - served
+    pct_not_served = "{:.2f}".format(not_served / full_pop * 100)
+    pct_served = "{:.2f}".format(served / full_pop * 100)
+
+    la_results_df = pd.DataFrame({"All_pop": [full_pop],
+                                  "Served": [served],
+                                  "Unserved": [not_served],
+                                  "Percentage served": [pct_served],
+                                  "Percentage unserved": [pct_not_served]})
+    la_results_df = la_results_df.T.rename(columns={0: "Total"})
+    la_results_df_out = do.reshape_for_output(la_results_df,
+                                              id_col="Total",
+                                              local_auth=local_auth)
+    la_results_df_out.drop("Total", axis=1, inplace=True)
+
+    # Age
+    age_servd_df = dt.served_proportions_disagg(pop_df=la_pop_df,
+                                                pop_in_poly_df=served_pop_df,
+                                                cols_lst=AGE_BINS)
+    age_servd_df_out = do.reshape_for_output(age_servd_df,
+                                             id_col="Age",
+                                             local_auth=local_auth)
+
+    # Sex
+    sex_servd_df = dt.served_proportions_disagg(pop_df=la_pop_df,
+                                                pop_in_poly_df=served_pop_df,
+                                                cols_lst=SEX_COLS)
+    sex_servd_df_out = do.reshape_for_output(sex_servd_df,
+                                             id_col="Sex",
+                                             local_auth=local_auth)
+
+    # Disability and urban/rural
+    disab_servd_df_out = dt.disab_dict(la_pop_df, served_pop_df,
+                                       {}, local_auth)[local_auth]
+    urb_rur_servd_df_out = dt.urban_rural_results(la_pop_df, served_pop_df,
+                                                  {}, local_auth)[local_auth]
+
+    return pd.concat([la_results_df_out,
+                      sex_servd_df_out,
+                      urb_rur_servd_df_out,
+                      disab_servd_df_out,
+                      age_servd_df_out])
@@ -2,10 +2,12 @@
 import os
 import sys
 import logging
+import zipfile
 
 # Third party modules
 import yaml
 import pandas as pd
+from datetime import datetime
 
 
 # # Getting the parent directory of the current file
@@ -15,8 +17,14 @@ parent = os.path.dirname(current)
 sys.path.append(parent)
 
 # Our modules
-import data_ingest as di # noqa E402
-import data_transform as dt # noqa E402
+import data_ingest as di  # noqa E402
+import time_table_utils as ttu  # noqa E402
+import bus_feeds as bf  # noqa E402
+import duckdb_counts as dc  # noqa E402
+from stop_hour_counts import StopHourCounts, StopDayHourCounts  # noqa E402
+from trip_snapshot import TripSnapshot  # noqa E402
+from headways import headway_stats  # noqa E402
+from gtfs_cache import GTFSParquetCache  # noqa E402
 
 # Get current working directory
 CWD = os.getcwd()
@@ -45,19 +53,61 @@ bus_dataset_name = 'itm_all_gtfs'
 bus_data_output_dir = os.path.join('data', 'england_bus_timetable')
 zip_path = os.path.join(bus_data_output_dir, bus_dataset_name)
 required_files = ['stop_times', 'trips', 'calendar']
+optional_files = ['calendar_dates', 'frequencies']
 auto_download_bus = config["auto_download_bus"]
+bus_read_from_zip = config["bus_read_from_zip"]
+bus_incremental_counts = config["bus_incremental_counts"]
+bus_collapse_duplicate_trips = config["bus_collapse_duplicate_trips"]
+bus_parquet_cache = config["bus_parquet_cache"]
+bus_agencies = config["bus_agencies"]
+if bus_agencies is not None and not bus_parquet_cache:
+    raise ValueError("bus_agencies needs bus_parquet_cache to be true")
+bus_regions = config["bus_regions"]
+bus_region_zip_link = config["eng_bus_region_timetable_data"]
+bus_region_workers = config["bus_region_workers"]
 timetable_day = config["timetable_day"]
 day_filter_type = config["day_filter"]
+exact_timetable_date = config["timetable_date"]
 early_timetable_hour = config["early_timetable_hour"]
 late_timetable_hour = config["late_timetable_hour"]
+headway_thresholds = config["headway_thresholds"]
+timetable_engine = config["timetable_engine"]
+duckdb_threads = config["duckdb_threads"]
+duckdb_memory_limit = config["duckdb_memory_limit"]
+if timetable_engine not in ("pandas", "duckdb"):
+    raise ValueError(f"""{timetable_engine} is not a valid timetable engine,
+                     should be either pandas or duckdb""")
+if timetable_engine == "duckdb" and (
+        day_filter_type != "general"
+        or bus_regions is not None
+        or bus_agencies is not None):
+    raise ValueError("""The duckdb timetable engine needs the general day
+                     filter, and can not be used with bus_regions or
+                     bus_agencies""")
+
+# The national feed, or the regional feeds processed in parallel
+if bus_regions is None:
+    bus_feed_links = {bus_dataset_name: bus_timetable_zip_link}
+else:
+    if day_filter_type != "general" or not bus_read_from_zip:
+        raise ValueError("""bus_regions needs the general day filter and
+                         bus_read_from_zip to be true""")
+    bus_feed_links = {f"{region}_gtfs": bus_region_zip_link.format(
+        region=region) for region in bus_regions}
+feed_paths = [os.path.join(bus_data_output_dir, feed_name)
+              for feed_name in bus_feed_links]
 
 # Calculate if bus timetable needs to be downloaded.
 # If current folder doesnt exist, or hasnt been modified then
 # flag to be downloaded
 
-files_to_check = [f"{file}.txt" for file in required_files]
-paths_to_check = [os.path.join(bus_data_output_dir, file)
-                  for file in files_to_check]
+# When reading from the zip, the zip is kept as the cached download
+if bus_read_from_zip:
+    paths_to_check = feed_paths
+else:
+    files_to_check = [f"{file}.txt" for file in required_files]
+    paths_to_check = [os.path.join(bus_data_output_dir, file)
+                      for file in files_to_check]
 each_file_checked = [di.persistent_exists(path) for path in paths_to_check]
 
 if not all(each_file_checked):
@@ -80,185 +130,259 @@ else:
 # Using individual data ingest functions (rather than
 # import_extract_delete_zip) as files are .txt not .csv.
 if download_bus_timetable and auto_download_bus:
-    di.grab_zip(file_nm=bus_dataset_name,
-                 zip_link=bus_timetable_zip_link,
-                 zip_path=zip_path)
-
-    # Extract the required files
-    for file in required_files:
-        file_extension_name = f"{file}.txt"
-
-        di.extract_zip(file_nm=bus_dataset_name,
-                        csv_nm=file_extension_name,
-                        zip_path=zip_path,
-                        csv_path=bus_data_output_dir)
-
-    # Remove zip file
-    di.delete_junk(file_nm=bus_dataset_name,
-                    zip_path=zip_path)
+    for feed_name, feed_link in bus_feed_links.items():
+        di.grab_zip(file_nm=feed_name,
+                    zip_link=feed_link,
+                    zip_path=os.path.join(bus_data_output_dir, feed_name))
+
+    if not bus_read_from_zip:
+        # Extract the required files, and the optional ones in the zip
+        with zipfile.ZipFile(zip_path) as bus_zip:
+            zip_names = bus_zip.namelist()
+        files_to_extract = required_files + [
+            file for file in optional_files if f"{file}.txt" in zip_names]
+        for file in files_to_extract:
+            file_extension_name = f"{file}.txt"
+
+            di.extract_zip(file_nm=bus_dataset_name,
+                           csv_nm=file_extension_name,
+                           zip_path=zip_path,
+                           csv_path=bus_data_output_dir)
+
+        # Remove zip file
+        di.delete_junk(file_nm=bus_dataset_name,
+                       zip_path=zip_path)
+
+# The GTFS files are read from the zip, or from the extracted text files
+gtfs_path = zip_path if bus_read_from_zip else bus_data_output_dir
 
 # ------------------------------------------
 # Load the text files into pandas dataframes
 # ------------------------------------------
 
-# Specify dtypes to remove unwanted columns and allow loading due to
-# mixed data types in certain columns.
-# Cannot parse datetime dtypes, and current function doesnt allow parse_dates
-# parameter in read_csv. So reading in as object type for the time being.
-# Dont think they need to be datetime format as we are using every trip
-# regardless of the date, and just want to extract the HH from the date which
-# can be done from a string.
-
-# Stop times
-feath_ = os.path.join(bus_data_output_dir, "stop_times.feather")
-if os.path.exists(feath_):
-    stop_times_df = di.feath_to_df("stop_times", feath_)
-else:
-    stop_times_types = {'trip_id': 'category',
-                        'departure_time': 'object', 'stop_id': 'category'}
-
-    stop_times_df = di.csv_to_df(file_nm='stop_times',
-                                  csv_path=os.path.join(
-                                      bus_data_output_dir, 'stop_times.txt'),
-                                  dtypes=stop_times_types)
-
-# trips
-feath_ = os.path.join(bus_data_output_dir, "trips.feather")
-if os.path.exists(feath_):
-    trips_df = di.feath_to_df("trips", feath_)
-else:
-    trips_types = {'route_id': 'category',
-                   'service_id': 'category', 'trip_id': 'category'}
-
-    trips_df = di.csv_to_df(
-        file_nm='trips',
-        csv_path=os.path.join(
-            bus_data_output_dir,
-            'trips.txt'),
-        dtypes=trips_types)
-
-# calendar
-# NOTE: Not adding in saturday and sunday columns for stops because
-# we are only interested in weekday trips for highly serviced stops
-feath_ = os.path.join(bus_data_output_dir, "calendar.feather")
-if os.path.exists(feath_):
-    calendar_df = di.feath_to_df("calendar", feath_)
-else:
-    calendar_types = {
-        'service_id': 'category',
-        'monday': 'int64',
-        'tuesday': 'int64',
-        'wednesday': 'int64',
-        'thursday': 'int64',
-        'friday': 'int64',
-        'start_date': 'object',
-        'end_date': 'object'}
-
-    calendar_df = di.csv_to_df(file_nm='calendar',
-                                csv_path=os.path.join(
-                                    bus_data_output_dir, 'calendar.txt'),
-                                dtypes=calendar_types)
-
-# ----------
-# Clean data
-# ----------
-
-# Some departure times are > 24:00 so need to be removed.
-# This is done automatically by restricting times to hours used
-# to define highly serviced stops
-
-hour_range = range(early_timetable_hour, late_timetable_hour)
-valid_hours = [f'0{i}' if i < 10 else f'{i}' for i in hour_range]
-
-# Check departure times for any NA values
-if stop_times_df['departure_time'].isna().any():
-    print("There are NA values in departure_time column")
-    # If there are any, remove them
-    stop_times_df = stop_times_df.dropna(subset=['departure_time'])
-
-# Filter stop times to only include valid hours
-stop_times_df = stop_times_df[
-    stop_times_df['departure_time'].str.startswith(tuple(valid_hours))]
-
-# Convert start and end date to datetime format
-calendar_df['start_date'] = pd.to_datetime(
-    calendar_df['start_date'], format='%Y%m%d')
-calendar_df['end_date'] = pd.to_datetime(
-    calendar_df['end_date'], format='%Y%m%d')
-
-# ----------------
-# Join data frames
-# ----------------
-
-bus_timetable_df = (
-    (stop_times_df.merge(trips_df, on='trip_id', how='left'))
-    .merge(calendar_df, on='service_id', how='left')
-)
-
-# Remove columns no longer required
-# NOTE: Route_id not used at all so could be removed at load
-bus_timetable_df = bus_timetable_df.drop(
-    columns=['trip_id', 'route_id'])  # 'service_id'
-
-
-# ----------------------------
-# Extract stops for chosen day
-# ----------------------------
-
-# Only interested in stops that are used on a certain day
+# Departures in the hours used to define highly serviced stops, linked to
+# the service running each one. Some departure times are > 24:00, these
+# are removed by the same filter. Frequency based trips are expanded into
+# a departure per journey, and trips with the same stops, departure times
+# and days of the week are only counted once.
+# The regional feeds, and the feed for the duckdb engine, are loaded
+# later. For the exact day filter duplicates are collapsed once the date
+# is applied, as trips with the same days can run on different dates.
+if bus_regions is None and timetable_engine == "pandas":
+    gtfs_cache = (GTFSParquetCache(gtfs_path,
+                                   os.path.join(bus_data_output_dir,
+                                                'gtfs_cache'))
+                  if bus_parquet_cache else None)
+    (stop_times_df,
+     service_rows,
+     service_calendar,
+     calendar_df) = bf.load_departures(
+        gtfs_path,
+        early_hour=early_timetable_hour,
+        late_hour=late_timetable_hour,
+        collapse_duplicates=(bus_collapse_duplicate_trips
+                             and day_filter_type == "general"),
+        gtfs_cache=gtfs_cache,
+        agencies=bus_agencies)
+
+
+# -----------------------------------
+# Find frequency of stops on each day
+# -----------------------------------
+
+timetable_vintage = datetime.fromtimestamp(
+    max(os.path.getmtime(path) for path in feed_paths)).strftime('%Y%m%d')
 
 if day_filter_type == "general":
+    # Departures per stop, day of the week and hour, counted in one pass
+    # from the days each service runs. Saved for this timetable so other
+    # service levels can be tested later
     timetable_day = timetable_day.lower()
-    serviced_bus_stops_df = (
-        bus_timetable_df[bus_timetable_df[timetable_day] == 1]
-    )
+    if timetable_engine == "duckdb":
+        # The filters, joins and hour pivot run as SQL in DuckDB, which
+        # spills to disk rather than holding the timetable in memory
+        con = dc.create_connection(
+            os.path.join(bus_data_output_dir, 'duckdb_tmp'),
+            threads=duckdb_threads,
+            memory_limit=duckdb_memory_limit)
+        dc.load_gtfs_departures(
+            con,
+            gtfs_path,
+            early_hour=early_timetable_hour,
+            late_hour=late_timetable_hour,
+            collapse_duplicates=bus_collapse_duplicate_trips)
+        stop_day_hour_counts = dc.stop_day_hour_counts(
+            con,
+            early_hour=early_timetable_hour,
+            late_hour=late_timetable_hour)
+
+        # Departures on the chosen day, for the headways
+        day_stop_ids, day_departure_secs = dc.day_departures(con,
+                                                             timetable_day)
+        con.close()
+    else:
+        if bus_regions is not None:
+            # Each regional feed is loaded and its trips hashed in a separate
+            # process. Trips in more than one regional feed, e.g. crossing a
+            # boundary, are kept once so shared stops are not double counted
+            trip_snapshot = bf.regional_snapshot(
+                feed_paths,
+                timetable_vintage,
+                early_hour=early_timetable_hour,
+                late_hour=late_timetable_hour,
+                collapse_duplicates=bus_collapse_duplicate_trips,
+                n_workers=bus_region_workers)
+        elif bus_incremental_counts:
+            trip_snapshot = TripSnapshot.from_departures(
+                timetable_vintage,
+                stop_times_df['trip_id'],
+                stop_times_df['stop_id'],
+                stop_times_df['departure_time'],
+                service_rows,
+                service_calendar.day_flags,
+                early_hour=early_timetable_hour,
+                late_hour=late_timetable_hour)
+        else:
+            trip_snapshot = None
+
+        if trip_snapshot is None:
+            stop_day_hour_counts = StopDayHourCounts.from_departures(
+                stop_times_df['stop_id'],
+                stop_times_df['departure_time'],
+                service_calendar.day_flags,
+                early_hour=early_timetable_hour,
+                late_hour=late_timetable_hour,
+                service_rows=service_rows)
+        elif bus_incremental_counts:
+            # Update the previous vintage's counts with only the trips that
+            # were added or removed since. The counts are kept in the
+            # snapshot, and only updated when the trips were loaded with
+            # the same settings
+            snapshot_settings = (
+                f"bus_regions={bus_regions};bus_agencies={bus_agencies};"
+                f"bus_collapse_duplicate_trips={bus_collapse_duplicate_trips}")
+            stop_day_hour_counts = trip_snapshot.refresh_counts(
+                bus_data_output_dir,
+                settings=snapshot_settings)
+            trip_snapshot.save(TripSnapshot.path(bus_data_output_dir))
+        else:
+            stop_day_hour_counts = trip_snapshot.counts()
+
+        # Departures on the chosen day, for the headways
+        if trip_snapshot is None:
+            day_stop_times_df = stop_times_df[ttu.rows_running(
+                service_rows, service_calendar.runs_on_weekday(timetable_day))]
+            day_stop_ids = day_stop_times_df['stop_id']
+            day_departure_secs = day_stop_times_df['departure_time']
+        else:
+            day_stop_ids, day_departure_secs = trip_snapshot.departures(
+                timetable_day)
+    stop_day_hour_counts.save(StopDayHourCounts.path(bus_data_output_dir,
+                                                     timetable_vintage))
+    counts_day = timetable_day
+
+    # Only keep those which have at least one service an hour, for
+    # every day of the week
+    bus_served_days_df = stop_day_hour_counts.served_by_day(min_per_hour=1)
 elif day_filter_type == "exact":
-    timetable_day = timetable_day.capitalize()
-    serviced_bus_stops = dt.filter_bus_timetable_by_day(
-        bus_timetable_df, timetable_day.capitalize())
+    # Use the date in config, or pick a date for the day
+    if exact_timetable_date is None:
+        timetable_day = timetable_day.capitalize()
+        timetable_date, _ = ttu.select_date_for_day(
+            calendar_df['start_date'].min(),
+            calendar_df['end_date'].max(),
+            timetable_day)
+    else:
+        timetable_date = pd.Timestamp(exact_timetable_date)
+    counts_day = str(timetable_date.date())
+
+    # Which services run is worked out once per service, then gathered to
+    # the stops
+    service_runs = service_calendar.active_on(timetable_date)
+    day_stop_times_df = stop_times_df[
+        ttu.rows_running(service_rows, service_runs)]
+
+    # Of trips with the same stops and times, keep one that runs on the
+    # date
+    if bus_collapse_duplicate_trips:
+        duplicate_rows = ttu.duplicate_trip_rows(
+            day_stop_times_df['trip_id'],
+            day_stop_times_df['stop_id'],
+            day_stop_times_df['departure_time'])
+        logger.info(f"Collapsed "
+                    f"{day_stop_times_df['trip_id'][duplicate_rows].nunique()}"
+                    f" duplicate trips running on {counts_day}")
+        day_stop_times_df = day_stop_times_df[~duplicate_rows]
+    day_stop_ids = day_stop_times_df['stop_id']
+    day_departure_secs = day_stop_times_df['departure_time']
+
+    # Departures per stop and hour, saved for this timetable and date
+    stop_hour_counts = StopHourCounts.from_departures(
+        day_stop_times_df['stop_id'],
+        day_stop_times_df['departure_time'],
+        early_hour=early_timetable_hour,
+        late_hour=late_timetable_hour)
+    stop_hour_counts.save(StopHourCounts.path(bus_data_output_dir,
+                                              timetable_vintage,
+                                              counts_day))
+
+    # Only keep those which have at least one service an hour
+    bus_served_days_df = pd.DataFrame(
+        {'stop_id': stop_hour_counts.served_stops(min_per_hour=1),
+         'day': counts_day})
 else:
-    print("Error: input error on day filter setting.")
-
-# -----------------------
-# Find frequency of stops
-# -----------------------
-
-# Take just HH from departure time
-serviced_bus_stops_df['departure_time'] = (
-    serviced_bus_stops_df['departure_time'].str.slice(0, 2)
-)
-
-bus_frequencies_df = pd.pivot_table(data=serviced_bus_stops_df,
-                                    values=timetable_day,
-                                    index='stop_id',
-                                    columns='departure_time',
-                                    aggfunc=len,
-                                    fill_value=0)
+    raise ValueError(f"""{day_filter_type} is not a valid day filter,
+                     should be either general or exact""")
+
+# --------------------------
+# Find headways at the stops
+# --------------------------
+
+# Gaps between departures at each stop on the chosen day
+bus_headways_df = headway_stats(day_stop_ids,
+                                day_departure_secs,
+                                early_hour=early_timetable_hour,
+                                late_hour=late_timetable_hour,
+                                thresholds=headway_thresholds)
+bus_headways_df.to_csv(
+    os.path.join(bus_data_output_dir,
+                 f'bus_stop_headways_{counts_day.lower()}.csv'),
+    index=False)
 
 
 # -----------------------------
 # Extract highly serviced stops
 # -----------------------------
 
-# Only keep those which have at least one service an hour
-bus_highly_serviced_stops = bus_frequencies_df[(
-    bus_frequencies_df > 0).all(axis=1)]
-
 # Read in naptan data
 stops_df = di.get_stops_file(url=config["naptan_api"],
                              dir=os.path.join("data", "stops"))
 
 # Add easting and northing
-bus_highly_serviced_stops = bus_highly_serviced_stops.merge(
+bus_served_days_df = bus_served_days_df.merge(
     stops_df, how='inner', left_on='stop_id', right_on='ATCOCode')
 
 # Remove stops that dont have coordinates
-bus_highly_serviced_stops = bus_highly_serviced_stops.dropna(
+bus_served_days_df = bus_served_days_df.dropna(
     subset=['Easting', 'Northing'], how='any')
 
-# Drop the hours columns
+# Keep the columns needed, with the day each stop is highly serviced on
+bus_served_days_df = (
+    bus_served_days_df[['NaptanCode', 'Easting', 'Northing', 'day']]
+    .reset_index(drop=True))
+bus_served_days_df.to_feather(os.path.join(
+    bus_data_output_dir, 'bus_highly_serviced_stops_by_day.feather'))
+bus_served_days_df.to_csv(
+    os.path.join(
+        bus_data_output_dir,
+        'bus_highly_serviced_stops_by_day.csv'),
+    index=False)
+
+# Stops for the chosen day
 bus_highly_serviced_stops = (
-    bus_highly_serviced_stops[['NaptanCode', 'Easting', 'Northing']])
+    bus_served_days_df[bus_served_days_df['day'] == counts_day]
+    .drop(columns=['day'])
+    .reset_index(drop=True))
 
 # Save a copy to be ingested by SDG_11.2.1_main
 bus_highly_serviced_stops.to_feather(os.path.join(
@@ -0,0 +1,97 @@
+# core
+import os
+import sys
+import json
+import logging
+from datetime import datetime
+
+# third party
+import yaml
+
+# # Getting the parent directory of the current file
+current = os.path.dirname(os.path.realpath(__file__))
+# Appending to path so that we can import modules from the src folder
+sys.path.append(current)
+
+# Our modules
+import synthetic_timetables as st  # noqa E402
+import timetable_benchmarks as tb  # noqa E402
+
+# Create logger
+BenchmarkLogger = logging.getLogger(__name__)
+BenchmarkLogger.setLevel(logging.INFO)
+
+# Create a console handler
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
+
+# Add the console handler to the logger
+BenchmarkLogger.addHandler(console_handler)
+
+# get current working directory
+CWD = os.getcwd()
+
+# The stages run in spawned processes, which import this script again, so
+# it only runs when called directly
+if __name__ == "__main__":
+    # Load config
+    with open(os.path.join(CWD, "config.yaml")) as yamlfile:
+        config = yaml.load(yamlfile, Loader=yaml.FullLoader)
+        module = os.path.basename(__file__)
+        print(f"Config loaded in {module}")
+
+    # Parameters
+    benchmark_output_dir = os.path.join('data', 'timetable_benchmarks')
+    benchmark_scale = config["benchmark_scale"]
+    benchmark_seed = config["benchmark_seed"]
+    benchmark_repeats = config["benchmark_repeats"]
+    benchmark_stages = config["benchmark_stages"]
+    params = {"early_hour": config["early_timetable_hour"],
+              "late_hour": config["late_timetable_hour"],
+              "mca_workers": config["train_mca_workers"],
+              "duckdb_threads": config["duckdb_threads"],
+              "duckdb_memory_limit": config["duckdb_memory_limit"],
+              "work_dir": os.path.join(benchmark_output_dir, 'work')}
+
+    # ---------------------------------
+    # Write the synthetic timetables
+    # ---------------------------------
+
+    # The timetables are kept, with a manifest of their sizes, and only
+    # written again for a different scale or seed
+    timetable_dir = os.path.join(
+        benchmark_output_dir,
+        f'scale_{benchmark_scale}_seed_{benchmark_seed}')
+    manifest_file = os.path.join(timetable_dir, 'manifest.json')
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as json_file:
+            inputs = json.load(json_file)
+    else:
+        os.makedirs(timetable_dir, exist_ok=True)
+        inputs = {
+            **st.write_cif(timetable_dir,
+                           scale=benchmark_scale,
+                           seed=benchmark_seed),
+            **st.write_gtfs(os.path.join(timetable_dir, 'gtfs.zip'),
+                            scale=benchmark_scale,
+                            seed=benchmark_seed)}
+        with open(manifest_file, 'w') as json_file:
+            json.dump(inputs, json_file, indent=2)
+
+    # ---------------------
+    # Run the benchmarks
+    # ---------------------
+
+    results_df = tb.run_benchmarks(inputs,
+                                   params,
+                                   stages=benchmark_stages,
+                                   repeats=benchmark_repeats)
+    results_df.insert(0, 'scale', benchmark_scale)
+
+    results_file = os.path.join(
+        benchmark_output_dir,
+        f'timetable_benchmarks_{datetime.now():%Y%m%d_%H%M%S}.csv')
+    results_df.to_csv(results_file, index=False)
+    BenchmarkLogger.info(f"Benchmark results saved to {results_file}")
+    BenchmarkLogger.info(results_df.drop(columns="scale").round(2)
+                         .to_string(index=False))
@@ -15,9 +15,13 @@ current = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(current)
 
 # Our modules
-import time_table_utils as ttu # noqa E402
-import data_transform as dt # noqa E402
-import data_ingest as di # noqa E402
+import time_table_utils as ttu  # noqa E402
+from stp_resolver import STPResolver  # noqa E402
+from stop_hour_counts import StopHourCounts, StopDayHourCounts  # noqa E402
+from headways import headway_stats  # noqa E402
+from station_index import StationIndex  # noqa E402
+import duckdb_counts as dc  # noqa E402
+import data_ingest as di  # noqa E402
 
 # Create logger
 TrainLogger = logging.getLogger(__name__)
@@ -42,14 +46,24 @@ with open(os.path.join(CWD, "config.yaml")) as yamlfile:
 
 # Parameters
 trn_data_output_dir = os.path.join('data', 'england_train_timetable')
-station_locations = os.path.join(trn_data_output_dir,
-                                 config['station_locations'])
 msn_file = os.path.join(trn_data_output_dir, config["train_msn_filename"])
 mca_file = os.path.join(trn_data_output_dir, config["train_mca_filename"])
+mca_workers = config["train_mca_workers"]
 day_filter_type = config["day_filter"]
 timetable_day = config["timetable_day"]
+exact_timetable_date = config["timetable_date"]
 early_timetable_hour = config["early_timetable_hour"]
 late_timetable_hour = config["late_timetable_hour"]
+headway_thresholds = config["headway_thresholds"]
+timetable_engine = config["timetable_engine"]
+duckdb_threads = config["duckdb_threads"]
+duckdb_memory_limit = config["duckdb_memory_limit"]
+if timetable_engine not in ("pandas", "duckdb"):
+    raise ValueError(f"""{timetable_engine} is not a valid timetable engine,
+                     should be either pandas or duckdb""")
+if timetable_engine == "duckdb" and day_filter_type != "general":
+    raise ValueError("""The duckdb timetable engine needs the general day
+                     filter""")
 required_files = ['stop_times', 'trips', 'calendar']
 auto_download_train = config["auto_download_train"]
 
@@ -87,54 +101,10 @@ if download_train_timetable and auto_download_train:
         di.download_shp_data(file)
 
 
-# Extract msn data
-msn_data = ttu.extract_msn_data(msn_file)
-
-# Create dataframe from msn data
-msn_df = pd.DataFrame(
-    msn_data, columns=['station_name', 'tiploc_code', 'crs_code'])
-
-# Clean msn data
-# --------------
-# Remove the duplicates in crs_code
-msn_df = msn_df.drop_duplicates(subset=['crs_code'])
-
-# Attach the coordinates for each train station
-station_locations = os.path.join(trn_data_output_dir, 'station_locations.csv')
-station_locations_df = pd.read_csv(
-    di.path_or_url(station_locations), usecols=[
-        'station_code', 'latitude', 'longitude'])
-
-# Join coordinates onto msn data
-# left join to master station names and see which ones dont have lat and long
-msn_data_df = pd.merge(msn_df, station_locations_df, how='left',
-                       left_on='crs_code', right_on='station_code')
-msn_data_df = msn_data_df[['station_name', 'tiploc_code',
-                           'crs_code', 'latitude', 'longitude']]
-
-# Remove stations with no coordinates
-msn_data_df = msn_data_df.dropna(subset=['latitude', 'longitude'], how='any')
-
-
-schedules, stops = ttu.extract_mca(mca_file)
-
-
-# Add data into dataframes
-mca_schedule_df = pd.DataFrame(schedules,
-                               columns=['schedule_id',
-                                        'start_date',
-                                        'end_date',
-                                        'monday',
-                                        'tuesday',
-                                        'wednesday',
-                                        'thursday',
-                                        'friday'])
-
-mca_stop_df = pd.DataFrame(stops,
-                           columns=['schedule_id',
-                                    'departure_time',
-                                    'tiploc_code',
-                                    'activity_type'])
+# Schedules and stops come back as dataframes, with the dates already
+# converted to datetime
+mca_schedule_df, mca_stop_df = ttu.extract_mca(mca_file,
+                                               n_workers=mca_workers)
 
 
 # Clean data
@@ -151,106 +121,167 @@ mca_schedule_df = mca_schedule_df.drop_duplicates(subset=['schedule_id'])
 mca_stop_df = mca_stop_df[mca_stop_df['activity_type'] == 'T']
 
 # Only keep records with departure time between highly serviced hours
-hour_range = range(early_timetable_hour, late_timetable_hour)
-valid_hours = [f'0{i}' if i < 10 else f'{i}' for i in hour_range]
-
+# Departure times are in seconds since midnight, times after midnight
+# are past 24:00 so are outside the window
 mca_stop_df = (
     mca_stop_df[
-        mca_stop_df['departure_time'].str.startswith(tuple(valid_hours))]
+        (mca_stop_df['departure_time'] >= early_timetable_hour * 3600)
+        & (mca_stop_df['departure_time'] < late_timetable_hour * 3600)]
 )
 
-# Convert start and end date to datetime format
-mca_schedule_df['start_date'] = (
-    pd.to_datetime(mca_schedule_df['start_date'], format='%y%m%d')
-)
-mca_schedule_df['end_date'] = (
-    pd.to_datetime(mca_schedule_df['end_date'], format='%y%m%d')
-)
-
-
 # Join dataframes
 # ---------------
 
-train_timetable_df = (
-    (mca_stop_df.merge(mca_schedule_df, on='schedule_id', how='left'))
-    .merge(msn_df, on='tiploc_code', how='left')
-)
+# The duckdb engine joins the schedules and stops in SQL
+if timetable_engine == "pandas":
+    train_timetable_df = (
+        mca_stop_df.merge(mca_schedule_df, on='schedule_id', how='left')
+    )
 
-# Remove columns no longer required
-train_timetable_df = train_timetable_df.drop(columns=['schedule_id',
-                                                      'activity_type',
-                                                      'station_name'])
+    # Remove columns no longer required
+    train_timetable_df = train_timetable_df.drop(columns=['activity_type'])
 
-# Extract stops for chosen day
-# ----------------------------
+# Find frequency of stops on each day
+# -----------------------------------
+
+timetable_vintage = os.path.splitext(config["train_mca_filename"])[0]
 
-# Only interested in stops on a certain day
 if day_filter_type == "general":
+    # Departures per station, day of the week and hour, counted in one
+    # pass from the days each schedule runs. Saved for this timetable so
+    # other service levels can be tested later
     timetable_day = timetable_day.lower()
-    serviced_train_stops_df = (
-        train_timetable_df[train_timetable_df[timetable_day] == 1]
+    if timetable_engine == "duckdb":
+        # The join and hour pivot run as SQL in DuckDB over the parsed
+        # schedules and stops
+        con = dc.create_connection(
+            os.path.join(trn_data_output_dir, 'duckdb_tmp'),
+            threads=duckdb_threads,
+            memory_limit=duckdb_memory_limit)
+        dc.load_cif_departures(con, mca_schedule_df, mca_stop_df)
+        stop_day_hour_counts = dc.stop_day_hour_counts(
+            con,
+            early_hour=early_timetable_hour,
+            late_hour=late_timetable_hour)
+
+        # Departures on the chosen day, for the headways
+        day_stop_ids, day_departure_secs = dc.day_departures(con,
+                                                             timetable_day)
+        con.close()
+    else:
+        stop_day_hour_counts = StopDayHourCounts.from_departures(
+            train_timetable_df['tiploc_code'],
+            train_timetable_df['departure_time'],
+            train_timetable_df[ttu.DAY_COLS].to_numpy(),
+            early_hour=early_timetable_hour,
+            late_hour=late_timetable_hour)
+
+        # Stops on the chosen day, for the headways
+        serviced_train_stops_df = (
+            train_timetable_df[train_timetable_df[timetable_day] == 1]
+        )
+        day_stop_ids = serviced_train_stops_df['tiploc_code']
+        day_departure_secs = serviced_train_stops_df['departure_time']
+    stop_day_hour_counts.save(StopDayHourCounts.path(trn_data_output_dir,
+                                                     timetable_vintage))
+    counts_day = timetable_day
+
+    # Only keep stations with at least 1 service per hour, for every day
+    # of the week
+    train_served_days_df = (
+        stop_day_hour_counts.served_by_day(min_per_hour=1)
+        .rename(columns={'stop_id': 'tiploc_code'})
     )
 elif day_filter_type == "exact":
-    timetable_day = timetable_day.capitalize()
+    # Use the date in config or pick a date for the day, then find the one
+    # schedule each train runs on that date once short term overlays and
+    # cancellations are applied
+    if exact_timetable_date is None:
+        timetable_day = timetable_day.capitalize()
+        timetable_date, _ = ttu.select_date_for_day(
+            mca_schedule_df['start_date'].min(),
+            mca_schedule_df['end_date'].max(),
+            timetable_day)
+    else:
+        timetable_date = pd.Timestamp(exact_timetable_date)
+    counts_day = str(timetable_date.date())
+    effective_schedule_df = (
+        STPResolver(mca_schedule_df).effective_on(timetable_date)
+    )
     serviced_train_stops_df = (
-        dt.filter_timetable_by_day(
-            train_timetable_df, timetable_day.capitalize())
+        train_timetable_df[train_timetable_df['schedule_id']
+                           .isin(effective_schedule_df['schedule_id'])]
     )
+    day_stop_ids = serviced_train_stops_df['tiploc_code']
+    day_departure_secs = serviced_train_stops_df['departure_time']
+
+    # Departures per station and hour, saved for this timetable and date
+    stop_hour_counts = StopHourCounts.from_departures(
+        serviced_train_stops_df['tiploc_code'],
+        serviced_train_stops_df['departure_time'],
+        early_hour=early_timetable_hour,
+        late_hour=late_timetable_hour)
+    stop_hour_counts.save(StopHourCounts.path(trn_data_output_dir,
+                                              timetable_vintage,
+                                              counts_day))
+
+    # Only keep stations with at least 1 service per hour
+    train_served_days_df = pd.DataFrame(
+        {'tiploc_code': stop_hour_counts.served_stops(min_per_hour=1),
+         'day': counts_day})
 else:
-    print("Error: input error on day filter setting.")
+    raise ValueError(f"""{day_filter_type} is not a valid day filter,
+                     should be either general or exact""")
 
 
-# Find frequency of stops
-# -----------------------
-
-# Just take HH from departure time
-serviced_train_stops_df['departure_time'] = (
-    serviced_train_stops_df['departure_time'].str.slice(0, 2)
-)
+# Find headways at the stations
+# -----------------------------
 
-train_frequencies_df = pd.pivot_table(data=serviced_train_stops_df,
-                                      values=timetable_day,
-                                      index='tiploc_code',
-                                      columns='departure_time',
-                                      aggfunc=len,
-                                      fill_value=0)
+# Gaps between departures at each station on the chosen day
+train_headways_df = headway_stats(day_stop_ids,
+                                  day_departure_secs,
+                                  early_hour=early_timetable_hour,
+                                  late_hour=late_timetable_hour,
+                                  thresholds=headway_thresholds)
+train_headways_df = train_headways_df.rename(
+    columns={'stop_id': 'tiploc_code'})
+train_headways_df.to_csv(
+    os.path.join(trn_data_output_dir,
+                 f'train_stop_headways_{counts_day.lower()}.csv'),
+    index=False)
 
 
 # Extract highly serviced stops
 # -----------------------------
 
-# Only keep stations with at least 1 service per hour
-highly_serviced_train_stops_df = (
-    train_frequencies_df[(train_frequencies_df > 0).all(axis=1)]
-)
-
-# Get the naptan data and limit to only the columns we need
-naptan_df = di.get_stops_file(url=config["naptan_api"],
-                              dir=os.path.join("data",
-                                               "stops"))
-# Create Tiploc column
-naptan_df = dt.create_tiploc_col(naptan_df)
-
-stations_df = naptan_df[naptan_df['StopType'] == 'RLY']
-station_locations_df = stations_df[['Easting', 'Northing', 'tiploc_code']]
-
+# Get the latest naptan data, then the index of the stations in it by
+# tiploc, with their CRS codes from the msn file. The index is only
+# rebuilt when either file changes
+naptan_file = di.update_stops_file(url=config["naptan_api"],
+                                   dir=os.path.join("data",
+                                                    "stops"))
+station_index = StationIndex(naptan_file, msn_file)
 
 # Add easting and northing
-highly_serviced_train_stops_df = (
-    highly_serviced_train_stops_df.merge(station_locations_df,
-                                         how='inner',
-                                         on='tiploc_code')
-)
+train_served_days_df = station_index.add_locations(train_served_days_df)
 
 # Remove stations with no coordinates
-highly_serviced_train_stops_df = (
-    highly_serviced_train_stops_df.dropna(subset=['Easting', 'Northing'],
-                                          how='any')
+train_served_days_df = (
+    train_served_days_df.dropna(subset=['Easting', 'Northing'], how='any')
+    .reset_index(drop=True)
 )
+train_served_days_df.to_feather(
+    os.path.join(trn_data_output_dir,
+                 'train_highly_serviced_stops_by_day.feather'))
+train_served_days_df.to_csv(
+    os.path.join(trn_data_output_dir,
+                 'train_highly_serviced_stops_by_day.csv'), index=False)
 
-# Keep only required columns in highly_serviced_train_stops_df
+# Stations for the chosen day
 highly_serviced_train_stops_df = (
-    highly_serviced_train_stops_df.drop(columns=valid_hours)
+    train_served_days_df[train_served_days_df['day'] == counts_day]
+    .drop(columns=['day'])
+    .reset_index(drop=True)
 )
 
 # Save a copy to be ingested into SDG_main
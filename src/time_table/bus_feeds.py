@@ -0,0 +1,219 @@
+"""Loads GTFS bus timetable feeds, nationally or one region at a time.
+
+`load_departures` reads a feed and links each stop to the service that
+runs it. `regional_snapshot` loads the regional feeds in separate
+processes. Each process only returns its compact `TripSnapshot`, so no
+process holds the national stop times, and the snapshots are joined so
+that trips in more than one regional feed are counted once.
+"""
+# Core imports
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+# Third party imports
+import numpy as np
+import pandas as pd
+
+# Module imports
+import time_table_utils as ttu
+from service_calendar import ServiceCalendar
+from trip_snapshot import TripSnapshot
+
+# Create logger
+logger = logging.getLogger(__name__)
+
+
+def read_calendars(gtfs_path: str):
+    """Reads the GTFS calendar and, if the feed has one, calendar_dates.
+
+    Args:
+        gtfs_path (str): path to the GTFS zip, or to a folder of the
+            extracted files.
+
+    Returns:
+        Tuple[pd.DataFrame, pd.DataFrame]: calendar, with the dates as
+            datetimes, and calendar_dates, or None when there is none.
+    """
+    # All seven days are needed to build the date bitsets of each service
+    calendar_types = {
+        'service_id': 'category',
+        **{day: 'int64' for day in ttu.DAY_COLS},
+        'start_date': 'object',
+        'end_date': 'object'}
+    calendar_df = ttu.read_gtfs_table(gtfs_path, 'calendar', calendar_types)
+    calendar_df['start_date'] = pd.to_datetime(
+        calendar_df['start_date'], format='%Y%m%d')
+    calendar_df['end_date'] = pd.to_datetime(
+        calendar_df['end_date'], format='%Y%m%d')
+
+    # Optional in GTFS. Adds (exception_type 1) or removes (2) single dates
+    calendar_dates_types = {
+        'service_id': 'category',
+        'date': 'object',
+        'exception_type': 'int64'}
+    try:
+        calendar_dates_df = ttu.read_gtfs_table(gtfs_path,
+                                                'calendar_dates',
+                                                calendar_dates_types)
+    except (KeyError, FileNotFoundError):
+        logger.info(f"No calendar_dates in {gtfs_path}")
+        return calendar_df, None
+
+    calendar_dates_df['date'] = pd.to_datetime(
+        calendar_dates_df['date'], format='%Y%m%d')
+    return calendar_df, calendar_dates_df
+
+
+def load_departures(gtfs_path: str,
+                    early_hour: int,
+                    late_hour: int,
+                    collapse_duplicates: bool = True,
+                    gtfs_cache=None,
+                    agencies: list = None):
+    """Loads the departures in an hour window and links them to services.
+
+    Frequency based trips are expanded into a departure per journey, and
+    duplicate trips are dropped if asked. Duplicates are matched on the
+    days of the week their services run, not their dates, so for counts
+    on a single date they should be collapsed after the date filter, see
+    `ttu.duplicate_trip_rows`.
+
+    Args:
+        gtfs_path (str): path to the GTFS zip, or to a folder of the
+            extracted files.
+        early_hour (int): first hour of the window.
+        late_hour (int): hour the window ends, not included.
+        collapse_duplicates (bool, optional): count trips with the same
+            stops, times and days once. Defaults to True.
+        gtfs_cache (GTFSParquetCache, optional): cache to read the stop
+            times and trips through. Defaults to reading the GTFS files.
+        agencies (list, optional): agency_ids to read, needs `gtfs_cache`.
+
+    Returns:
+        Tuple: the stop times from `ttu.read_stop_times`, the row in the
+            service calendar of each stop's service, the `ServiceCalendar`
+            and the calendar dataframe.
+    """
+    # Trips in frequencies.txt are templates run every headway_secs, so
+    # all of their stops are kept to expand into a departure per journey
+    frequencies_df = ttu.read_frequencies(gtfs_path)
+    frequency_trip_ids = (frequencies_df['trip_id'].unique()
+                          if frequencies_df is not None else None)
+
+    trips_types = {'service_id': 'category', 'trip_id': 'category'}
+    if gtfs_cache is not None:
+        stop_times_df = gtfs_cache.read_stop_times(
+            early_hour=early_hour,
+            late_hour=late_hour,
+            agencies=agencies,
+            keep_trip_ids=frequency_trip_ids)
+        trips_df = gtfs_cache.read_trips(agencies)[list(trips_types)]
+    else:
+        with ttu.open_gtfs_file(gtfs_path, 'stop_times') as stop_times_file:
+            stop_times_df = ttu.read_stop_times(
+                stop_times_file,
+                early_hour=early_hour,
+                late_hour=late_hour,
+                keep_trip_ids=frequency_trip_ids)
+        trips_df = ttu.read_gtfs_table(gtfs_path, 'trips', trips_types)
+
+    if frequencies_df is not None:
+        stop_times_df = ttu.expand_frequencies(stop_times_df,
+                                               frequencies_df,
+                                               early_hour=early_hour,
+                                               late_hour=late_hour)
+
+    # Each service's running dates as a bitset, with the calendar_dates
+    # exceptions applied
+    calendar_df, calendar_dates_df = read_calendars(gtfs_path)
+    service_calendar = ServiceCalendar.from_gtfs(calendar_df,
+                                                 calendar_dates_df)
+
+    # The service running each stop, found with integer lookups rather than
+    # merging stop_times, trips and calendar
+    service_rows = ttu.trip_service_rows(stop_times_df['trip_id'],
+                                         trips_df,
+                                         service_calendar.service_ids)
+
+    # The same journey can be published more than once, e.g. by several
+    # operators
+    if collapse_duplicates:
+        service_days = np.append(ttu.day_bits(service_calendar.day_flags), 0)
+        duplicate_rows = ttu.duplicate_trip_rows(
+            stop_times_df['trip_id'],
+            stop_times_df['stop_id'],
+            stop_times_df['departure_time'],
+            service_days[service_rows])
+        logger.info(f"Collapsed "
+                    f"{stop_times_df['trip_id'][duplicate_rows].nunique()} "
+                    f"duplicate trips in {gtfs_path}")
+        stop_times_df = stop_times_df[~duplicate_rows]
+        service_rows = service_rows[~duplicate_rows]
+
+    return stop_times_df, service_rows, service_calendar, calendar_df
+
+
+def region_snapshot(gtfs_path: str,
+                    vintage: str,
+                    early_hour: int,
+                    late_hour: int,
+                    collapse_duplicates: bool = True) -> TripSnapshot:
+    """Loads one regional feed and hashes its trips.
+
+    Args:
+        gtfs_path (str): path to the region's GTFS zip.
+        vintage (str): identifies the timetable.
+        early_hour (int): first hour of the window.
+        late_hour (int): hour the window ends, not included.
+        collapse_duplicates (bool, optional): count trips with the same
+            stops, times and days once. Defaults to True.
+
+    Returns:
+        TripSnapshot: the region's trips.
+    """
+    logger.info(f"Loading {gtfs_path}")
+    stop_times_df, service_rows, service_calendar, _ = load_departures(
+        gtfs_path, early_hour, late_hour, collapse_duplicates)
+    return TripSnapshot.from_departures(vintage,
+                                        stop_times_df['trip_id'],
+                                        stop_times_df['stop_id'],
+                                        stop_times_df['departure_time'],
+                                        service_rows,
+                                        service_calendar.day_flags,
+                                        early_hour,
+                                        late_hour)
+
+
+def regional_snapshot(gtfs_paths: list,
+                      vintage: str,
+                      early_hour: int,
+                      late_hour: int,
+                      collapse_duplicates: bool = True,
+                      n_workers: int = 1) -> TripSnapshot:
+    """Loads regional feeds in parallel and joins their trips.
+
+    Args:
+        gtfs_paths (list): paths to the regions' GTFS zips.
+        vintage (str): identifies the timetable.
+        early_hour (int): first hour of the window.
+        late_hour (int): hour the window ends, not included.
+        collapse_duplicates (bool, optional): count trips with the same
+            stops, times and days once. Defaults to True.
+        n_workers (int, optional): number of processes. Defaults to 1,
+            which loads the regions one after another in this process.
+
+    Returns:
+        TripSnapshot: the trips of every region, with trips that are in
+            more than one regional feed kept once.
+    """
+    n_regions = len(gtfs_paths)
+    args = ([vintage] * n_regions, [early_hour] * n_regions,
+            [late_hour] * n_regions, [collapse_duplicates] * n_regions)
+    if n_workers > 1 and n_regions > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            snapshots = list(executor.map(region_snapshot, gtfs_paths,
+                                          *args))
+    else:
+        snapshots = list(map(region_snapshot, gtfs_paths, *args))
+
+    return TripSnapshot.concat(snapshots, vintage)
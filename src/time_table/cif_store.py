@@ -0,0 +1,199 @@
+"""Indexed access to individual schedules in the CIF mca file.
+
+Parsing the whole mca file to look at one train, or at the trains calling
+at one station, is slow. `CIFScheduleStore` makes one pass over the file
+to build a small index of where each schedule starts and ends, and which
+tiplocs each schedule calls at. The index is saved next to the mca file
+and reused until the mca file changes. Schedules are then decoded on
+demand from a memory map of the file.
+"""
+# Core imports
+import os
+import logging
+
+# Third party imports
+import numpy as np
+
+# Module imports
+import time_table_utils as ttu
+
+# Create logger
+logger = logging.getLogger(__name__)
+
+
+class CIFScheduleStore:
+    """Looks up schedules in an mca file by train UID or tiploc.
+
+    Only new and revised schedules (BSN and BSR records) are indexed, as
+    in `ttu.extract_mca`.
+
+    Args:
+        mca_file (str): path to the mca file.
+        index_file (str, optional): path of the index. Defaults to the mca
+            file path with "_index.npz" in place of the extension.
+    """
+
+    def __init__(self, mca_file: str, index_file: str = None):
+        self.mca_file = mca_file
+        if index_file is None:
+            index_file = os.path.splitext(mca_file)[0] + "_index.npz"
+        self.index_file = index_file
+        self._buf = None
+
+        if not self._index_is_current():
+            self.build_index()
+        self._load_index()
+
+    @property
+    def buf(self) -> np.ndarray:
+        """The mca file as a memory mapped uint8 array."""
+        if self._buf is None:
+            self._buf = np.asarray(
+                np.memmap(self.mca_file, dtype=np.uint8, mode="r"))
+        return self._buf
+
+    def _file_stamp(self) -> np.ndarray:
+        """Size and modified time of the mca file, to spot changes."""
+        stat = os.stat(self.mca_file)
+        return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+    def _index_is_current(self) -> bool:
+        """Checks the index exists and was built from the current file."""
+        if not os.path.exists(self.index_file):
+            return False
+        with np.load(self.index_file) as index:
+            return np.array_equal(index["file_stamp"], self._file_stamp())
+
+    def build_index(self):
+        """Makes one pass over the mca file and saves the index.
+
+        The index holds, sorted by train UID, the byte range and schedule
+        id of every schedule. It also holds (tiploc, schedule) pairs sorted
+        by tiploc for every location record in those byte ranges.
+        """
+        logger.info(f"Building schedule index for {self.mca_file}")
+        buf = self.buf
+        # Skip the header
+        starts = ttu.line_starts(buf)[1:]
+        rec_type = ttu.field_bytes(buf, starts, 0, 2)
+
+        # Each schedule runs from its BS record to the next BS record
+        bs_lines = np.flatnonzero(rec_type == b"BS")
+        bs_starts = starts[bs_lines]
+        bs_ends = np.append(bs_starts[1:], len(buf))
+        bs_kept = np.isin(ttu.field_bytes(buf, bs_starts, 2, 1), [b"N", b"R"])
+
+        # Schedule of each location record
+        loc_lines = np.flatnonzero(np.isin(rec_type, [b"LO", b"LI", b"LT"]))
+        bs_pos = np.searchsorted(bs_lines, loc_lines, side="right") - 1
+        has_bs = bs_pos >= 0
+        loc_lines, bs_pos = loc_lines[has_bs], bs_pos[has_bs]
+        loc_kept = bs_kept[bs_pos]
+        loc_lines, bs_pos = loc_lines[loc_kept], bs_pos[loc_kept]
+
+        # Number the kept schedules in UID order, keeping file order
+        # within a UID
+        uids = ttu.field_bytes(buf, bs_starts, 3, 6)
+        kept = np.flatnonzero(bs_kept)
+        order = kept[np.argsort(uids[kept], kind="stable")]
+        sched_num = np.full(len(bs_lines), -1)
+        sched_num[order] = np.arange(len(order))
+
+        tiplocs = np.char.strip(ttu.field_bytes(buf, starts[loc_lines], 2, 8))
+        # One pair per schedule calling at the tiploc
+        pairs = np.unique(np.rec.fromarrays([tiplocs, sched_num[bs_pos]],
+                                            names="tiploc,schedule"))
+        schedule_ids = ttu.schedule_id_bytes(buf, bs_starts[order])
+
+        np.savez_compressed(self.index_file,
+                            file_stamp=self._file_stamp(),
+                            uid=uids[order],
+                            start=bs_starts[order],
+                            end=bs_ends[order],
+                            schedule_id=np.char.strip(schedule_ids),
+                            tiploc=pairs["tiploc"],
+                            tiploc_schedule=pairs["schedule"])
+
+    def _load_index(self):
+        """Loads the index arrays into memory."""
+        with np.load(self.index_file) as index:
+            self._uid = index["uid"]
+            self._start = index["start"]
+            self._end = index["end"]
+            self._schedule_id = index["schedule_id"]
+            self._tiploc = index["tiploc"]
+            self._tiploc_schedule = index["tiploc_schedule"]
+
+    @property
+    def uids(self) -> np.ndarray:
+        """The unique train UIDs in the mca file."""
+        return np.char.decode(np.unique(self._uid), "ascii")
+
+    def _decode(self, schedule_nums: np.ndarray):
+        """Decodes schedules from the memory mapped file.
+
+        Args:
+            schedule_nums (np.ndarray): positions of the schedules in the
+                index.
+
+        Returns:
+            Tuple[pd.DataFrame, pd.DataFrame]: schedules and stops, as
+                returned by `ttu.extract_mca`.
+        """
+        # Decode in file order
+        starts = np.sort(self._start[schedule_nums])
+        ends = np.sort(self._end[schedule_nums])
+        line_starts = [ttu.line_starts(self.buf[start:end]) + start
+                       for start, end in zip(starts, ends)]
+        if not line_starts:
+            line_starts = [np.array([], dtype=np.int64)]
+        return ttu.parse_mca_lines(self.buf, np.concatenate(line_starts))
+
+    def get_train(self, uid: str):
+        """Gets every schedule for a train.
+
+        Args:
+            uid (str): the train UID, e.g. "C12345".
+
+        Returns:
+            Tuple[pd.DataFrame, pd.DataFrame]: schedules and stops, as
+                returned by `ttu.extract_mca`.
+        """
+        key = uid.encode("ascii")
+        first = np.searchsorted(self._uid, key, side="left")
+        last = np.searchsorted(self._uid, key, side="right")
+        return self._decode(np.arange(first, last))
+
+    def schedules_at(self, tiploc: str):
+        """Gets every schedule with a location record at a tiploc.
+
+        Args:
+            tiploc (str): the tiploc code, e.g. "EUSTON".
+
+        Returns:
+            Tuple[pd.DataFrame, pd.DataFrame]: schedules and stops, as
+                returned by `ttu.extract_mca`. The stops are for the whole
+                journey, not just the given tiploc.
+        """
+        key = tiploc.encode("ascii")
+        first = np.searchsorted(self._tiploc, key, side="left")
+        last = np.searchsorted(self._tiploc, key, side="right")
+        return self._decode(self._tiploc_schedule[first:last])
+
+    def schedule_ids_at(self, tiploc: str) -> np.ndarray:
+        """Gets the ids of the schedules with a location record at a tiploc.
+
+        Only the index is read, not the mca file.
+
+        Args:
+            tiploc (str): the tiploc code.
+
+        Returns:
+            np.ndarray: schedule ids, in the same form as the schedule_id
+                column of `ttu.extract_mca`, ordered by train UID.
+        """
+        key = tiploc.encode("ascii")
+        first = np.searchsorted(self._tiploc, key, side="left")
+        last = np.searchsorted(self._tiploc, key, side="right")
+        schedule_nums = np.sort(self._tiploc_schedule[first:last])
+        return np.char.decode(self._schedule_id[schedule_nums], "ascii")
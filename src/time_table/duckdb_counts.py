@@ -0,0 +1,364 @@
+"""Counts departures per stop, day of the week and hour with DuckDB.
+
+An alternative engine to the pandas one for the general day filter. The
+GTFS text files, or the parsed CIF columns, are registered with an
+embedded DuckDB connection, and the filters, joins and the hour pivot run
+as SQL. DuckDB runs the queries on several threads and spills to disk
+rather than running out of memory, so the national bus timetable is never
+held in a pandas dataframe.
+
+Both timetables are loaded into one `departures` table: the stop, trip and
+departure time of every departure, and the days of the week its trip runs
+as bits from `ttu.DAY_BITS`. The counts and the departures on a day are
+then queried from it, in the same form the pandas engine gives.
+"""
+# Core imports
+import os
+import zipfile
+import logging
+from contextlib import contextmanager
+
+# Third party imports
+import duckdb
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+from duckdb import DuckDBPyConnection
+from scipy import sparse
+
+# Module imports
+import time_table_utils as ttu
+from stop_hour_counts import HOURS_PER_DAY, StopDayHourCounts
+
+# Create logger
+logger = logging.getLogger(__name__)
+
+# Seconds since midnight of a GTFS H:MM:SS time, NULL when it is missing
+# or in another format, as in `ttu.gtfs_times_to_seconds`
+GTFS_TIME_PATTERN = r"^\s*(\d{1,2}):(\d{2}):(\d{2})\s*$"
+GTFS_SECS_MACRO = f"""
+CREATE OR REPLACE TEMP MACRO gtfs_secs(t) AS
+    TRY_CAST(regexp_extract(t, '{GTFS_TIME_PATTERN}', 1) AS INTEGER) * 3600
+    + TRY_CAST(regexp_extract(t, '{GTFS_TIME_PATTERN}', 2) AS INTEGER) * 60
+    + TRY_CAST(regexp_extract(t, '{GTFS_TIME_PATTERN}', 3) AS INTEGER)
+"""
+
+# Days of the week packed into bits, as in `ttu.day_bits`
+DAYS_SQL = " + ".join(
+    f"(CASE WHEN TRY_CAST({day} AS INTEGER) = 1 THEN {bit} ELSE 0 END)"
+    for day, bit in zip(ttu.DAY_COLS, ttu.DAY_BITS))
+
+
+def create_connection(temp_dir: str,
+                      threads: int = None,
+                      memory_limit: str = None) -> DuckDBPyConnection:
+    """Creates an in-memory DuckDB connection that spills to disk.
+
+    Args:
+        temp_dir (str): folder for the data spilled to disk.
+        threads (int, optional): number of threads. Defaults to DuckDB's
+            default, the number of cores.
+        memory_limit (str, optional): memory DuckDB can use before
+            spilling, e.g. "4GB". Defaults to DuckDB's default.
+
+    Returns:
+        DuckDBPyConnection: the connection.
+    """
+    os.makedirs(temp_dir, exist_ok=True)
+    con = duckdb.connect(":memory:")
+    con.execute(f"SET temp_directory = '{temp_dir}'")
+    # Row order is not needed, and keeping it stops large results spilling
+    con.execute("SET preserve_insertion_order = false")
+    if threads is not None:
+        con.execute(f"SET threads = {int(threads)}")
+    if memory_limit is not None:
+        con.execute(f"SET memory_limit = '{memory_limit}'")
+    return con
+
+
+@contextmanager
+def gtfs_relation(con: DuckDBPyConnection,
+                  gtfs_path: str,
+                  file_nm: str,
+                  columns: list):
+    """Registers a GTFS text file with DuckDB, with every column as text.
+
+    A folder's text files are read by DuckDB's own csv reader, in
+    parallel. DuckDB can not read inside a zip, so a file in the GTFS zip
+    is streamed through Arrow in record batches, and can only be scanned
+    once.
+
+    Args:
+        con (DuckDBPyConnection): the connection.
+        gtfs_path (str): path to the GTFS zip, or to a folder of the
+            extracted files.
+        file_nm (str): name of the file without the extension,
+            e.g. "stop_times".
+        columns (list): columns to read.
+
+    Yields:
+        str: SQL to select from in a query, e.g. in a FROM clause.
+    """
+    if zipfile.is_zipfile(gtfs_path):
+        with ttu.open_gtfs_file(gtfs_path, file_nm) as stream:
+            reader = pa_csv.open_csv(
+                stream,
+                read_options=pa_csv.ReadOptions(
+                    block_size=ttu.CSV_BLOCK_SIZE),
+                convert_options=pa_csv.ConvertOptions(
+                    include_columns=columns,
+                    column_types={col: pa.string() for col in columns},
+                    strings_can_be_null=True))
+            view_nm = f"gtfs_{file_nm}_stream"
+            con.register(view_nm, reader)
+            try:
+                yield view_nm
+            finally:
+                con.unregister(view_nm)
+    else:
+        txt_path = os.path.join(gtfs_path, f"{file_nm}.txt")
+        if not os.path.exists(txt_path):
+            raise FileNotFoundError(f"{txt_path} does not exist")
+        txt_path = txt_path.replace("'", "''")
+        yield f"""(SELECT {', '.join(columns)}
+                  FROM read_csv('{txt_path}', header = true,
+                                all_varchar = true))"""
+
+
+def load_gtfs_departures(con: DuckDBPyConnection,
+                         gtfs_path: str,
+                         early_hour: int,
+                         late_hour: int,
+                         collapse_duplicates: bool = True):
+    """Loads the GTFS departures in an hour window into `departures`.
+
+    Follows `bus_feeds.load_departures`: stops with a missing departure
+    time, or a trip or service that is not in trips or calendar, are left
+    out, frequency based trips are expanded into a departure per journey,
+    and trips with the same stops, departure times and days are counted
+    once if asked.
+
+    Args:
+        con (DuckDBPyConnection): the connection.
+        gtfs_path (str): path to the GTFS zip, or to a folder of the
+            extracted files.
+        early_hour (int): first hour of the window.
+        late_hour (int): hour the window ends, not included.
+        collapse_duplicates (bool, optional): count trips with the same
+            stops, times and days once. Defaults to True.
+    """
+    con.execute(GTFS_SECS_MACRO)
+    window_start, window_end = early_hour * 3600, late_hour * 3600
+
+    # Days each trip runs, from its service. GTFS ids should be unique,
+    # one row is kept for any that are not
+    with gtfs_relation(con, gtfs_path, "calendar",
+                       ["service_id", *ttu.DAY_COLS]) as calendar:
+        con.execute(f"""
+            CREATE OR REPLACE TEMP TABLE service_days AS
+            SELECT service_id, CAST({DAYS_SQL} AS UTINYINT) AS days
+            FROM {calendar}
+            QUALIFY row_number() OVER (PARTITION BY service_id) = 1""")
+    with gtfs_relation(con, gtfs_path, "trips",
+                       ["trip_id", "service_id"]) as trips:
+        con.execute(f"""
+            CREATE OR REPLACE TEMP TABLE trip_days AS
+            SELECT trip_id, days
+            FROM (SELECT trip_id, service_id
+                  FROM {trips}
+                  QUALIFY row_number() OVER (PARTITION BY trip_id) = 1)
+            JOIN service_days USING (service_id)""")
+
+    # Frequency windows, without those with missing or invalid values
+    try:
+        with gtfs_relation(con, gtfs_path, "frequencies",
+                           ["trip_id", "start_time", "end_time",
+                            "headway_secs"]) as frequencies:
+            con.execute(f"""
+                CREATE OR REPLACE TEMP TABLE frequencies AS
+                SELECT * FROM (
+                    SELECT trip_id,
+                           gtfs_secs(start_time) AS start_secs,
+                           gtfs_secs(end_time) AS end_secs,
+                           CAST(trunc(TRY_CAST(headway_secs AS DOUBLE))
+                                AS BIGINT) AS headway_secs
+                    FROM {frequencies})
+                WHERE trip_id IS NOT NULL
+                  AND headway_secs > 0
+                  AND end_secs > start_secs""")
+    except (KeyError, FileNotFoundError):
+        con.execute("""
+            CREATE OR REPLACE TEMP TABLE frequencies (
+                trip_id VARCHAR, start_secs INTEGER, end_secs INTEGER,
+                headway_secs BIGINT)""")
+
+    # Stops in the window, and every stop of the frequency based trips,
+    # whose times are a template relative to the trip's first departure
+    with gtfs_relation(con, gtfs_path, "stop_times",
+                       ["trip_id", "stop_id", "departure_time"]) as stops:
+        con.execute(f"""
+            CREATE OR REPLACE TEMP TABLE stop_times AS
+            SELECT * FROM (
+                SELECT trip_id, stop_id,
+                       gtfs_secs(departure_time) AS departure_secs
+                FROM {stops})
+            WHERE (departure_secs >= {window_start}
+                   AND departure_secs < {window_end})
+               OR (departure_secs IS NOT NULL
+                   AND trip_id IN (SELECT trip_id FROM frequencies))""")
+
+    # Every stop of every journey of the frequency based trips. Journeys
+    # run from start_time every headway_secs until end_time, not included,
+    # and keep the template's trip_id
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE departures AS
+        WITH templates AS (
+            SELECT trip_id, stop_id,
+                   departure_secs - min(departure_secs)
+                       OVER (PARTITION BY trip_id) AS offset_secs
+            FROM stop_times
+            WHERE trip_id IN (SELECT trip_id FROM frequencies)),
+        journeys AS (
+            SELECT trip_id,
+                   unnest(range(start_secs, end_secs, headway_secs))
+                       AS journey_secs
+            FROM frequencies),
+        all_stops AS (
+            SELECT trip_id, stop_id, departure_secs
+            FROM stop_times
+            WHERE trip_id NOT IN (SELECT trip_id FROM frequencies)
+            UNION ALL
+            SELECT trip_id, stop_id,
+                   CAST(journey_secs + offset_secs AS INTEGER)
+            FROM templates
+            JOIN journeys USING (trip_id))
+        SELECT trip_id, stop_id, departure_secs, days
+        FROM all_stops
+        JOIN trip_days USING (trip_id)
+        WHERE stop_id IS NOT NULL
+          AND departure_secs >= {window_start}
+          AND departure_secs < {window_end}""")
+
+    # The same journey can be published more than once, e.g. by several
+    # operators. Trips are matched on the sum of their departures' hashes,
+    # so the order of the stops does not matter, and their days
+    if collapse_duplicates:
+        con.execute("""
+            DELETE FROM departures
+            WHERE trip_id IN (
+                SELECT trip_id
+                FROM (SELECT trip_id,
+                             sum(hash(stop_id, departure_secs)) AS content,
+                             any_value(days) AS days
+                      FROM departures
+                      GROUP BY trip_id)
+                QUALIFY row_number() OVER (PARTITION BY content, days
+                                           ORDER BY trip_id) > 1)""")
+
+    con.execute("DROP TABLE stop_times")
+    n_departures = con.execute(
+        "SELECT count(*) FROM departures").fetchone()[0]
+    logger.info(f"Loaded {n_departures} departures from {gtfs_path}")
+
+
+def load_cif_departures(con: DuckDBPyConnection,
+                        schedules_df: pd.DataFrame,
+                        stops_df: pd.DataFrame):
+    """Loads the CIF departures into `departures`.
+
+    The dataframes are scanned by DuckDB where they are, without copying.
+    Stops whose schedule is not in `schedules_df` are left out.
+
+    Args:
+        con (DuckDBPyConnection): the connection.
+        schedules_df (pd.DataFrame): schedules from `ttu.extract_mca`, one
+            row per schedule_id.
+        stops_df (pd.DataFrame): stops from `ttu.extract_mca`, already
+            filtered to the stops used.
+    """
+    con.register("cif_schedules", schedules_df[["schedule_id",
+                                                *ttu.DAY_COLS]])
+    con.register("cif_stops", stops_df[["schedule_id",
+                                        "tiploc_code",
+                                        "departure_time"]])
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE departures AS
+        SELECT CAST(cif_stops.schedule_id AS VARCHAR) AS trip_id,
+               CAST(tiploc_code AS VARCHAR) AS stop_id,
+               CAST(departure_time AS INTEGER) AS departure_secs,
+               schedule_days.days
+        FROM cif_stops
+        JOIN (SELECT CAST(schedule_id AS VARCHAR) AS schedule_id,
+                     CAST({DAYS_SQL} AS UTINYINT) AS days
+              FROM cif_schedules) AS schedule_days
+          ON CAST(cif_stops.schedule_id AS VARCHAR)
+             = schedule_days.schedule_id""")
+    con.unregister("cif_schedules")
+    con.unregister("cif_stops")
+
+
+def stop_day_hour_counts(con: DuckDBPyConnection,
+                         early_hour: int,
+                         late_hour: int) -> StopDayHourCounts:
+    """Counts the loaded departures per stop, day of the week and hour.
+
+    Args:
+        con (DuckDBPyConnection): connection with `departures` loaded.
+        early_hour (int): first hour of the window counted.
+        late_hour (int): hour the window ends, not included.
+
+    Returns:
+        StopDayHourCounts: the counts, as `StopDayHourCounts.from_departures`
+            gives them.
+    """
+    day_counts = ", ".join(
+        f"count(*) FILTER (WHERE days & {bit} > 0) AS {day}"
+        for day, bit in zip(ttu.DAY_COLS, ttu.DAY_BITS))
+    result = con.execute(f"""
+        SELECT stop_id,
+               CAST(departure_secs // 3600 AS INTEGER) AS departure_hour,
+               {day_counts}
+        FROM departures
+        WHERE departure_secs >= {early_hour * 3600}
+          AND departure_secs < {late_hour * 3600}
+        GROUP BY ALL""").fetchnumpy()
+
+    stop_codes, stop_uniques = pd.factorize(result["stop_id"])
+    hours = result["departure_hour"]
+    by_day = np.column_stack([result[day] for day in ttu.DAY_COLS])
+
+    # One row per stop with each day's hours side by side
+    counts = sparse.csr_matrix(
+        (by_day.ravel(),
+         (np.repeat(stop_codes, len(ttu.DAY_COLS)),
+          (np.arange(len(ttu.DAY_COLS)) * HOURS_PER_DAY
+           + hours[:, None]).ravel())),
+        shape=(len(stop_uniques), len(ttu.DAY_COLS) * HOURS_PER_DAY))
+    counts.eliminate_zeros()
+    return StopDayHourCounts(counts, np.asarray(stop_uniques),
+                             early_hour, late_hour)
+
+
+def day_departures(con: DuckDBPyConnection, day: str):
+    """Gets the loaded departures of the trips that run on a day of the
+    week.
+
+    Args:
+        con (DuckDBPyConnection): connection with `departures` loaded.
+        day (str): day of the week, e.g. "wednesday".
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: stop id and departure time in
+            seconds since midnight of each departure.
+    """
+    day = day.lower()
+    if day not in ttu.DAY_COLS:
+        raise ValueError(f"""{day} is not a valid day,
+                         should be one of {ttu.DAY_COLS}""")
+    day_bit = ttu.DAY_BITS[ttu.DAY_COLS.index(day)]
+    result = con.execute(f"""
+        SELECT stop_id, departure_secs
+        FROM departures
+        WHERE days & {day_bit} > 0""").fetchnumpy()
+    return result["stop_id"], result["departure_secs"]
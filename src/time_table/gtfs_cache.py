@@ -0,0 +1,277 @@
+"""Parquet cache of the GTFS stop times and trips, partitioned by agency.
+
+Parsing stop_times.txt is the slowest part of the bus pipeline, and it is
+repeated on every run even when the timetable has not changed.
+`GTFSParquetCache` converts the stop times and trips once into Parquet
+datasets partitioned by agency. Trips and stops are stored as integer
+codes, with the ids they stand for kept alongside, and departure times as
+seconds since midnight. Reruns, and runs for a few agencies, read only the
+partitions and row groups they need with filters pushed down to Parquet.
+
+The cache is rebuilt when the GTFS zip, or the extracted stop_times.txt,
+it was made from changes.
+"""
+# Core imports
+import os
+import shutil
+import logging
+
+# Third party imports
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.csv as pa_csv
+
+# Module imports
+import time_table_utils as ttu
+
+# Create logger
+logger = logging.getLogger(__name__)
+
+# Agency of trips whose route or agency is not in routes.txt
+UNKNOWN_AGENCY = "unknown"
+
+STOP_TIMES_SCHEMA = pa.schema([("trip_code", pa.int32()),
+                               ("stop_code", pa.int32()),
+                               ("departure_time", pa.int32()),
+                               ("agency_id", pa.string())])
+TRIPS_SCHEMA = pa.schema([("trip_code", pa.int32()),
+                          ("service_id", pa.string()),
+                          ("agency_id", pa.string())])
+AGENCY_PARTITIONING = ds.partitioning(
+    pa.schema([("agency_id", pa.string())]), flavor="hive")
+
+# Rows buffered for each agency before a row group is written, so the
+# batches of the stop times don't leave many small row groups
+MIN_ROWS_PER_GROUP = 1 << 16
+
+
+class GTFSParquetCache:
+    """Reads the stop times and trips of a GTFS timetable through a
+    Parquet cache.
+
+    Args:
+        gtfs_path (str): path to the GTFS zip, or to a folder of the
+            extracted files.
+        cache_dir (str): folder for the cache.
+    """
+
+    def __init__(self, gtfs_path: str, cache_dir: str):
+        self.gtfs_path = gtfs_path
+        self.cache_dir = cache_dir
+        self.stop_times_dir = os.path.join(cache_dir, "stop_times")
+        self.trips_dir = os.path.join(cache_dir, "trips")
+        self.codes_file = os.path.join(cache_dir, "codes.npz")
+
+        if not self._cache_is_current():
+            self.build()
+        self._load_codes()
+
+    def _file_stamp(self) -> np.ndarray:
+        """Size and modified time of the GTFS zip, or of stop_times.txt in
+        a folder, to spot changes."""
+        path = self.gtfs_path
+        if os.path.isdir(path):
+            path = os.path.join(path, "stop_times.txt")
+        stat = os.stat(path)
+        return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+    def _cache_is_current(self) -> bool:
+        """Checks the cache exists and was built from the current file."""
+        if not os.path.exists(self.codes_file):
+            return False
+        with np.load(self.codes_file) as codes:
+            return np.array_equal(codes["file_stamp"], self._file_stamp())
+
+    def _trip_agencies(self, trips_df: pd.DataFrame) -> np.ndarray:
+        """Finds the agency of each trip from routes.txt."""
+        try:
+            routes_df = ttu.read_gtfs_table(
+                self.gtfs_path, "routes",
+                {"route_id": "object", "agency_id": "object"})
+        except (KeyError, FileNotFoundError):
+            return np.full(len(trips_df), UNKNOWN_AGENCY, dtype=object)
+
+        routes_df = routes_df.drop_duplicates(subset=["route_id"])
+        route_row = (pd.Index(routes_df["route_id"])
+                     .get_indexer(trips_df["route_id"]))
+        agencies = np.append(routes_df["agency_id"].fillna(UNKNOWN_AGENCY)
+                             .to_numpy(dtype=object), UNKNOWN_AGENCY)
+        return agencies[route_row]
+
+    def build(self):
+        """Converts the stop times and trips to Parquet.
+
+        The stop times are streamed in record batches as in
+        `ttu.read_stop_times`, with every valid departure time kept. Each
+        batch is sorted by agency, and rows are buffered for each agency
+        up to `MIN_ROWS_PER_GROUP` before they are written.
+        """
+        logger.info(f"Building Parquet cache of {self.gtfs_path}")
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.makedirs(self.cache_dir)
+
+        trips_df = ttu.read_gtfs_table(
+            self.gtfs_path, "trips",
+            {"route_id": "object", "service_id": "object",
+             "trip_id": "object"})
+        trips_df = trips_df.drop_duplicates(subset=["trip_id"])
+        trip_ids = pd.Index(trips_df["trip_id"])
+        trip_agency = self._trip_agencies(trips_df)
+
+        # One partition per agency, which can be more than pyarrow's
+        # default limit
+        write_options = {
+            "format": "parquet",
+            "partitioning": AGENCY_PARTITIONING,
+            "max_partitions": max(len(pd.unique(trip_agency)), 1),
+            "min_rows_per_group": MIN_ROWS_PER_GROUP,
+            "existing_data_behavior": "overwrite_or_ignore"}
+
+        trips_table = pa.table(
+            {"trip_code": np.arange(len(trips_df), dtype=np.int32),
+             "service_id": trips_df["service_id"].astype(str),
+             "agency_id": trip_agency.astype(str)},
+            schema=TRIPS_SCHEMA)
+        ds.write_dataset(
+            trips_table.sort_by("agency_id"), self.trips_dir,
+            **write_options)
+
+        # Stop ids are numbered in the order they are first seen
+        stop_ids = pd.Index([], dtype=object)
+
+        def stop_time_batches():
+            nonlocal stop_ids
+            cols = ["trip_id", "stop_id", "departure_time"]
+            with ttu.open_gtfs_file(self.gtfs_path, "stop_times") as source:
+                reader = pa_csv.open_csv(
+                    source,
+                    read_options=pa_csv.ReadOptions(
+                        block_size=ttu.CSV_BLOCK_SIZE),
+                    convert_options=pa_csv.ConvertOptions(
+                        include_columns=cols,
+                        column_types={col: pa.string() for col in cols},
+                        strings_can_be_null=True))
+                for batch in reader:
+                    departure = ttu.gtfs_times_to_seconds(
+                        batch.column("departure_time"))
+                    trip_code = trip_ids.get_indexer(
+                        batch.column("trip_id").to_numpy(
+                            zero_copy_only=False))
+                    keep = ((trip_code >= 0)
+                            & pc.is_valid(departure).to_numpy(
+                                zero_copy_only=False))
+
+                    batch_stops = (batch.column("stop_id")
+                                   .filter(pa.array(keep))
+                                   .to_numpy(zero_copy_only=False))
+                    stop_code = stop_ids.get_indexer(batch_stops)
+                    new_stops = pd.unique(batch_stops[stop_code < 0])
+                    if len(new_stops):
+                        stop_ids = stop_ids.append(pd.Index(new_stops))
+                        stop_code = stop_ids.get_indexer(batch_stops)
+
+                    stop_time_batch = pa.record_batch(
+                        [pa.array(trip_code[keep], type=pa.int32()),
+                         pa.array(stop_code, type=pa.int32()),
+                         departure.filter(pa.array(keep)),
+                         pa.array(trip_agency[trip_code[keep]].astype(str))],
+                        schema=STOP_TIMES_SCHEMA)
+                    yield stop_time_batch.take(pc.sort_indices(
+                        stop_time_batch, [("agency_id", "ascending")]))
+
+        ds.write_dataset(stop_time_batches(), self.stop_times_dir,
+                         schema=STOP_TIMES_SCHEMA, **write_options)
+
+        np.savez_compressed(self.codes_file,
+                            file_stamp=self._file_stamp(),
+                            trip_ids=trip_ids.to_numpy(dtype=str),
+                            stop_ids=stop_ids.to_numpy(dtype=str))
+
+    def _load_codes(self):
+        """Loads the ids the trip and stop codes stand for."""
+        with np.load(self.codes_file) as codes:
+            self.trip_ids = codes["trip_ids"]
+            self.stop_ids = codes["stop_ids"]
+
+    @property
+    def agencies(self) -> list:
+        """The agencies in the cache, one per partition."""
+        dataset = ds.dataset(self.trips_dir, format="parquet",
+                             partitioning=AGENCY_PARTITIONING)
+        agency_ids = dataset.to_table(columns=["agency_id"])["agency_id"]
+        return sorted(pc.unique(agency_ids).to_pylist())
+
+    def _agency_filter(self, agencies):
+        """Filter expression for the partitions of some agencies."""
+        if agencies is None:
+            return None
+        return pc.field("agency_id").isin(list(agencies))
+
+    def read_stop_times(self,
+                        early_hour: int,
+                        late_hour: int,
+                        agencies: list = None,
+                        keep_trip_ids=None) -> pd.DataFrame:
+        """Reads the stop times in an hour window.
+
+        Args:
+            early_hour (int): first hour of the window, e.g. 6.
+            late_hour (int): hour the window ends, not included, e.g. 20.
+            agencies (list, optional): agency_ids to read. Defaults to
+                every agency.
+            keep_trip_ids (array-like, optional): trips to keep every stop
+                of, in or out of the window, as in `ttu.read_stop_times`.
+
+        Returns:
+            pd.DataFrame: the same columns as `ttu.read_stop_times`.
+        """
+        in_window = ((pc.field("departure_time") >= early_hour * 3600)
+                     & (pc.field("departure_time") < late_hour * 3600))
+        if keep_trip_ids is not None:
+            keep_codes = pd.Index(self.trip_ids).get_indexer(
+                np.asarray(keep_trip_ids, dtype=str))
+            in_window = in_window | pc.field("trip_code").isin(
+                keep_codes[keep_codes >= 0].tolist())
+
+        agency_filter = self._agency_filter(agencies)
+        row_filter = (in_window if agency_filter is None
+                      else agency_filter & in_window)
+
+        dataset = ds.dataset(self.stop_times_dir, format="parquet",
+                             partitioning=AGENCY_PARTITIONING)
+        table = dataset.to_table(
+            columns=["trip_code", "stop_code", "departure_time"],
+            filter=row_filter)
+
+        stop_times_df = pd.DataFrame({
+            "trip_id": pd.Categorical.from_codes(
+                table["trip_code"].to_numpy(), categories=self.trip_ids),
+            "stop_id": pd.Categorical.from_codes(
+                table["stop_code"].to_numpy(), categories=self.stop_ids),
+            "departure_time": table["departure_time"].to_numpy()})
+        logger.info(f"Read {len(stop_times_df)} stop times from the cache")
+        return stop_times_df
+
+    def read_trips(self, agencies: list = None) -> pd.DataFrame:
+        """Reads the trips.
+
+        Args:
+            agencies (list, optional): agency_ids to read. Defaults to
+                every agency.
+
+        Returns:
+            pd.DataFrame: trip_id and service_id (categorical) and
+                agency_id of each trip.
+        """
+        dataset = ds.dataset(self.trips_dir, format="parquet",
+                             partitioning=AGENCY_PARTITIONING)
+        table = dataset.to_table(filter=self._agency_filter(agencies))
+        return pd.DataFrame({
+            "trip_id": pd.Categorical.from_codes(
+                table["trip_code"].to_numpy(), categories=self.trip_ids),
+            "service_id": pd.Categorical(
+                table["service_id"].to_numpy(zero_copy_only=False)),
+            "agency_id": table["agency_id"].to_numpy(zero_copy_only=False)})
@@ -0,0 +1,106 @@
+"""Headways between departures at each stop.
+
+"At least one departure every hour" says little about how even the service
+is. These functions measure the gaps between departures at every stop in
+the hours counted. The departures are sorted by stop and time once, so the
+gaps of all stops are one diff over the sorted array, and the statistics
+per stop are grouped sums and maximums over it.
+"""
+# Core imports
+import logging
+
+# Third party imports
+import numpy as np
+import pandas as pd
+
+# Create logger
+logger = logging.getLogger(__name__)
+
+
+def headway_stats(stop_ids: pd.Series,
+                  departure_secs: pd.Series,
+                  early_hour: int,
+                  late_hour: int,
+                  thresholds=(15, 20, 30)) -> pd.DataFrame:
+    """Calculates headway statistics for each stop.
+
+    Departures at the same stop and time, e.g. on different routes, are
+    counted once. The gaps before the first departure and after the last
+    departure in the window count towards the maximum gap but are not
+    headways.
+
+    Args:
+        stop_ids (pd.Series): stop of each departure.
+        departure_secs (pd.Series): departure times in seconds since
+            midnight.
+        early_hour (int): first hour of the window.
+        late_hour (int): hour the window ends, not included.
+        thresholds (tuple, optional): headways in minutes to measure the
+            coverage of. Defaults to (15, 20, 30).
+
+    Returns:
+        pd.DataFrame: one row per stop with departures in the window, with
+            stop_id, departures, max_gap_mins, mean_headway_mins (NaN for
+            stops with one departure) and, for each threshold, the share
+            of the window covered by headways of at most that many minutes.
+    """
+    window_start = early_hour * 3600
+    window_end = late_hour * 3600
+
+    departure_secs = np.asarray(departure_secs)
+    in_window = ((departure_secs >= window_start)
+                 & (departure_secs < window_end))
+    stop_codes, stop_uniques = pd.factorize(np.asarray(stop_ids)[in_window])
+    times = departure_secs[in_window].astype(np.int64)
+
+    # Sort by stop then time, dropping repeated times at a stop
+    order = np.lexsort((times, stop_codes))
+    stop_codes, times = stop_codes[order], times[order]
+    repeat = np.zeros(len(times), dtype=bool)
+    repeat[1:] = ((stop_codes[1:] == stop_codes[:-1])
+                  & (times[1:] == times[:-1]))
+    stop_codes, times = stop_codes[~repeat], times[~repeat]
+
+    # Gap before each departure, from the window start for a stop's first
+    first = np.ones(len(times), dtype=bool)
+    first[1:] = stop_codes[1:] != stop_codes[:-1]
+    previous = np.empty_like(times)
+    previous[0:1] = window_start
+    previous[1:] = times[:-1]
+    previous[first] = window_start
+    gaps = times - previous
+
+    n_stops = len(stop_uniques)
+    stop_starts = np.flatnonzero(first)
+    stop_ends = np.append(stop_starts[1:], len(times)) - 1
+
+    # Longest gap, including the gap from the last departure to the end
+    max_gap = np.zeros(n_stops, dtype=np.int64)
+    if n_stops:
+        max_gap = np.maximum(np.maximum.reduceat(gaps, stop_starts),
+                             window_end - times[stop_ends])
+
+    # Headways are the gaps between departures
+    headway_stops = stop_codes[~first]
+    headways = gaps[~first]
+    n_headways = np.bincount(headway_stops, minlength=n_stops)
+    headway_sum = np.bincount(headway_stops, weights=headways,
+                              minlength=n_stops)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_headway = headway_sum / n_headways
+
+    stats_df = pd.DataFrame({
+        "stop_id": np.asarray(stop_uniques),
+        "departures": n_headways + 1,
+        "max_gap_mins": max_gap / 60,
+        "mean_headway_mins": mean_headway / 60})
+
+    window_secs = window_end - window_start
+    for threshold in thresholds:
+        short = headways <= threshold * 60
+        covered = np.bincount(headway_stops[short], weights=headways[short],
+                              minlength=n_stops)
+        stats_df[f"share_within_{threshold}_mins"] = covered / window_secs
+
+    return stats_df
@@ -0,0 +1,263 @@
+"""Which timetable services run on which dates, stored as bitsets.
+
+Each GTFS service or CIF schedule is turned into one bit per date over the
+whole timetable period: the weekday pattern within its validity range,
+plus the GTFS calendar_dates additions and removals. The bits are packed
+eight dates to a byte, so finding the services that run on a date, or on
+a set of dates, is a vectorised bit test over every service at once.
+"""
+# Core imports
+import logging
+
+# Third party imports
+import numpy as np
+import pandas as pd
+
+# Module imports
+import time_table_utils as ttu
+
+# Create logger
+logger = logging.getLogger(__name__)
+
+# GTFS calendar_dates exception types
+SERVICE_ADDED = 1
+SERVICE_REMOVED = 2
+
+# Bytes of bitset built at a time
+CHUNK_BYTES = 1 << 22
+
+
+def _to_days(dates) -> np.ndarray:
+    """Converts dates to datetime64[D]."""
+    return pd.to_datetime(np.asarray(dates)).to_numpy("datetime64[D]")
+
+
+class ServiceCalendar:
+    """Date bitsets for a set of services.
+
+    Args:
+        service_ids (array-like): id of each service.
+        start_dates (array-like): first date of each service's pattern,
+            NaT for services with no pattern.
+        end_dates (array-like): last date of each service's pattern.
+        day_flags (np.ndarray): 0/1 with one row per service and a column
+            for each day of the week from Monday. Kept as `day_flags` for
+            filtering on the day of the week alone.
+        first_date (optional): first date of the bitsets. Defaults to the
+            earliest start date.
+        last_date (optional): last date of the bitsets. Defaults to the
+            latest end date.
+    """
+
+    def __init__(self, service_ids, start_dates, end_dates, day_flags,
+                 first_date=None, last_date=None):
+        self.service_ids = pd.Index(service_ids)
+        self.day_flags = np.asarray(day_flags)
+        start = _to_days(start_dates)
+        end = _to_days(end_dates)
+
+        self.first_date = (np.nanmin(start) if first_date is None
+                           else _to_days([first_date])[0])
+        last_date = (np.nanmax(end) if last_date is None
+                     else _to_days([last_date])[0])
+        self.n_days = int((last_date - self.first_date).astype(int)) + 1
+
+        # NaT start or end dates give no running days
+        has_pattern = ~(np.isnat(start) | np.isnat(end))
+        start_off = np.where(
+            has_pattern, (start - self.first_date).astype(np.int64), 1)
+        end_off = np.where(
+            has_pattern, (end - self.first_date).astype(np.int64), 0)
+
+        # Packed dates of each of the 128 weekday patterns, looked up by
+        # each service's pattern rather than built per service
+        weekday = ((pd.Timestamp(self.first_date).dayofweek
+                    + np.arange(self.n_days)) % 7)
+        on_weekday = (ttu.DAY_BITS[weekday] & np.arange(128)[:, None]) > 0
+        pattern_bits = np.packbits(on_weekday, axis=1)
+        service_patterns = ttu.day_bits(self.day_flags)
+
+        # Written straight into packed form a chunk of services at a
+        # time, so no array has a value per service and date
+        n_bytes = pattern_bits.shape[1]
+        self.bits = np.zeros((len(self.service_ids), n_bytes),
+                             dtype=np.uint8)
+        byte_start = np.arange(n_bytes, dtype=np.int64) * 8
+        chunk_size = max(1, CHUNK_BYTES // max(n_bytes, 1))
+        for first in range(0, len(self.service_ids), chunk_size):
+            rows = slice(first, first + chunk_size)
+            # Bits of each byte before the start and up to the end date
+            before_start = np.clip(
+                start_off[rows, None] - byte_start, 0, 8)
+            to_end = np.clip(end_off[rows, None] - byte_start + 1, 0, 8)
+            in_range = ((0xFF >> before_start)
+                        & (0xFF << (8 - to_end)) & 0xFF)
+            self.bits[rows] = (in_range.astype(np.uint8)
+                               & pattern_bits[service_patterns[rows]])
+
+    @classmethod
+    def from_gtfs(cls,
+                  calendar_df: pd.DataFrame,
+                  calendar_dates_df: pd.DataFrame = None):
+        """Builds the bitsets from the GTFS calendar and calendar_dates.
+
+        Services that are only in calendar_dates are included, running on
+        their added dates only.
+
+        Args:
+            calendar_df (pd.DataFrame): calendar with service_id, the seven
+                day columns, start_date and end_date as datetimes.
+            calendar_dates_df (pd.DataFrame, optional): calendar_dates with
+                service_id, date as a datetime and exception_type.
+
+        Returns:
+            ServiceCalendar: the calendar.
+        """
+        calendar_df = calendar_df.drop_duplicates(subset=["service_id"])
+        service_ids = pd.Index(calendar_df["service_id"].astype(str))
+        start_dates = calendar_df["start_date"].to_numpy()
+        end_dates = calendar_df["end_date"].to_numpy()
+        day_flags = calendar_df[ttu.DAY_COLS].to_numpy()
+
+        first_date = calendar_df["start_date"].min()
+        last_date = calendar_df["end_date"].max()
+
+        if calendar_dates_df is not None and len(calendar_dates_df):
+            exception_ids = calendar_dates_df["service_id"].astype(str)
+            extra_ids = pd.Index(exception_ids.unique()).difference(
+                service_ids)
+            service_ids = service_ids.append(extra_ids)
+            start_dates = np.append(
+                start_dates, np.full(len(extra_ids), np.datetime64("NaT")))
+            end_dates = np.append(
+                end_dates, np.full(len(extra_ids), np.datetime64("NaT")))
+            day_flags = np.vstack(
+                [day_flags, np.zeros((len(extra_ids), 7), dtype=int)])
+
+            first_date = min(first_date, calendar_dates_df["date"].min())
+            last_date = max(last_date, calendar_dates_df["date"].max())
+
+        service_calendar = cls(service_ids, start_dates, end_dates,
+                               day_flags, first_date, last_date)
+
+        if calendar_dates_df is not None and len(calendar_dates_df):
+            service_calendar.apply_exceptions(
+                calendar_dates_df["service_id"].astype(str),
+                calendar_dates_df["date"],
+                calendar_dates_df["exception_type"])
+
+        return service_calendar
+
+    @classmethod
+    def from_cif_schedules(cls, schedules_df: pd.DataFrame):
+        """Builds the bitsets from CIF schedules.
+
+        Services are the rows of `schedules_df`, in order. STP overlays
+        and cancellations are not applied here, see `STPResolver`.
+
+        Args:
+            schedules_df (pd.DataFrame): schedules as returned by
+                `ttu.extract_mca`.
+
+        Returns:
+            ServiceCalendar: the calendar.
+        """
+        return cls(schedules_df["schedule_id"].astype(str),
+                   schedules_df["start_date"].to_numpy(),
+                   schedules_df["end_date"].to_numpy(),
+                   schedules_df[ttu.DAY_COLS].to_numpy())
+
+    def _offsets(self, dates):
+        """Day offsets of dates in the bitsets, and which are in range."""
+        offsets = (_to_days(dates) - self.first_date).astype(np.int64)
+        in_range = (offsets >= 0) & (offsets < self.n_days)
+        return offsets, in_range
+
+    def apply_exceptions(self, service_ids, dates, exception_types):
+        """Adds and removes single dates for services.
+
+        Args:
+            service_ids (array-like): service of each exception.
+            dates (array-like): date of each exception.
+            exception_types (array-like): 1 where the service is added on
+                the date, 2 where it is removed.
+        """
+        rows = self.service_ids.get_indexer(service_ids)
+        offsets, in_range = self._offsets(dates)
+        exception_types = np.asarray(exception_types)
+
+        bad_types = set(exception_types) - {SERVICE_ADDED, SERVICE_REMOVED}
+        if bad_types:
+            raise ValueError(f"""{bad_types} are not valid exception types,
+                             should be either 1 or 2""")
+
+        keep = (rows >= 0) & in_range
+        rows, offsets = rows[keep], offsets[keep]
+        exception_types = exception_types[keep]
+        cols = offsets >> 3
+        masks = (0x80 >> (offsets & 7)).astype(np.uint8)
+
+        added = exception_types == SERVICE_ADDED
+        np.bitwise_or.at(self.bits, (rows[added], cols[added]),
+                         masks[added])
+        removed = ~added
+        np.bitwise_and.at(self.bits, (rows[removed], cols[removed]),
+                          ~masks[removed])
+
+    def active_on_dates(self, dates) -> np.ndarray:
+        """Tests which services run on each of a set of dates.
+
+        Args:
+            dates (array-like): the dates.
+
+        Returns:
+            np.ndarray: bool with one row per service and one column per
+                date. Dates outside the timetable period have no services.
+        """
+        offsets, in_range = self._offsets(dates)
+        offsets = np.where(in_range, offsets, 0)
+        masks = (0x80 >> (offsets & 7)).astype(np.uint8)
+        active = (self.bits[:, offsets >> 3] & masks) > 0
+        return active & in_range
+
+    def active_on(self, date) -> np.ndarray:
+        """Tests which services run on a date.
+
+        Args:
+            date (str or pd.Timestamp): the date.
+
+        Returns:
+            np.ndarray: bool for each service.
+        """
+        return self.active_on_dates([date])[:, 0]
+
+    def active_on_any(self, dates) -> np.ndarray:
+        """Tests which services run on at least one of a set of dates.
+
+        Args:
+            dates (array-like): the dates.
+
+        Returns:
+            np.ndarray: bool for each service.
+        """
+        return self.active_on_dates(dates).any(axis=1)
+
+    def runs_on_weekday(self, day: str) -> np.ndarray:
+        """Tests which services have a day of the week in their pattern,
+        whatever the dates.
+
+        Args:
+            day (str): day of the week, e.g. "wednesday".
+
+        Returns:
+            np.ndarray: bool for each service.
+        """
+        return self.day_flags[:, ttu.DAY_COLS.index(day.lower())] == 1
+
+    def days_active(self) -> np.ndarray:
+        """Counts the dates each service runs on.
+
+        Returns:
+            np.ndarray: number of dates for each service.
+        """
+        return np.unpackbits(self.bits, axis=1).sum(axis=1)
@@ -0,0 +1,152 @@
+"""Persisted index of rail station codes and locations by tiploc.
+
+The train timetable is counted by tiploc, but the stations' locations are
+in NaPTAN, which has the tiploc inside each station's ATCO code, and their
+CRS codes are in the MSN file. Extracting the tiplocs and matching them
+up on every run is repeated work, as both files rarely change.
+`StationIndex` does it once and saves, sorted by tiploc, the CRS code,
+easting, northing and NaPTAN code of every station. The index is reused
+until the NaPTAN or MSN file changes, and the stations of any tiplocs are
+found with a binary search.
+"""
+# Core imports
+import os
+import logging
+
+# Third party imports
+import numpy as np
+import pandas as pd
+
+# Module imports
+import time_table_utils as ttu
+import data_transform as dt
+
+# Create logger
+logger = logging.getLogger(__name__)
+
+# NaPTAN columns needed to build the index
+NAPTAN_COLS = ["ATCOCode", "NaptanCode", "StopType", "Easting", "Northing"]
+
+
+class StationIndex:
+    """Looks up rail stations by tiploc.
+
+    Args:
+        naptan_file (str): path to the NaPTAN stops feather file, as saved
+            by `di.save_latest_stops_as_feather`.
+        msn_file (str): path to the msn file.
+        index_file (str, optional): path of the index. Defaults to the msn
+            file path with "_stations.npz" in place of the extension.
+    """
+
+    def __init__(self, naptan_file: str, msn_file: str,
+                 index_file: str = None):
+        self.naptan_file = naptan_file
+        self.msn_file = msn_file
+        if index_file is None:
+            index_file = os.path.splitext(msn_file)[0] + "_stations.npz"
+        self.index_file = index_file
+
+        if not self._index_is_current():
+            self.build_index()
+        self._load_index()
+
+    def _file_stamp(self) -> np.ndarray:
+        """Size and modified time of the NaPTAN and msn files, to spot
+        changes."""
+        stats = [os.stat(path) for path in [self.naptan_file, self.msn_file]]
+        return np.array([[stat.st_size, stat.st_mtime_ns] for stat in stats],
+                        dtype=np.int64)
+
+    def _index_is_current(self) -> bool:
+        """Checks the index exists and was built from the current files."""
+        if not os.path.exists(self.index_file):
+            return False
+        with np.load(self.index_file) as index:
+            return np.array_equal(index["file_stamp"], self._file_stamp())
+
+    def build_index(self):
+        """Matches the NaPTAN stations to the msn file and saves the index.
+
+        Every NaPTAN station (stop type RLY) with a tiploc is kept, with
+        the CRS code of the tiploc in the msn file, or an empty string
+        where it has none. The first station is kept for tiplocs in NaPTAN
+        more than once, and the first tiploc for CRS codes in the msn file
+        more than once.
+        """
+        logger.info(f"Building station index for {self.naptan_file} "
+                    f"and {self.msn_file}")
+        naptan_df = pd.read_feather(self.naptan_file, columns=NAPTAN_COLS)
+        stations_df = dt.create_tiploc_col(
+            naptan_df[naptan_df["StopType"] == "RLY"])
+        stations_df = (stations_df
+                       .dropna(subset=["tiploc_code", "Easting", "Northing"])
+                       .drop_duplicates(subset=["tiploc_code"])
+                       .sort_values("tiploc_code"))
+
+        msn_df = pd.DataFrame(ttu.extract_msn_data(self.msn_file),
+                              columns=["station_name", "tiploc_code",
+                                       "crs_code"])
+        msn_df = (msn_df.drop_duplicates(subset=["crs_code"])
+                  .drop_duplicates(subset=["tiploc_code"]))
+        msn_row = (pd.Index(msn_df["tiploc_code"])
+                   .get_indexer(stations_df["tiploc_code"]))
+        crs_codes = np.append(msn_df["crs_code"].to_numpy(dtype=str),
+                              "")[msn_row]
+
+        np.savez_compressed(
+            self.index_file,
+            file_stamp=self._file_stamp(),
+            tiploc=stations_df["tiploc_code"].to_numpy(dtype=str),
+            crs=crs_codes,
+            naptan_code=stations_df["NaptanCode"].fillna("")
+            .to_numpy(dtype=str),
+            easting=stations_df["Easting"].to_numpy(),
+            northing=stations_df["Northing"].to_numpy())
+
+    def _load_index(self):
+        """Loads the index into memory."""
+        with np.load(self.index_file) as index:
+            self.tiploc = index["tiploc"]
+            self.crs = index["crs"]
+            self.naptan_code = index["naptan_code"]
+            self.easting = index["easting"]
+            self.northing = index["northing"]
+
+    def lookup(self, tiploc_codes) -> np.ndarray:
+        """Finds the station of each tiploc.
+
+        Args:
+            tiploc_codes (array-like): the tiploc codes.
+
+        Returns:
+            np.ndarray: position of each tiploc's station in the index, -1
+                where it has none.
+        """
+        tiploc_codes = np.asarray(tiploc_codes, dtype=str)
+        if len(self.tiploc) == 0:
+            return np.full(len(tiploc_codes), -1)
+        pos = np.searchsorted(self.tiploc, tiploc_codes)
+        pos = np.minimum(pos, len(self.tiploc) - 1)
+        return np.where(self.tiploc[pos] == tiploc_codes, pos, -1)
+
+    def add_locations(self, df: pd.DataFrame,
+                      on: str = "tiploc_code") -> pd.DataFrame:
+        """Adds the easting and northing of each row's station.
+
+        Rows whose tiploc has no station are dropped, as in an inner join.
+
+        Args:
+            df (pd.DataFrame): dataframe with a tiploc column.
+            on (str, optional): the tiploc column. Defaults to
+                "tiploc_code".
+
+        Returns:
+            pd.DataFrame: `df` with Easting and Northing columns.
+        """
+        pos = self.lookup(df[on])
+        has_station = pos >= 0
+        df = df[has_station].reset_index(drop=True)
+        df["Easting"] = self.easting[pos[has_station]]
+        df["Northing"] = self.northing[pos[has_station]]
+        return df
@@ -0,0 +1,389 @@
+"""Counts of departures from each stop in each hour of the day.
+
+The timetable scripts used to pivot the departures into a stop by hour
+table, test it for a service every hour and throw it away. The counts are
+now kept as a sparse matrix and saved for each timetable vintage and day,
+so other rules for highly serviced stops can be tested from the saved
+counts without reading the timetables again.
+
+`StopDayHourCounts` counts every day of the week in one pass, from the
+days each service runs, so weekday, Saturday and Sunday highly serviced
+stops all come from one run of a timetable script.
+"""
+# Core imports
+import os
+import logging
+
+# Third party imports
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# Module imports
+import time_table_utils as ttu
+
+# Create logger
+logger = logging.getLogger(__name__)
+
+# Count columns for each day
+HOURS_PER_DAY = 24
+
+
+def _save_counts(path: str, counts, stop_ids, early_hour, late_hour):
+    """Saves a sparse count matrix and its stops to a compressed npz file."""
+    logger.info(f"Saving stop hour counts to {path}")
+    np.savez_compressed(path,
+                        data=counts.data,
+                        indices=counts.indices,
+                        indptr=counts.indptr,
+                        shape=counts.shape,
+                        stop_ids=np.asarray(stop_ids).astype(str),
+                        window=[early_hour, late_hour])
+
+
+def _load_counts(path: str):
+    """Loads a count matrix saved with `_save_counts`.
+
+    Returns:
+        Tuple: counts, stop ids, early hour and late hour.
+    """
+    with np.load(path) as saved:
+        counts = sparse.csr_matrix(
+            (saved["data"], saved["indices"], saved["indptr"]),
+            shape=tuple(saved["shape"]))
+        early_hour, late_hour = saved["window"]
+        return counts, saved["stop_ids"], early_hour, late_hour
+
+
+class StopHourCounts:
+    """Sparse matrix of departures with one row per stop and one column
+    per hour of the day.
+
+    Args:
+        counts (sparse.csr_matrix): departures, stops by hours.
+        stop_ids (np.ndarray): id of the stop in each row.
+        early_hour (int): first hour that departures were counted for.
+        late_hour (int): hour that counting ended, not included.
+    """
+
+    def __init__(self, counts, stop_ids, early_hour, late_hour):
+        self.counts = sparse.csr_matrix(counts, dtype=np.int32)
+        self.stop_ids = np.asarray(stop_ids)
+        self.early_hour = int(early_hour)
+        self.late_hour = int(late_hour)
+
+    @classmethod
+    def from_departures(cls,
+                        stop_ids: pd.Series,
+                        departure_secs: pd.Series,
+                        early_hour: int,
+                        late_hour: int):
+        """Counts the departures per stop and hour.
+
+        Args:
+            stop_ids (pd.Series): stop of each departure, e.g. stop_id or
+                tiploc_code.
+            departure_secs (pd.Series): departure times in seconds since
+                midnight.
+            early_hour (int): first hour of the window counted.
+            late_hour (int): hour the window ends, not included.
+
+        Returns:
+            StopHourCounts: the counts. Every hour of the window has a
+                column, even if nothing departs in it.
+        """
+        hours = np.asarray(departure_secs) // 3600
+        in_window = (hours >= early_hour) & (hours < late_hour)
+        stop_codes, stop_uniques = pd.factorize(
+            np.asarray(stop_ids)[in_window])
+
+        n_stops = len(stop_uniques)
+        n_hours = HOURS_PER_DAY
+        counts = np.bincount(stop_codes * n_hours + hours[in_window],
+                             minlength=n_stops * n_hours)
+        return cls(counts.reshape(n_stops, n_hours),
+                   np.asarray(stop_uniques),
+                   early_hour,
+                   late_hour)
+
+    @staticmethod
+    def path(out_dir: str, vintage: str, day: str) -> str:
+        """Gets the path the counts for a timetable vintage and day are
+        saved at.
+
+        Args:
+            out_dir (str): folder for the counts.
+            vintage (str): identifies the timetable, e.g. its download date.
+            day (str): the day or date the counts are for.
+
+        Returns:
+            str: path of the npz file.
+        """
+        return os.path.join(out_dir,
+                            f"stop_hour_counts_{vintage}_{day.lower()}.npz")
+
+    def save(self, path: str):
+        """Saves the counts to a compressed npz file.
+
+        Args:
+            path (str): path of the npz file.
+        """
+        _save_counts(path, self.counts, self.stop_ids,
+                     self.early_hour, self.late_hour)
+
+    @classmethod
+    def load(cls, path: str):
+        """Loads counts saved with `save`.
+
+        Args:
+            path (str): path of the npz file.
+
+        Returns:
+            StopHourCounts: the counts.
+        """
+        return cls(*_load_counts(path))
+
+    def _window(self, early_hour, late_hour):
+        """Checks a window is inside the hours that were counted."""
+        early_hour = self.early_hour if early_hour is None else early_hour
+        late_hour = self.late_hour if late_hour is None else late_hour
+        if early_hour < self.early_hour or late_hour > self.late_hour:
+            raise ValueError(f"""The window {early_hour}-{late_hour} is
+                             outside the hours counted,
+                             {self.early_hour}-{self.late_hour}""")
+        return early_hour, late_hour
+
+    def served(self,
+               min_per_hour: int = 1,
+               min_hours: int = None,
+               early_hour: int = None,
+               late_hour: int = None) -> np.ndarray:
+        """Tests which stops meet a service level.
+
+        The default is the rule used for highly serviced stops: at least
+        one departure in every hour of the window.
+
+        Args:
+            min_per_hour (int, optional): departures needed for an hour to
+                count as served. Defaults to 1.
+            min_hours (int, optional): served hours needed. Defaults to
+                every hour of the window.
+            early_hour (int, optional): first hour of the window. Defaults
+                to the first hour counted.
+            late_hour (int, optional): hour the window ends, not included.
+                Defaults to the end of the hours counted.
+
+        Returns:
+            np.ndarray: bool for each stop, in the order of `stop_ids`.
+        """
+        early_hour, late_hour = self._window(early_hour, late_hour)
+        if min_hours is None:
+            min_hours = late_hour - early_hour
+
+        window_counts = self.counts[:, early_hour:late_hour]
+        hours_served = (window_counts >= min_per_hour).sum(axis=1)
+        return np.asarray(hours_served).ravel() >= min_hours
+
+    def served_stops(self, **kwargs) -> np.ndarray:
+        """Gets the ids of the stops that meet a service level.
+
+        Args:
+            **kwargs: the service level, see `served`.
+
+        Returns:
+            np.ndarray: stop ids.
+        """
+        return self.stop_ids[self.served(**kwargs)]
+
+    def to_frame(self) -> pd.DataFrame:
+        """Gets the counts in the window as a dense stop by hour table.
+
+        Returns:
+            pd.DataFrame: one row per stop and one column per hour.
+        """
+        hours = range(self.early_hour, self.late_hour)
+        return pd.DataFrame(
+            self.counts[:, self.early_hour:self.late_hour].toarray(),
+            index=pd.Index(self.stop_ids, name="stop_id"),
+            columns=pd.Index(hours, name="hour"))
+
+
+class StopDayHourCounts:
+    """Sparse matrix of departures with one row per stop and a column for
+    each hour of each day of the week, Monday's hours first.
+
+    Args:
+        counts (sparse.csr_matrix): departures, stops by 7 x 24 hours.
+        stop_ids (np.ndarray): id of the stop in each row.
+        early_hour (int): first hour that departures were counted for.
+        late_hour (int): hour that counting ended, not included.
+    """
+
+    def __init__(self, counts, stop_ids, early_hour, late_hour):
+        self.counts = sparse.csr_matrix(counts, dtype=np.int32)
+        self.stop_ids = np.asarray(stop_ids)
+        self.early_hour = int(early_hour)
+        self.late_hour = int(late_hour)
+
+    @classmethod
+    def from_departures(cls,
+                        stop_ids: pd.Series,
+                        departure_secs: pd.Series,
+                        day_flags: np.ndarray,
+                        early_hour: int,
+                        late_hour: int,
+                        service_rows: np.ndarray = None):
+        """Counts the departures per stop, day of the week and hour.
+
+        Departures are first counted per stop, hour and service. One
+        sparse product with the services' day flags then gives the counts
+        for every day at once.
+
+        Args:
+            stop_ids (pd.Series): stop of each departure.
+            departure_secs (pd.Series): departure times in seconds since
+                midnight.
+            day_flags (np.ndarray): 0/1 with one row per service and a
+                column for each day of the week from Monday.
+            early_hour (int): first hour of the window counted.
+            late_hour (int): hour the window ends, not included.
+            service_rows (np.ndarray, optional): row in `day_flags` of
+                each departure's service, -1 where it is missing, as
+                returned by `ttu.trip_service_rows`. Defaults to one row
+                of `day_flags` per departure.
+
+        Returns:
+            StopDayHourCounts: the counts.
+        """
+        hours = np.asarray(departure_secs) // 3600
+        day_flags = (np.asarray(day_flags) == 1).astype(np.int32)
+        if service_rows is None:
+            service_rows = np.arange(len(hours))
+        service_rows = np.asarray(service_rows)
+
+        keep = (hours >= early_hour) & (hours < late_hour) \
+            & (service_rows >= 0)
+        stop_codes, stop_uniques = pd.factorize(np.asarray(stop_ids)[keep])
+        hours = hours[keep]
+        n_stops = len(stop_uniques)
+
+        # Rows are (stop, hour) pairs and columns are services
+        by_service = sparse.csr_matrix(
+            (np.ones(len(hours), dtype=np.int32),
+             (stop_codes * HOURS_PER_DAY + hours, service_rows[keep])),
+            shape=(n_stops * HOURS_PER_DAY, len(day_flags)))
+
+        # Rows are (stop, hour) pairs and columns are days, moved round to
+        # one row per stop with the day's hours side by side
+        by_day = (by_service @ sparse.csr_matrix(day_flags)).tocoo()
+        counts = sparse.csr_matrix(
+            (by_day.data,
+             (by_day.row // HOURS_PER_DAY,
+              by_day.col * HOURS_PER_DAY + by_day.row % HOURS_PER_DAY)),
+            shape=(n_stops, len(ttu.DAY_COLS) * HOURS_PER_DAY))
+        return cls(counts, np.asarray(stop_uniques), early_hour, late_hour)
+
+    @staticmethod
+    def path(out_dir: str, vintage: str) -> str:
+        """Gets the path the counts for a timetable vintage are saved at.
+
+        Args:
+            out_dir (str): folder for the counts.
+            vintage (str): identifies the timetable, e.g. its download date.
+
+        Returns:
+            str: path of the npz file.
+        """
+        return os.path.join(out_dir, f"stop_day_hour_counts_{vintage}.npz")
+
+    def save(self, path: str):
+        """Saves the counts to a compressed npz file.
+
+        Args:
+            path (str): path of the npz file.
+        """
+        _save_counts(path, self.counts, self.stop_ids,
+                     self.early_hour, self.late_hour)
+
+    @classmethod
+    def load(cls, path: str):
+        """Loads counts saved with `save`.
+
+        Args:
+            path (str): path of the npz file.
+
+        Returns:
+            StopDayHourCounts: the counts.
+        """
+        return cls(*_load_counts(path))
+
+    def add(self, other, sign: int = 1):
+        """Adds another set of counts, matching the stops by id.
+
+        Args:
+            other (StopDayHourCounts): counts for the same hours.
+            sign (int, optional): 1 to add, -1 to subtract. Defaults to 1.
+
+        Returns:
+            StopDayHourCounts: the summed counts. Stops with no departures
+                left are dropped.
+        """
+        if ((other.early_hour, other.late_hour)
+                != (self.early_hour, self.late_hour)):
+            raise ValueError(f"""Counts for the hours
+                             {other.early_hour}-{other.late_hour} can not
+                             be added to counts for the hours
+                             {self.early_hour}-{self.late_hour}""")
+
+        stop_ids = pd.Index(self.stop_ids).append(
+            pd.Index(other.stop_ids)).unique()
+        this, that = self.counts.tocoo(), other.counts.tocoo()
+        rows = np.concatenate(
+            [stop_ids.get_indexer(self.stop_ids)[this.row],
+             stop_ids.get_indexer(other.stop_ids)[that.row]])
+        counts = sparse.csr_matrix(
+            (np.concatenate([this.data, sign * that.data]),
+             (rows, np.concatenate([this.col, that.col]))),
+            shape=(len(stop_ids), self.counts.shape[1]))
+        counts.eliminate_zeros()
+
+        has_counts = counts.getnnz(axis=1) > 0
+        return StopDayHourCounts(counts[has_counts],
+                                 np.asarray(stop_ids)[has_counts],
+                                 self.early_hour,
+                                 self.late_hour)
+
+    def for_day(self, day: str) -> StopHourCounts:
+        """Gets the counts for one day of the week.
+
+        Args:
+            day (str): day of the week, e.g. "saturday".
+
+        Returns:
+            StopHourCounts: the day's counts, with a row for every stop.
+        """
+        day = day.lower()
+        if day not in ttu.DAY_COLS:
+            raise ValueError(f"""{day} is not a valid day,
+                             should be one of {ttu.DAY_COLS}""")
+        first_col = ttu.DAY_COLS.index(day) * HOURS_PER_DAY
+        return StopHourCounts(
+            self.counts[:, first_col:first_col + HOURS_PER_DAY],
+            self.stop_ids,
+            self.early_hour,
+            self.late_hour)
+
+    def served_by_day(self, **kwargs) -> pd.DataFrame:
+        """Gets the stops that meet a service level on each day of the week.
+
+        Args:
+            **kwargs: the service level, see `StopHourCounts.served`.
+
+        Returns:
+            pd.DataFrame: stop_id and day of each stop served on each day.
+        """
+        served_dfs = [pd.DataFrame({"stop_id": self.for_day(day)
+                                    .served_stops(**kwargs),
+                                    "day": day})
+                      for day in ttu.DAY_COLS]
+        return pd.concat(served_dfs, ignore_index=True)
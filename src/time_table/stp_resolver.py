@@ -0,0 +1,108 @@
+"""Resolves short term planning (STP) overlays in the CIF schedules.
+
+A train UID can have several schedules covering the same date: the
+permanent schedule (STP indicator P) and short term overlays (O), new
+short term schedules (N) or cancellations (C). On any date only one of
+them runs. The short term records take priority over the permanent
+schedule, and a cancellation means the train does not run at all.
+"""
+# Core imports
+import logging
+
+# Third party imports
+import numpy as np
+import pandas as pd
+
+# Module imports
+import time_table_utils as ttu
+
+# Create logger
+logger = logging.getLogger(__name__)
+
+# Higher number wins when schedules for a train overlap
+STP_PRIORITY = {"P": 0, "O": 1, "N": 1, "C": 1}
+
+
+class STPResolver:
+    """Finds the schedule in effect for each train on a given date.
+
+    The schedules are sorted by start date once, so the schedules that
+    have started by a date are a prefix of the sorted arrays. Each date is
+    then resolved for all trains at once with array operations.
+
+    Args:
+        schedules_df (pd.DataFrame): schedules as returned by
+            `ttu.extract_mca`, with the train_uid, stp_indicator,
+            start_date, end_date and day columns.
+    """
+
+    def __init__(self, schedules_df: pd.DataFrame):
+        bad_stp = set(schedules_df["stp_indicator"].astype(str)) \
+            - set(STP_PRIORITY)
+        if bad_stp:
+            raise ValueError(f"""{bad_stp} are not valid STP indicators,
+                             should be one of {list(STP_PRIORITY)}""")
+
+        self.schedules_df = schedules_df.reset_index(drop=True)
+
+        start = self.schedules_df["start_date"].to_numpy("datetime64[D]")
+        end = self.schedules_df["end_date"].to_numpy("datetime64[D]")
+        self._order = np.argsort(start, kind="stable")
+        self._start = start[self._order]
+        self._end = end[self._order]
+
+        # Days run as a bit mask, bit 0 is Monday
+        day_bits = self.schedules_df[ttu.DAY_COLS].to_numpy(dtype=np.uint8)
+        self._day_mask = (day_bits << np.arange(7, dtype=np.uint8)).sum(
+            axis=1, dtype=np.uint8)
+
+        stp = self.schedules_df["stp_indicator"].astype(str)
+        self._priority = stp.map(STP_PRIORITY).to_numpy()
+        self._cancelled = (stp == "C").to_numpy()
+        self._uid, _ = pd.factorize(self.schedules_df["train_uid"])
+        self._start_by_row = start
+
+    def effective_rows(self, date) -> np.ndarray:
+        """Finds the row of the schedule in effect for each train on a date.
+
+        Args:
+            date (str or pd.Timestamp): the date of interest.
+
+        Returns:
+            np.ndarray: positions in `schedules_df` of the schedules that
+                run on the date, in row order. Trains that are cancelled or
+                do not run on the date have no row.
+        """
+        date = pd.Timestamp(date)
+        day_bit = np.uint8(1 << date.dayofweek)
+        date = np.datetime64(date.date(), "D")
+
+        # Schedules that have started by the date, still running and
+        # that run on that day of the week
+        n_started = np.searchsorted(self._start, date, side="right")
+        rows = self._order[:n_started]
+        running = self._end[:n_started] >= date
+        rows = rows[running & ((self._day_mask[rows] & day_bit) > 0)]
+
+        # Per train, highest priority first and then latest start date
+        rows = rows[np.lexsort((-self._start_by_row[rows].astype(np.int64),
+                                -self._priority[rows],
+                                self._uid[rows]))]
+        _, first = np.unique(self._uid[rows], return_index=True)
+        rows = rows[first]
+
+        return np.sort(rows[~self._cancelled[rows]])
+
+    def effective_on(self, date) -> pd.DataFrame:
+        """Gets the schedules in effect on a date.
+
+        Args:
+            date (str or pd.Timestamp): the date of interest.
+
+        Returns:
+            pd.DataFrame: one row per train that runs on the date.
+        """
+        effective_df = self.schedules_df.iloc[self.effective_rows(date)]
+        logger.info(f"{len(effective_df)} trains run on "
+                    f"{pd.Timestamp(date).date()}")
+        return effective_df
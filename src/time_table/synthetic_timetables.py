@@ -0,0 +1,666 @@
+"""Writes synthetic train and bus timetables for benchmarking.
+
+The real timetables can't be shipped with the code and change every week,
+so parser and engine changes are measured on synthetic ones instead.
+`write_cif` writes an mca and an msn file, and `write_gtfs` writes a GTFS
+feed. They have the record layouts of the real files and roughly their
+mix of records: permanent schedules with overlays and cancellations of
+the same trains, passing points between stations, routes with many trips
+at different times, services with calendar_dates exceptions, duplicate
+trips, frequency based trips and times past midnight.
+
+The size of the timetables is set by a scale, where 1 is roughly the size
+of the national timetables. Records are built as arrays and written a
+chunk at a time, so full size timetables can be written without holding
+them in memory.
+"""
+# Core imports
+import os
+import zipfile
+import logging
+
+# Third party imports
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+# Module imports
+import time_table_utils as ttu
+
+# Create logger
+logger = logging.getLogger(__name__)
+
+# Rough sizes of the national timetables, at a scale of 1
+NATIONAL_CIF_SCHEDULES = 500_000
+NATIONAL_RAIL_STATIONS = 2_600
+NATIONAL_TIMING_POINTS = 10_000
+NATIONAL_RAIL_ROUTES = 1_500
+NATIONAL_BUS_TRIPS = 1_200_000
+NATIONAL_BUS_STOPS = 300_000
+NATIONAL_BUS_ROUTES = 20_000
+NATIONAL_BUS_AGENCIES = 900
+
+# Characters in a CIF record, without the newline
+CIF_LINE_LENGTH = 80
+
+# First date of the synthetic timetables
+TIMETABLE_START = np.datetime64("2023-05-20")
+
+# Days of the week patterns, and how often schedules and services run them
+DAY_PATTERNS = ["1111100", "0000010", "0000001", "1111110", "1111111",
+                "1000000", "0010000", "0000100", "0111100"]
+DAY_PATTERN_SHARES = [0.45, 0.15, 0.12, 0.1, 0.1, 0.02, 0.02, 0.02, 0.02]
+
+# Share of departures starting in each hour of the day, busiest at the
+# peaks, with a few after midnight
+HOUR_SHARES = np.array([1, 0.5, 0.3, 0.3, 0.5, 2, 5, 8, 9, 7, 6, 6,
+                        6, 6, 6, 7, 8, 9, 8, 6, 5, 4, 3, 2,
+                        1, 0.5])
+HOUR_SHARES = HOUR_SHARES / HOUR_SHARES.sum()
+
+
+def _scaled(national: int, scale: float, minimum: int) -> int:
+    """Scales a national count, keeping a minimum."""
+    return max(minimum, int(round(national * scale)))
+
+
+def _letter_codes(rng: np.random.Generator, n: int, width: int) -> np.ndarray:
+    """Makes unique random codes of capital letters, e.g. tiplocs."""
+    nums = rng.choice(26 ** width, size=n, replace=False)
+    chars = np.empty((n, width), dtype=np.uint8)
+    for i in range(width - 1, -1, -1):
+        chars[:, i] = ord("A") + nums % 26
+        nums = nums // 26
+    return chars.view(f"S{width}").ravel()
+
+
+def _departure_secs(rng: np.random.Generator, n: int,
+                    step: int = 30) -> np.ndarray:
+    """Draws departure times, in seconds, following `HOUR_SHARES`."""
+    hours = rng.choice(len(HOUR_SHARES), size=n, p=HOUR_SHARES)
+    return hours * 3600 + rng.integers(0, 3600 // step, size=n) * step
+
+
+def _day_patterns(rng: np.random.Generator, n: int) -> np.ndarray:
+    """Draws days of the week patterns, e.g. b"1111100"."""
+    return np.array(DAY_PATTERNS, dtype="S7")[
+        rng.choice(len(DAY_PATTERNS), size=n, p=DAY_PATTERN_SHARES)]
+
+
+def _blank_lines(n: int) -> np.ndarray:
+    """Makes n blank fixed width CIF lines, one row of bytes per line."""
+    lines = np.full((n, CIF_LINE_LENGTH + 1), ord(" "), dtype=np.uint8)
+    lines[:, -1] = ord("\n")
+    return lines
+
+
+def _put(lines: np.ndarray, col: int, values, width: int):
+    """Writes text values into a fixed width field of every line.
+
+    Args:
+        lines (np.ndarray): lines from `_blank_lines`.
+        col (int): position of the field in the line.
+        values (bytes or np.ndarray): one value, or one value per line.
+        width (int): number of characters in the field, values are padded
+            with spaces.
+    """
+    values = np.atleast_1d(np.asarray(values, dtype=f"S{width}"))
+    chars = values.view(np.uint8).reshape(-1, width)
+    lines[:, col:col + width] = np.where(chars == 0, ord(" "), chars)
+
+
+def _clock(secs: np.ndarray, half_minutes: bool = False) -> np.ndarray:
+    """Formats seconds as CIF HHMM clock times, with a trailing H for a
+    half minute if asked.
+
+    Returns:
+        np.ndarray: uint8 characters with one row per time.
+    """
+    secs = np.asarray(secs) % 86400
+    hours, minutes = secs // 3600, secs // 60 % 60
+    digits = [hours // 10, hours % 10, minutes // 10, minutes % 10]
+    chars = np.stack(digits, axis=1) + ord("0")
+    if half_minutes:
+        half = np.where(secs % 60 == 30, ord("H"), ord(" "))
+        chars = np.column_stack([chars, half])
+    return chars.astype(np.uint8)
+
+
+def _cif_dates(days: np.ndarray) -> np.ndarray:
+    """Formats datetime64[D] dates as CIF yymmdd."""
+    return (pd.DatetimeIndex(days).strftime("%y%m%d")
+            .to_numpy(dtype="S6"))
+
+
+def _rail_network(rng: np.random.Generator, scale: float) -> dict:
+    """Makes the timing points, stations and routes of a rail network.
+
+    The first timing points are the stations. Routes call at stations
+    and pass the other timing points, e.g. junctions.
+    """
+    n_points = _scaled(NATIONAL_TIMING_POINTS, scale, 50)
+    n_stations = _scaled(NATIONAL_RAIL_STATIONS, scale, 20)
+    n_routes = _scaled(NATIONAL_RAIL_ROUTES, scale, 5)
+
+    route_len = rng.integers(4, 30, size=n_routes)
+    route_start = np.cumsum(route_len) - route_len
+    # Roughly 60% of the points on a route are stations
+    is_station_call = rng.random(route_len.sum()) < 0.6
+    route_points = np.where(is_station_call,
+                            rng.integers(0, n_stations, route_len.sum()),
+                            rng.integers(n_stations, n_points,
+                                         route_len.sum()))
+    return {"tiplocs": _letter_codes(rng, n_points, 7),
+            "crs": _letter_codes(rng, n_stations, 3),
+            "n_stations": n_stations,
+            "route_len": route_len,
+            "route_start": route_start,
+            "route_points": route_points}
+
+
+def _mca_header(n_lines: int = 1) -> np.ndarray:
+    """Makes the HD header record."""
+    lines = _blank_lines(n_lines)
+    _put(lines, 0, b"HDTPS.UDFROC1.PD2305202305200000000DFTTISF467FA"
+         b"200523190524", CIF_LINE_LENGTH)
+    return lines
+
+
+def _tiploc_records(network: dict) -> np.ndarray:
+    """Makes a TI record for every timing point."""
+    tiplocs = network["tiplocs"]
+    n_stations = network["n_stations"]
+    lines = _blank_lines(len(tiplocs))
+    _put(lines, 0, b"TI", 2)
+    _put(lines, 2, tiplocs, 7)
+    _put(lines, 9, b"00", 2)
+    _put(lines, 11, np.char.zfill(
+        np.arange(len(tiplocs)).astype("S6"), 6), 6)
+    _put(lines, 18, np.char.add(b"SYNTHETIC ", tiplocs), 26)
+    crs = np.full(len(tiplocs), b"", dtype="S3")
+    crs[:n_stations] = network["crs"]
+    _put(lines, 53, crs, 3)
+    return lines
+
+
+def _schedule_records(rng: np.random.Generator,
+                      network: dict,
+                      n_schedules: int,
+                      first_uid: int,
+                      n_uids: int) -> np.ndarray:
+    """Makes the records of a chunk of schedules, in file order.
+
+    Cancellations are a BS record alone. Other schedules have a BS and a
+    BX record, then an LO, LI and LT record for each point on their route
+    and now and then a CR record.
+    """
+    stp = np.array([b"P", b"O", b"N", b"C"])[
+        rng.choice(4, size=n_schedules, p=[0.6, 0.2, 0.05, 0.15])]
+    # Overlays and cancellations change trains that have a schedule
+    uid_num = np.where(stp == b"P",
+                       first_uid + np.arange(n_schedules),
+                       rng.integers(0, max(n_uids, 1), size=n_schedules))
+    uid_letter = (ord("A") + uid_num // 100_000 % 26).astype(np.uint8)
+    uids = np.char.add(uid_letter.view("S1"),
+                       np.char.zfill((uid_num % 100_000).astype("S5"), 5))
+
+    # Permanent schedules run for months, the others for days
+    start = TIMETABLE_START + rng.integers(-180, 180, size=n_schedules)
+    days_run = np.where(stp == b"P",
+                        rng.integers(30, 365, size=n_schedules),
+                        rng.integers(0, 28, size=n_schedules))
+    end = start + days_run
+
+    bs = _blank_lines(n_schedules)
+    _put(bs, 0, b"BSN", 3)
+    _put(bs, 3, uids, 6)
+    _put(bs, 9, _cif_dates(start), 6)
+    _put(bs, 15, _cif_dates(end), 6)
+    _put(bs, 21, _day_patterns(rng, n_schedules), 7)
+    _put(bs, 29, b"POO2A01    122112000 EMU375 100", 31)
+    _put(bs, 66, b"S", 1)
+    _put(bs, 79, stp, 1)
+
+    # Points called at or passed by each schedule, with a run of one to
+    # six minutes, in half minutes, between each
+    route = rng.integers(0, len(network["route_len"]), size=n_schedules)
+    n_calls = np.where(stp == b"C", 0, network["route_len"][route])
+    call_sched = np.repeat(np.arange(n_schedules), n_calls)
+    first_call = np.cumsum(n_calls) - n_calls
+    call_num = np.arange(n_calls.sum()) - first_call[call_sched]
+    point = network["route_points"][
+        network["route_start"][route][call_sched] + call_num]
+    run = rng.integers(2, 13, size=len(call_sched)) * 30
+    run[call_num == 0] = 0
+    elapsed = np.cumsum(run)
+    elapsed -= (elapsed - run)[first_call[call_sched]]
+    times = _departure_secs(rng, n_schedules)[call_sched] + elapsed
+
+    is_lo = call_num == 0
+    is_lt = call_num == n_calls[call_sched] - 1
+    is_li = ~(is_lo | is_lt)
+    is_pass = is_li & (point >= network["n_stations"])
+    is_stop = is_li & ~is_pass
+
+    calls = _blank_lines(len(call_sched))
+    _put(calls, 0, np.select([is_lo, is_li], [b"LO", b"LI"], b"LT"), 2)
+    _put(calls, 2, network["tiplocs"][point], 8)
+    clock = _clock(times, half_minutes=True)
+    public = _clock(times + 30 * (times % 60 == 30))
+
+    # LO: departure, public departure, platform and activity
+    calls[is_lo, 10:15] = clock[is_lo]
+    calls[is_lo, 15:19] = public[is_lo]
+    calls[is_lo, 29:31] = np.frombuffer(b"TB", dtype=np.uint8)
+    # LI: arrival and departure, or a passing time, and activity
+    calls[is_stop, 10:15] = _clock(times[is_stop] - 30, half_minutes=True)
+    calls[is_stop, 15:20] = clock[is_stop]
+    calls[is_stop, 25:29] = public[is_stop]
+    calls[is_stop, 29:33] = public[is_stop]
+    activity = np.array([b"T ", b"T ", b"T ", b"T ", b"U ", b"D "])[
+        rng.integers(0, 6, size=is_stop.sum())]
+    calls[is_stop, 42:44] = activity.view(np.uint8).reshape(-1, 2)
+    calls[is_pass, 20:25] = clock[is_pass]
+    calls[is_pass, 25:33] = ord("0")
+    # LT: arrival, public arrival, platform and activity
+    calls[is_lt, 10:15] = clock[is_lt]
+    calls[is_lt, 15:19] = public[is_lt]
+    calls[is_lt, 19] = ord("1")
+    calls[is_lt, 25:27] = np.frombuffer(b"TF", dtype=np.uint8)
+
+    has_calls = n_calls > 0
+    bx = _blank_lines(has_calls.sum())
+    _put(bx, 0, b"BX         SWY", 14)
+
+    cr_rows = np.flatnonzero(is_stop & (rng.random(len(is_stop)) < 0.03))
+    cr = _blank_lines(len(cr_rows))
+    _put(cr, 0, b"CR", 2)
+    _put(cr, 2, network["tiplocs"][point[cr_rows]], 8)
+    _put(cr, 10, b"OO2A01    122112000 EMU375 100", 30)
+
+    # Order the records by schedule, then BS, BX, each call and any CR
+    # after its call
+    sched = np.concatenate([np.arange(n_schedules),
+                            np.flatnonzero(has_calls),
+                            call_sched,
+                            call_sched[cr_rows]])
+    order = np.concatenate([np.zeros(n_schedules, dtype=np.int64),
+                            np.ones(has_calls.sum(), dtype=np.int64),
+                            2 * (call_num + 1),
+                            2 * (call_num[cr_rows] + 1) + 1])
+    lines = np.concatenate([bs, bx, calls, cr])
+    return lines[np.lexsort((order, sched))]
+
+
+def _msn_records(rng: np.random.Generator, network: dict) -> np.ndarray:
+    """Makes an A record for every station, with a second tiploc for a
+    few stations and an L alias record for some."""
+    n_stations = network["n_stations"]
+    tiplocs = network["tiplocs"][:n_stations]
+    crs = network["crs"]
+
+    # Some stations have a second tiploc, taken from the timing points
+    n_extra = min(n_stations // 20,
+                  len(network["tiplocs"]) - n_stations)
+    extra = rng.choice(n_stations, size=n_extra, replace=False)
+    tiplocs = np.concatenate(
+        [tiplocs, network["tiplocs"][n_stations:n_stations + n_extra]])
+    crs = np.concatenate([crs, crs[extra]])
+    names = np.char.add(b"SYNTHETIC STATION ", crs)
+
+    a_records = _blank_lines(len(tiplocs))
+    _put(a_records, 0, b"A", 1)
+    _put(a_records, 5, names, 26)
+    _put(a_records, 35, b"1", 1)
+    _put(a_records, 36, tiplocs, 7)
+    _put(a_records, 43, crs, 3)
+    _put(a_records, 49, crs, 3)
+    _put(a_records, 52, np.char.zfill(
+        rng.integers(10_000, 16_600, len(tiplocs)).astype("S5"), 5), 5)
+    _put(a_records, 57, b"E", 1)
+    _put(a_records, 58, np.char.zfill(
+        rng.integers(60_000, 69_999, len(tiplocs)).astype("S5"), 5), 5)
+    _put(a_records, 63, b"05", 2)
+
+    aliased = rng.random(n_stations) < 0.1
+    l_records = _blank_lines(aliased.sum())
+    _put(l_records, 0, b"L", 1)
+    _put(l_records, 5, names[:n_stations][aliased], 26)
+    _put(l_records, 36, np.char.add(b"ALIAS ", crs[:n_stations][aliased]),
+         26)
+
+    header = _blank_lines(1)
+    _put(header, 0, b"A                             FILE-SPEC=05 1.00 "
+         b"20/05/23 18.02.25   467", CIF_LINE_LENGTH)
+    return np.concatenate([header, a_records, l_records])
+
+
+def write_cif(out_dir: str,
+              name: str = "synthetic",
+              scale: float = 0.01,
+              seed: int = 0,
+              chunk_size: int = 50_000) -> dict:
+    """Writes a synthetic CIF timetable: an mca and an msn file.
+
+    Args:
+        out_dir (str): folder to write the files to.
+        name (str, optional): file name without the extension. Defaults
+            to "synthetic".
+        scale (float, optional): size of the timetable, where 1 is roughly
+            the national timetable. Defaults to 0.01.
+        seed (int, optional): seed for the random numbers. Defaults to 0.
+        chunk_size (int, optional): schedules built at a time. Defaults to
+            50,000.
+
+    Returns:
+        dict: for "mca" and "msn", the path, bytes and records (lines) of
+            the file.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    network = _rail_network(rng, scale)
+    n_schedules = _scaled(NATIONAL_CIF_SCHEDULES, scale, 100)
+    n_uids = int(n_schedules * 0.6)
+
+    mca_path = os.path.join(out_dir, f"{name}.mca")
+    logger.info(f"Writing {n_schedules} schedules to {mca_path}")
+    n_lines = 0
+    with open(mca_path, "wb") as mca_file:
+        for lines in [_mca_header(), _tiploc_records(network)]:
+            mca_file.write(lines.tobytes())
+            n_lines += len(lines)
+        for first in range(0, n_schedules, chunk_size):
+            lines = _schedule_records(
+                rng, network, min(chunk_size, n_schedules - first),
+                first_uid=first, n_uids=max(first, n_uids // 10))
+            mca_file.write(lines.tobytes())
+            n_lines += len(lines)
+        trailer = _blank_lines(1)
+        _put(trailer, 0, b"ZZ", 2)
+        mca_file.write(trailer.tobytes())
+        n_lines += 1
+
+    msn_path = os.path.join(out_dir, f"{name}.msn")
+    msn_lines = _msn_records(rng, network)
+    with open(msn_path, "wb") as msn_file:
+        msn_file.write(msn_lines.tobytes())
+
+    return {"mca": {"path": mca_path,
+                    "bytes": os.path.getsize(mca_path),
+                    "records": n_lines},
+            "msn": {"path": msn_path,
+                    "bytes": os.path.getsize(msn_path),
+                    "records": len(msn_lines)}}
+
+
+def _gtfs_times(secs: np.ndarray) -> pa.Array:
+    """Formats seconds since midnight as GTFS HH:MM:SS times, past 24:00
+    after midnight."""
+    secs = np.asarray(secs)
+    hours, minutes, seconds = secs // 3600, secs // 60 % 60, secs % 60
+    digits = np.stack([hours // 10, hours % 10, minutes // 10, minutes % 10,
+                       seconds // 10, seconds % 10], axis=1) + ord("0")
+    chars = np.full((len(secs), 8), ord(":"), dtype=np.uint8)
+    chars[:, [0, 1, 3, 4, 6, 7]] = digits
+    return pa.array(chars.view("S8").ravel()).cast(pa.string())
+
+
+def _write_table(gtfs, file_nm: str, table: pa.Table):
+    """Writes a table to a GTFS zip or folder as a csv text file."""
+    write_options = pa_csv.WriteOptions(quoting_style="none")
+    if isinstance(gtfs, zipfile.ZipFile):
+        with gtfs.open(f"{file_nm}.txt", "w", force_zip64=True) as stream:
+            pa_csv.write_csv(table, stream, write_options=write_options)
+    else:
+        pa_csv.write_csv(table, os.path.join(gtfs, f"{file_nm}.txt"),
+                         write_options=write_options)
+
+
+def _bus_network(rng: np.random.Generator, scale: float) -> dict:
+    """Makes the stops, agencies, routes and services of a bus network.
+
+    Each route's stops are a walk along nearby stops, so routes share
+    stops, and each stop on a route has a fixed running time from the
+    first stop, so trips of a route at the same time are identical.
+    """
+    n_stops = _scaled(NATIONAL_BUS_STOPS, scale, 200)
+    n_routes = _scaled(NATIONAL_BUS_ROUTES, scale, 5)
+    n_agencies = _scaled(NATIONAL_BUS_AGENCIES, scale, 2)
+
+    route_len = rng.integers(8, 63, size=n_routes)
+    route_start = np.cumsum(route_len) - route_len
+    route_stop_num = np.arange(route_len.sum()) - np.repeat(route_start,
+                                                            route_len)
+    steps = rng.integers(1, 20, size=route_len.sum())
+    steps[route_stop_num == 0] = 0
+    walk = np.cumsum(steps)
+    walk -= np.repeat(walk[route_start], route_len)
+    route_stops = (np.repeat(rng.integers(0, n_stops, n_routes), route_len)
+                   + walk) % n_stops
+    run = rng.integers(30, 240, size=route_len.sum())
+    run[route_stop_num == 0] = 0
+    route_secs = np.cumsum(run)
+    route_secs -= np.repeat(route_secs[route_start], route_len)
+
+    # One to three services per route, e.g. weekdays and weekends
+    route_services = rng.integers(1, 4, size=n_routes)
+    n_services = route_services.sum()
+
+    stop_ids = np.char.add(
+        b"0", np.char.zfill(np.arange(n_stops).astype("S11"), 11))
+    return {"stop_ids": stop_ids,
+            "agency_ids": np.char.add(
+                b"OP", np.arange(n_agencies).astype("S6")),
+            "route_agency": rng.integers(0, n_agencies, size=n_routes),
+            "route_len": route_len,
+            "route_start": route_start,
+            "route_stops": route_stops,
+            "route_secs": route_secs,
+            "route_services": route_services,
+            "route_first_service": np.cumsum(route_services)
+            - route_services,
+            "service_days": _day_patterns(rng, n_services)}
+
+
+def _stop_times(network: dict,
+                trip_ids: pa.Array,
+                trip_route: np.ndarray,
+                trip_start: np.ndarray) -> pa.Table:
+    """Makes the stop_times of a chunk of trips."""
+    n_stops = network["route_len"][trip_route]
+    stop_trip = np.repeat(np.arange(len(trip_route)), n_stops)
+    stop_num = (np.arange(n_stops.sum())
+                - np.repeat(np.cumsum(n_stops) - n_stops, n_stops))
+    route_row = network["route_start"][trip_route][stop_trip] + stop_num
+    departure = trip_start[stop_trip] + network["route_secs"][route_row]
+    dwell = np.where(stop_num % 5 == 4, 30, 0)
+    last_stop = stop_num == n_stops[stop_trip] - 1
+
+    stop_ids = pa.array(network["stop_ids"]).cast(pa.string())
+    return pa.table({
+        "trip_id": trip_ids.take(pa.array(stop_trip)),
+        "arrival_time": _gtfs_times(departure - dwell),
+        "departure_time": _gtfs_times(departure),
+        "stop_id": stop_ids.take(pa.array(network["route_stops"][route_row])),
+        "stop_sequence": pa.array(stop_num + 1),
+        "stop_headsign": pa.nulls(len(stop_trip), pa.string()),
+        "pickup_type": pa.array(np.where(last_stop, 1, 0)),
+        "drop_off_type": pa.array(np.where(stop_num == 0, 1, 0)),
+        "shape_dist_traveled": pa.nulls(len(stop_trip), pa.string()),
+        "timepoint": pa.array(np.where(stop_num % 5 == 0, 1, 0))})
+
+
+def write_gtfs(gtfs_path: str,
+               scale: float = 0.01,
+               seed: int = 0,
+               as_zip: bool = True,
+               frequency_share: float = 0.01,
+               duplicate_share: float = 0.02,
+               chunk_size: int = 100_000) -> dict:
+    """Writes a synthetic GTFS timetable.
+
+    Writes agency, stops, routes, trips, calendar, calendar_dates,
+    frequencies and stop_times.
+
+    Args:
+        gtfs_path (str): path of the GTFS zip, or of the folder to write
+            the text files to.
+        scale (float, optional): size of the timetable, where 1 is roughly
+            the national timetable. Defaults to 0.01.
+        seed (int, optional): seed for the random numbers. Defaults to 0.
+        as_zip (bool, optional): write a zip, as downloaded, rather than a
+            folder. Defaults to True.
+        frequency_share (float, optional): share of trips that are
+            frequency based. Defaults to 0.01.
+        duplicate_share (float, optional): share of trips that repeat
+            another trip under a different trip_id. Defaults to 0.02.
+        chunk_size (int, optional): trips whose stop_times are built at a
+            time. Defaults to 100,000.
+
+    Returns:
+        dict: for "gtfs" the path and bytes of the zip or folder, and for
+            "stop_times" the bytes and records (rows) of stop_times.txt.
+    """
+    rng = np.random.default_rng(seed)
+    network = _bus_network(rng, scale)
+    n_trips = _scaled(NATIONAL_BUS_TRIPS, scale, 100)
+    n_routes = len(network["route_len"])
+    n_services = len(network["service_days"])
+
+    # Trips, with the last ones repeating earlier trips
+    trip_route = rng.integers(0, n_routes, size=n_trips)
+    trip_service = (network["route_first_service"][trip_route]
+                    + rng.integers(0, network["route_services"][trip_route]))
+    trip_start = _departure_secs(rng, n_trips, step=60)
+    n_duplicates = int(n_trips * duplicate_share)
+    if n_duplicates:
+        copied = rng.integers(0, n_trips - n_duplicates, size=n_duplicates)
+        for col in [trip_route, trip_service, trip_start]:
+            col[-n_duplicates:] = col[copied]
+    trip_ids = pa.array(np.char.add(
+        b"VJ", np.char.zfill(np.arange(n_trips).astype("S9"), 9))
+    ).cast(pa.string())
+
+    # Services run from the start of the timetable for months, and a few
+    # have dates added or removed
+    service_ids = pa.array(np.char.add(
+        b"SV", np.arange(n_services).astype("S8"))).cast(pa.string())
+    service_start = TIMETABLE_START - rng.integers(0, 60, size=n_services)
+    service_end = service_start + rng.integers(90, 365, size=n_services)
+    days = network["service_days"].view(np.uint8).reshape(-1, 7) - ord("0")
+    calendar = pa.table({
+        "service_id": service_ids,
+        **{day: pa.array(days[:, i]) for i, day in enumerate(ttu.DAY_COLS)},
+        "start_date": pd.DatetimeIndex(service_start).strftime("%Y%m%d"),
+        "end_date": pd.DatetimeIndex(service_end).strftime("%Y%m%d")})
+    exception_service = rng.choice(n_services, size=n_services // 5)
+    calendar_dates = pa.table({
+        "service_id": service_ids.take(pa.array(exception_service)),
+        "date": pd.DatetimeIndex(
+            service_start[exception_service]
+            + rng.integers(0, 90, size=len(exception_service)))
+        .strftime("%Y%m%d"),
+        "exception_type": pa.array(
+            rng.choice([1, 2], size=len(exception_service), p=[0.3, 0.7]))})
+
+    # Frequency based trips run from their start time every 10 to 30
+    # minutes, for 2 to 6 hours
+    frequency_trips = rng.choice(n_trips - n_duplicates,
+                                 size=int(n_trips * frequency_share),
+                                 replace=False)
+    frequency_start = trip_start[frequency_trips]
+    frequencies = pa.table({
+        "trip_id": trip_ids.take(pa.array(frequency_trips)),
+        "start_time": _gtfs_times(frequency_start),
+        "end_time": _gtfs_times(
+            frequency_start
+            + rng.integers(2, 7, size=len(frequency_trips)) * 3600),
+        "headway_secs": pa.array(
+            rng.integers(1, 4, size=len(frequency_trips)) * 600),
+        "exact_times": pa.array(np.zeros(len(frequency_trips), dtype=int))})
+
+    n_stops = len(network["stop_ids"])
+    stop_ids = pa.array(network["stop_ids"]).cast(pa.string())
+    route_ids = pa.array(np.char.add(
+        b"RT", np.arange(n_routes).astype("S8"))).cast(pa.string())
+    agency_ids = pa.array(network["agency_ids"]).cast(pa.string())
+    tables = {
+        "agency": pa.table({
+            "agency_id": agency_ids,
+            "agency_name": pa.compute.binary_join_element_wise(
+                "Synthetic operator ", agency_ids, ""),
+            "agency_url": pa.array(["https://www.example.com"]
+                                   * len(agency_ids)),
+            "agency_timezone": pa.array(["Europe/London"]
+                                        * len(agency_ids))}),
+        "stops": pa.table({
+            "stop_id": stop_ids,
+            "stop_name": pa.compute.binary_join_element_wise(
+                "Stop ", stop_ids, ""),
+            "stop_lat": pa.array(rng.uniform(50.0, 55.8, n_stops)),
+            "stop_lon": pa.array(rng.uniform(-5.7, 1.7, n_stops))}),
+        "routes": pa.table({
+            "route_id": route_ids,
+            "agency_id": agency_ids.take(pa.array(network["route_agency"])),
+            "route_short_name": pa.array(np.arange(n_routes) % 999 + 1),
+            "route_type": pa.array(np.full(n_routes, 3))}),
+        "trips": pa.table({
+            "route_id": route_ids.take(pa.array(trip_route)),
+            "service_id": service_ids.take(pa.array(trip_service)),
+            "trip_id": trip_ids,
+            "trip_headsign": pa.nulls(n_trips, pa.string()),
+            "block_id": pa.nulls(n_trips, pa.string()),
+            "wheelchair_accessible": pa.array(np.zeros(n_trips, dtype=int)),
+            "vehicle_journey_code": trip_ids}),
+        "calendar": calendar,
+        "calendar_dates": calendar_dates,
+        "frequencies": frequencies}
+
+    logger.info(f"Writing {n_trips} trips to {gtfs_path}")
+    if as_zip:
+        gtfs = zipfile.ZipFile(gtfs_path, "w",
+                               compression=zipfile.ZIP_DEFLATED,
+                               compresslevel=1)
+    else:
+        os.makedirs(gtfs_path, exist_ok=True)
+        gtfs = gtfs_path
+    try:
+        for file_nm, table in tables.items():
+            _write_table(gtfs, file_nm, table)
+
+        n_stop_times = 0
+        write_options = pa_csv.WriteOptions(quoting_style="none")
+        if as_zip:
+            stream = gtfs.open("stop_times.txt", "w", force_zip64=True)
+        else:
+            stream = open(os.path.join(gtfs_path, "stop_times.txt"), "wb")
+        with stream:
+            writer = None
+            for first in range(0, n_trips, chunk_size):
+                rows = slice(first, min(first + chunk_size, n_trips))
+                table = _stop_times(network, trip_ids[rows],
+                                    trip_route[rows], trip_start[rows])
+                if writer is None:
+                    writer = pa_csv.CSVWriter(stream, table.schema,
+                                              write_options=write_options)
+                writer.write_table(table)
+                n_stop_times += table.num_rows
+            writer.close()
+    finally:
+        if as_zip:
+            gtfs.close()
+
+    if as_zip:
+        with zipfile.ZipFile(gtfs_path) as gtfs_zip:
+            stop_times_bytes = gtfs_zip.getinfo("stop_times.txt").file_size
+        gtfs_bytes = os.path.getsize(gtfs_path)
+    else:
+        stop_times_bytes = os.path.getsize(
+            os.path.join(gtfs_path, "stop_times.txt"))
+        gtfs_bytes = sum(entry.stat().st_size
+                         for entry in os.scandir(gtfs_path))
+
+    return {"gtfs": {"path": gtfs_path, "bytes": gtfs_bytes},
+            "stop_times": {"bytes": stop_times_bytes,
+                           "records": n_stop_times}}
@@ -1,12 +1,32 @@
 """All functions realted to the bus and train timetable data."""
 
 import logging
+import mmap
+import os
+import zipfile
+import numpy as np
 import pandas as pd
-from typing import List, Tuple
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from pandas.api.types import union_categoricals
+from typing import Dict, List, Tuple
 
 # Create logger
 logger = logging.getLogger(__name__)
 
+# Bytes of csv parsed per record batch when streaming GTFS files
+CSV_BLOCK_SIZE = 64 * 1024 * 1024
+
+# Day columns of the timetables, in weekday order from Monday
+DAY_COLS = ["monday", "tuesday", "wednesday", "thursday",
+            "friday", "saturday", "sunday"]
+
+# Bit of each day when the days a trip runs are packed into one byte
+DAY_BITS = (1 << np.arange(7)).astype(np.uint8)
+
 
 def filter_stops(stops_df: pd.DataFrame) -> pd.DataFrame:
     """Filters the stops dataframe based on two things:
@@ -70,38 +90,427 @@ def add_stop_capacity_type(stops_df: pd.DataFrame) -> pd.DataFrame:
     return stops_df
 
 
-def filter_timetable_by_day(timetable_df: pd.DataFrame,
-                            day: str) -> pd.DataFrame:
-    """Extract serviced stops based on specific day of the week.
+@contextmanager
+def open_gtfs_file(gtfs_path: str, file_nm: str):
+    """Opens a GTFS text file as a binary stream.
 
-    The day is selected from the available days in the date range present in
-      timetable data.
+    If `gtfs_path` is the downloaded GTFS zip the file is decompressed as
+    it is read, so nothing is extracted to disk. Otherwise `gtfs_path` is
+    taken to be a folder of extracted text files.
+
+    Args:
+        gtfs_path (str): path to the GTFS zip, or to a folder of the
+            extracted files.
+        file_nm (str): name of the file without the extension,
+            e.g. "stop_times".
+
+    Yields:
+        file-like: binary stream of the file.
+    """
+    txt_nm = f"{file_nm}.txt"
+    if zipfile.is_zipfile(gtfs_path):
+        with zipfile.ZipFile(gtfs_path) as gtfs_zip:
+            logger.info(f"Reading {txt_nm} from {gtfs_path}")
+            with gtfs_zip.open(txt_nm) as stream:
+                yield stream
+    else:
+        with open(os.path.join(gtfs_path, txt_nm), "rb") as stream:
+            yield stream
+
+
+def read_gtfs_table(gtfs_path: str,
+                    file_nm: str,
+                    dtypes: Dict) -> pd.DataFrame:
+    """Reads the columns needed from a GTFS text file.
+
+    Args:
+        gtfs_path (str): path to the GTFS zip, or to a folder of the
+            extracted files.
+        file_nm (str): name of the file without the extension,
+            e.g. "trips".
+        dtypes (Dict): datatypes of the columns to keep.
+
+    Returns:
+        pd.DataFrame: the columns in `dtypes`.
+    """
+    with open_gtfs_file(gtfs_path, file_nm) as stream:
+        return pd.read_csv(stream, usecols=list(dtypes.keys()),
+                           dtype=dtypes, encoding_errors="ignore")
+
+
+def gtfs_times_to_seconds(times) -> pa.Array:
+    """Converts GTFS H:MM:SS times to seconds since midnight.
+
+    GTFS times are measured from noon minus 12 hours on the service day,
+    so trips running after midnight have times of 24:00:00 and later.
+    These are kept as they are, e.g. 25:10:00 is 90600 seconds, so the
+    times stay in order within a trip and fall outside any hour window
+    within the service day.
+
+    Args:
+        times (pa.Array or array-like of str): the times.
+
+    Returns:
+        pa.Array: int32 seconds, null where the time is missing or not in
+            H:MM:SS or HH:MM:SS format.
+    """
+    parts = pc.extract_regex(
+        pa.array(times, type=pa.string()),
+        r"^\s*(?P<h>\d{1,2}):(?P<m>\d{2}):(?P<s>\d{2})\s*$")
+    hours, minutes, seconds = [
+        pc.cast(pc.struct_field(parts, name), pa.int32())
+        for name in ["h", "m", "s"]]
+    return pc.add(pc.add(pc.multiply(hours, 3600),
+                         pc.multiply(minutes, 60)),
+                  seconds)
+
+
+def read_stop_times(source,
+                    early_hour: int,
+                    late_hour: int,
+                    block_size: int = CSV_BLOCK_SIZE,
+                    keep_trip_ids=None) -> pd.DataFrame:
+    """Streams the GTFS stop_times file, keeping stops in the hour window.
+
+    The file is parsed in Arrow record batches. Departure times are
+    converted to seconds since midnight and the rows outside the window
+    are dropped from each batch before the next is read, so memory use
+    depends on the batch size and the rows kept, rather than on the size
+    of the file. Departure times past 24:00, and missing departure times,
+    fall outside the window.
+
+    Args:
+        source (str or file-like): path to stop_times.txt, or an open
+            binary stream of it.
+        early_hour (int): first hour of the window, e.g. 6.
+        late_hour (int): hour the window ends, not included, e.g. 20.
+        block_size (int, optional): bytes of csv per record batch.
+            Defaults to CSV_BLOCK_SIZE.
+        keep_trip_ids (array-like, optional): trips to keep every stop with
+            a departure time of, in or out of the window, e.g. the template
+            trips in frequencies.txt.
+
+    Returns:
+        pd.DataFrame: trip_id and stop_id (categorical) and the departure
+            time in int32 seconds since midnight of each stop in the
+            window.
+    """
+    cols = ["trip_id", "stop_id", "departure_time"]
+    reader = pa_csv.open_csv(
+        source,
+        read_options=pa_csv.ReadOptions(block_size=block_size),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=cols,
+            column_types={col: pa.string() for col in cols},
+            strings_can_be_null=True))
+
+    schema = pa.schema([("trip_id", pa.string()),
+                        ("stop_id", pa.string()),
+                        ("departure_time", pa.int32())])
+    if keep_trip_ids is not None:
+        keep_trip_ids = pa.array(np.asarray(keep_trip_ids, dtype=str))
+    rows_read = 0
+    batches = []
+    for batch in reader:
+        rows_read += batch.num_rows
+        departure = gtfs_times_to_seconds(batch.column("departure_time"))
+        in_window = pc.and_(pc.greater_equal(departure, early_hour * 3600),
+                            pc.less(departure, late_hour * 3600))
+        if keep_trip_ids is not None:
+            kept_trip = pc.and_(
+                pc.is_in(batch.column("trip_id"), value_set=keep_trip_ids),
+                pc.is_valid(departure))
+            in_window = pc.or_(in_window, kept_trip)
+        batches.append(
+            pa.record_batch([batch.column("trip_id"),
+                             batch.column("stop_id"),
+                             departure],
+                            schema=schema)
+            .filter(in_window))
+
+    stop_times_df = (pa.Table.from_batches(batches, schema=schema)
+                     .to_pandas(strings_to_categorical=True))
+    logger.info(f"Kept {len(stop_times_df)} of {rows_read} stop times "
+                f"departing between {early_hour}:00 and {late_hour}:00")
+    return stop_times_df
+
+
+def read_frequencies(gtfs_path: str) -> pd.DataFrame:
+    """Reads the GTFS frequencies file, if the timetable has one.
+
+    Args:
+        gtfs_path (str): path to the GTFS zip, or to a folder of the
+            extracted files.
+
+    Returns:
+        pd.DataFrame: trip_id, and start_time and end_time in seconds since
+            midnight and headway_secs of each frequency window, without
+            the windows with missing or invalid values. None when there is
+            no frequencies file.
+    """
+    frequency_types = {"trip_id": "object",
+                       "start_time": "object",
+                       "end_time": "object",
+                       "headway_secs": "float64"}
+    try:
+        frequencies_df = read_gtfs_table(gtfs_path, "frequencies",
+                                         frequency_types)
+    except (KeyError, FileNotFoundError):
+        return None
+
+    for col in ["start_time", "end_time"]:
+        frequencies_df[col] = (
+            gtfs_times_to_seconds(frequencies_df[col].astype(str))
+            .to_numpy(zero_copy_only=False))
+    frequencies_df = frequencies_df.dropna()
+    frequencies_df = frequencies_df[
+        (frequencies_df["headway_secs"] > 0)
+        & (frequencies_df["end_time"] > frequencies_df["start_time"])]
+    return frequencies_df.astype({"start_time": np.int64,
+                                  "end_time": np.int64,
+                                  "headway_secs": np.int64})
+
+
+def expand_frequencies(stop_times_df: pd.DataFrame,
+                       frequencies_df: pd.DataFrame,
+                       early_hour: int,
+                       late_hour: int) -> pd.DataFrame:
+    """Expands trips in frequencies.txt into a departure per journey.
+
+    The stop times of a frequency based trip are a template, with times
+    relative to the trip's first departure. Each frequency window runs a
+    journey from start_time every headway_secs until end_time. The start
+    of every journey, and then every stop of every journey, are built with
+    repeat and arange rather than a loop over trips. The journeys keep the
+    template's trip_id, so each stop still links to the trip's service.
+
+    Args:
+        stop_times_df (pd.DataFrame): stop times from `read_stop_times`,
+            with every stop of the template trips kept.
+        frequencies_df (pd.DataFrame): windows from `read_frequencies`.
+        early_hour (int): first hour of the window kept.
+        late_hour (int): hour the window ends, not included.
+
+    Returns:
+        pd.DataFrame: the stop times of the other trips, and the stops of
+            every journey of the frequency based trips, in the window.
+    """
+    is_template = stop_times_df["trip_id"].isin(
+        frequencies_df["trip_id"]).to_numpy()
+    template_df = stop_times_df[is_template]
+    stop_times_df = stop_times_df[~is_template]
+
+    # Template stops of each trip, and their times from its first departure
+    template_df = template_df.sort_values("trip_id", kind="stable")
+    template_trips = pd.Index(template_df["trip_id"].unique())
+    trip_codes = template_trips.get_indexer(template_df["trip_id"])
+    departure = template_df["departure_time"].to_numpy(np.int64)
+    first_departure = np.full(len(template_trips), np.iinfo(np.int64).max)
+    np.minimum.at(first_departure, trip_codes, departure)
+    offset = departure - first_departure[trip_codes]
+    trip_starts = np.searchsorted(trip_codes, np.arange(len(template_trips)))
+    trip_stops = np.bincount(trip_codes, minlength=len(template_trips))
+
+    # Start of every journey in each window, start inclusive, end exclusive
+    frequencies_df = frequencies_df[
+        frequencies_df["trip_id"].isin(template_trips)]
+    window_trip = template_trips.get_indexer(frequencies_df["trip_id"])
+    start = frequencies_df["start_time"].to_numpy(np.int64)
+    headway = frequencies_df["headway_secs"].to_numpy(np.int64)
+    journeys = -(-(frequencies_df["end_time"].to_numpy(np.int64) - start)
+                 // headway)
+    journey_window = np.repeat(np.arange(len(start)), journeys)
+    journey_num = (np.arange(journeys.sum())
+                   - np.repeat(np.cumsum(journeys) - journeys, journeys))
+    journey_start = (start[journey_window]
+                     + journey_num * headway[journey_window])
+    journey_trip = window_trip[journey_window]
+
+    # Every template stop of every journey
+    stops = trip_stops[journey_trip]
+    stop_journey = np.repeat(np.arange(len(journey_start)), stops)
+    stop_num = (np.arange(stops.sum())
+                - np.repeat(np.cumsum(stops) - stops, stops))
+    template_row = trip_starts[journey_trip][stop_journey] + stop_num
+
+    expanded_df = template_df.iloc[template_row].reset_index(drop=True)
+    expanded_df["departure_time"] = (
+        journey_start[stop_journey] + offset[template_row]).astype(np.int32)
+    expanded_df = expanded_df[
+        (expanded_df["departure_time"] >= early_hour * 3600)
+        & (expanded_df["departure_time"] < late_hour * 3600)]
+
+    logger.info(f"Expanded {len(template_trips)} frequency based trips "
+                f"into {len(journey_start)} journeys")
+    return pd.concat([stop_times_df, expanded_df], ignore_index=True)
+
+
+def trip_service_rows(trip_ids: pd.Series,
+                      trips_df: pd.DataFrame,
+                      service_ids) -> np.ndarray:
+    """Finds the row of the service that runs each stop's trip.
+
+    Replaces merging stop_times, trips and calendar. The trip ids are
+    factorized into integer codes, each code is looked up once in trips
+    and then in the services, and the result is gathered back to the
+    stops with the codes. The wide merged dataframe is never built.
+
+    Args:
+        trip_ids (pd.Series): trip_id of each stop, ideally categorical.
+        trips_df (pd.DataFrame): trips with trip_id and service_id.
+        service_ids (array-like): unique service ids, e.g. the service_id
+            column of calendar or `ServiceCalendar.service_ids`.
+
+    Returns:
+        np.ndarray: position in `service_ids` of the service for each stop,
+            -1 where the trip or its service is not found.
+    """
+    # GTFS ids should be unique, keep the first as a merge would
+    # otherwise duplicate stops
+    trips_df = trips_df.drop_duplicates(subset=["trip_id"])
+
+    trip_codes, trip_uniques = pd.factorize(trip_ids)
+    trip_row = pd.Index(trips_df["trip_id"]).get_indexer(trip_uniques)
+    service_row = (pd.Index(service_ids)
+                   .get_indexer(trips_df["service_id"].astype(str)))
+
+    # Service of each unique trip, then of each stop. -1 indexes the
+    # appended -1 so missing trips stay missing
+    trip_service = np.append(service_row, -1)[trip_row]
+    return np.append(trip_service, -1)[trip_codes]
+
+
+def rows_running(service_rows: np.ndarray,
+                 service_runs: np.ndarray) -> np.ndarray:
+    """Gathers whether each stop's service runs from a per-service mask.
+
+    Args:
+        service_rows (np.ndarray): service row of each stop, as returned
+            by `trip_service_rows`.
+        service_runs (np.ndarray): bool for each service.
+
+    Returns:
+        np.ndarray: bool for each stop, False where the service is missing.
+    """
+    return np.append(np.asarray(service_runs, dtype=bool), False)[service_rows]
+
+
+def day_bits(day_flags: np.ndarray) -> np.ndarray:
+    """Packs day of the week flags into one byte per row.
+
+    Args:
+        day_flags (np.ndarray): 0/1 with a column for each day of the week
+            from Monday.
+
+    Returns:
+        np.ndarray: uint8 with the bits in `DAY_BITS` set for each day.
+    """
+    flags = np.asarray(day_flags) == 1
+    return (flags @ DAY_BITS.astype(np.int64)).astype(np.uint8)
+
+
+def trip_hashes(trip_codes: np.ndarray,
+                stop_ids: pd.Series,
+                departure_secs: pd.Series,
+                trip_days: np.ndarray) -> np.ndarray:
+    """Hashes the content of each trip.
+
+    Each departure is hashed from its stop and time. The departure hashes
+    are summed per trip, so the order of the rows does not matter, and
+    combined with the days the trip runs.
+
+    Args:
+        trip_codes (np.ndarray): trip of each departure, as codes from 0 to
+            the number of trips.
+        stop_ids (pd.Series): stop of each departure.
+        departure_secs (pd.Series): departure times in seconds since
+            midnight.
+        trip_days (np.ndarray): days of the week each trip runs, as bits
+            from `DAY_BITS`.
+
+    Returns:
+        np.ndarray: uint64 hash of each trip.
+    """
+    departure_hashes = pd.util.hash_pandas_object(
+        pd.DataFrame({"stop_id": np.asarray(stop_ids),
+                      "departure_time": np.asarray(departure_secs)}),
+        index=False).to_numpy()
+
+    # Sum per trip, wrapping round on overflow
+    order = np.argsort(trip_codes, kind="stable")
+    trip_starts = np.searchsorted(trip_codes[order],
+                                  np.arange(len(trip_days)))
+    departure_sums = np.add.reduceat(departure_hashes[order], trip_starts)
+
+    return pd.util.hash_pandas_object(
+        pd.DataFrame({"departures": departure_sums, "days": trip_days}),
+        index=False).to_numpy()
+
+
+def duplicate_trip_rows(trip_ids: pd.Series,
+                        stop_ids: pd.Series,
+                        departure_secs: pd.Series,
+                        row_days: np.ndarray = None) -> np.ndarray:
+    """Finds the stops of trips that repeat an earlier trip.
+
+    Aggregated feeds can publish the same journey more than once, e.g. by
+    several operators or under overlapping services. Each trip is hashed
+    from its stops, departure times and days with `trip_hashes`, and only
+    the first trip with each hash is kept.
+
+    Trips are matched on the days of the week they run, not their dates.
+    For a single date, filter the stops to the services running on it
+    first and leave out `row_days`, so the trip kept is one that runs.
+
+    Args:
+        trip_ids (pd.Series): trip of each stop.
+        stop_ids (pd.Series): stop_id of each stop.
+        departure_secs (pd.Series): departure times in seconds since
+            midnight.
+        row_days (np.ndarray, optional): days of the week the trip runs,
+            as bits from `DAY_BITS`, for each stop. Defaults to matching
+            trips on their stops and times alone.
+
+    Returns:
+        np.ndarray: bool for each stop, True where its trip is a duplicate.
+    """
+    if len(trip_ids) == 0:
+        return np.zeros(0, dtype=bool)
+
+    trip_codes, trip_uniques = pd.factorize(trip_ids)
+    trip_days = np.zeros(len(trip_uniques), dtype=np.uint8)
+    if row_days is not None:
+        trip_days[trip_codes] = row_days
+
+    fingerprints = trip_hashes(trip_codes, stop_ids,
+                               departure_secs, trip_days)
+    duplicate_trips = pd.Series(fingerprints).duplicated().to_numpy()
+    logger.info(f"{duplicate_trips.sum()} of {len(duplicate_trips)} trips "
+                "are duplicates")
+    return duplicate_trips[trip_codes]
+
+
+def select_date_for_day(earliest_start_date,
+                        latest_end_date,
+                        day: str):
+    """Selects a date for a day of the week within the timetable date range.
 
     1) identifies which days dates in the entire date range
     2) counts days of each type to get the maximum position order
     3) validates user's choice for `day` - provides useful errors
     4) creates ord value that is half of maximum position order to ensure
     as many services get included as possible.
-    4) selects a date based on the day and ord parameters
-    5) filters the dataframe to that date
+    5) selects a date based on the day and ord parameters
 
     Args:
-        timetable_df (pandas dataframe): df to filter
+        earliest_start_date (pd.Timestamp): start of the date range.
+        latest_end_date (pd.Timestamp): end of the date range.
         day (str) : day of the week in title case, e.g. "Wednesday"
 
     Returns:
-        pd.DataFrame: filtered pandas dataframe
+        Tuple[pd.Timestamp, int]: the date, and which occurrence of the day
+            in the range it is.
     """
-    # Measure the dataframe
-    original_rows = timetable_df.shape[0]
-
-    # Count the services
-    orig_service_count = timetable_df.service_id.unique().shape[0]
-
-    # Get the minimum date range
-    earliest_start_date = timetable_df.start_date.min()
-    latest_end_date = timetable_df.end_date.max()
-
     # Identify days in the range and count them
     date_range = pd.date_range(earliest_start_date, latest_end_date)
     date_day_couplings_df = pd.DataFrame({"date": date_range,
@@ -124,16 +533,35 @@ def filter_timetable_by_day(timetable_df: pd.DataFrame,
 
     # Get date of the nth (ord) day
     nth = ord - 1
-    date_of_day_entered = day_filtered_dates.iloc[nth].date
+    return day_filtered_dates.iloc[nth].date, ord
 
-    # Filter the timetable_df by date range
-    timetable_df = timetable_df[(timetable_df['start_date']
-                                 <= date_of_day_entered) &
-                                (timetable_df['end_date']
-                                 >= date_of_day_entered)]
 
-    # Then filter to day of interest
-    timetable_df = timetable_df[timetable_df[day.lower()] == 1]
+def filter_timetable_by_day(timetable_df: pd.DataFrame,
+                            day: str) -> pd.DataFrame:
+    """Extract serviced stops based on specific day of the week.
+
+    The day is selected from the available days in the date range present in
+      timetable data.
+
+    1) selects a date for the day with `select_date_for_day`
+    2) filters the dataframe to that date
+
+    Args:
+        timetable_df (pandas dataframe): df to filter
+        day (str) : day of the week in title case, e.g. "Wednesday"
+
+    Returns:
+        pd.DataFrame: filtered pandas dataframe
+    """
+    # Measure the dataframe
+    original_rows = timetable_df.shape[0]
+
+    # Count the services
+    orig_service_count = timetable_df.service_id.unique().shape[0]
+
+    # Pick a date for the day from the date range
+    date_of_day_entered, ord = select_date_for_day(
+        timetable_df.start_date.min(), timetable_df.end_date.max(), day)
 
     # Filter the timetable_df by date range
     timetable_df = timetable_df[(timetable_df['start_date']
@@ -144,21 +572,21 @@ def filter_timetable_by_day(timetable_df: pd.DataFrame,
     # Then filter to day of interest
     timetable_df = timetable_df[timetable_df[day.lower()] == 1]
 
-    # Print date being used (consider logging instead)
+    # Log date being used
     day_date = date_of_day_entered.date()
-    logger(f"The date of {day} number {ord} is {day_date}")
+    logger.info(f"The date of {day} number {ord} is {day_date}")
 
-    # Print how many rows have been dropped (consider logging instead)
-    logger(
-        f"Selecting only services covering {day_date} reduced records"
+    # Log how many rows have been dropped
+    logger.info(
+        f"Selecting only services covering {day_date} reduced records "
         f"by {original_rows-timetable_df.shape[0]} rows"
     )
 
-    # Print how many services are in the analysis and how many were dropped
+    # Log how many services are in the analysis and how many were dropped
     service_count = timetable_df.service_id.unique().shape[0]
     dropped_services = orig_service_count - service_count
-    logger(f"There are {service_count} services in the analysis")
-    logger(f"Filtering by day has reduced services by {dropped_services}")
+    logger.info(f"There are {service_count} services in the analysis")
+    logger.info(f"Filtering by day has reduced services by {dropped_services}")
 
     return timetable_df
 
@@ -200,8 +628,310 @@ def extract_msn_data(msn_file: str) -> List[List]:
     return msn_data_lst
 
 
-# add type hints
-def extract_mca(mca_file: str) -> Tuple[List[List], List[List]]:
+def field_bytes(buf: np.ndarray,
+                starts: np.ndarray,
+                offsets,
+                width: int) -> np.ndarray:
+    """Slices a fixed-width field out of many lines of a byte buffer.
+
+    Args:
+        buf (np.ndarray): the file as a uint8 array.
+        starts (np.ndarray): byte offset of the start of each line.
+        offsets (int or np.ndarray): position of the field in the line,
+            either the same for every line or one per line.
+        width (int): number of characters in the field.
+
+    Returns:
+        np.ndarray: bytes array (dtype "S{width}") with one value per line.
+    """
+    idx = (starts + offsets)[:, None] + np.arange(width)
+    # Guard against a short final line without a newline
+    np.clip(idx, 0, len(buf) - 1, out=idx)
+    return np.ascontiguousarray(buf[idx]).view(f"S{width}").ravel()
+
+
+def _decode(field: np.ndarray) -> np.ndarray:
+    """Strips the padding from a bytes field and converts it to str."""
+    return np.char.strip(field).astype(str)
+
+
+def _categorical(field: np.ndarray) -> pd.Categorical:
+    """Converts a bytes field with many repeated values to a categorical.
+
+    The field is read as 8 byte integer words so it can be factorized by
+    hashing, and only the unique values are decoded. This is much quicker
+    than decoding every row for fields such as the tiploc code.
+    """
+    width = field.dtype.itemsize
+    n_words = -(-width // 8)
+    padded = np.zeros((len(field), n_words * 8), dtype=np.uint8)
+    padded[:, :width] = field.view(np.uint8).reshape(-1, width)
+    words = padded.view(np.uint64)
+
+    # Combine the codes of each word in turn, factorizing again each time
+    # so that the combined code cannot overflow
+    codes = np.zeros(len(field), dtype=np.int64)
+    for i in range(n_words):
+        word_codes, word_uniques = pd.factorize(words[:, i])
+        codes, _ = pd.factorize(codes * len(word_uniques) + word_codes)
+
+    # Codes are numbered in order of first appearance. Values which only
+    # differ by padding are the same once stripped, so factorize again
+    _, first_row = np.unique(codes, return_index=True)
+    value_codes, values = pd.factorize(_decode(field[first_row]))
+    return pd.Categorical.from_codes(value_codes[codes], values)
+
+
+def _cif_dates(field: np.ndarray) -> np.ndarray:
+    """Converts a yymmdd bytes field to datetime64[ns]."""
+    return (pd.to_datetime(_decode(field), format="%y%m%d")
+            .to_numpy(dtype="datetime64[ns]"))
+
+
+def cif_times_to_seconds(field: np.ndarray) -> np.ndarray:
+    """Converts CIF HHMM[H] times to seconds since midnight.
+
+    A trailing H means half a minute past, so adds 30 seconds.
+
+    Args:
+        field (np.ndarray): bytes field of width 5, e.g. b"0715H".
+
+    Returns:
+        np.ndarray: int32 seconds, -1 where there is no time (e.g. a
+            passing point with no departure).
+    """
+    chars = field.view(np.uint8).reshape(-1, 5)
+    digits = chars[:, :4].astype(np.int32) - ord("0")
+    valid = ((digits >= 0) & (digits <= 9)).all(axis=1)
+    seconds = ((digits[:, 0] * 10 + digits[:, 1]) * 3600
+               + (digits[:, 2] * 10 + digits[:, 3]) * 60
+               + np.where(chars[:, 4] == ord("H"), 30, 0))
+    return np.where(valid, seconds, -1).astype(np.int32)
+
+
+def wrap_after_midnight(seconds: np.ndarray,
+                        group_codes: np.ndarray) -> np.ndarray:
+    """Adds a day to times after a journey passes midnight.
+
+    CIF times are clock times, so a train leaving at 23:50 reaches its
+    next stop at 00:05. Within each journey, every time that is earlier
+    than the time before it starts a new day, as in GTFS where the time
+    would be 24:05:00. Times of -1 (no time) are left as they are.
+
+    Args:
+        seconds (np.ndarray): seconds since midnight, grouped by journey
+            and in calling order.
+        group_codes (np.ndarray): journey of each time. Rows of the same
+            journey must be next to each other.
+
+    Returns:
+        np.ndarray: int32 seconds since midnight of the day the journey
+            starts.
+    """
+    seconds = np.asarray(seconds)
+    group_codes = np.asarray(group_codes)
+    valid = np.flatnonzero(seconds >= 0)
+    secs = seconds[valid]
+    groups = group_codes[valid]
+
+    new_group = np.ones(len(valid), dtype=bool)
+    new_group[1:] = groups[1:] != groups[:-1]
+    went_back = np.zeros(len(valid), dtype=bool)
+    went_back[1:] = secs[1:] < secs[:-1]
+    went_back &= ~new_group
+
+    # Days passed so far in each journey
+    days = np.cumsum(went_back)
+    days -= np.maximum.accumulate(np.where(new_group, days, 0))
+
+    result = seconds.astype(np.int32)
+    result[valid] = secs + days * 86400
+    return result
+
+
+def schedule_id_bytes(buf: np.ndarray, bs_starts: np.ndarray) -> np.ndarray:
+    """Builds the schedule id of each BS record.
+
+    ID in dataset is not actually unique as same train has several
+    schedules with different dates and calendars. Create ID from these
+    variables (train UID, start and end date, days run) and the STP
+    indicator, so a permanent schedule and an overlay or cancellation
+    over the same dates do not share an id.
+
+    Args:
+        buf (np.ndarray): the file as a uint8 array.
+        bs_starts (np.ndarray): byte offset of the start of each BS record.
+
+    Returns:
+        np.ndarray: bytes array of the schedule ids.
+    """
+    return np.char.add(field_bytes(buf, bs_starts, 3, 25),
+                       field_bytes(buf, bs_starts, 79, 1))
+
+
+def parse_mca_lines(buf: np.ndarray, starts: np.ndarray):
+    """Parses the schedules and stops from lines of an mca file.
+
+    Args:
+        buf (np.ndarray): the file as a uint8 array.
+        starts (np.ndarray): byte offset of the start of each line to
+            parse, in file order.
+
+    Returns:
+        Tuple[pd.DataFrame, pd.DataFrame]: schedules and stops, see
+            `extract_mca`.
+    """
+    # Record type is the first two characters of the line
+    rec_type = field_bytes(buf, starts, 0, 2)
+    is_bs = rec_type == b"BS"
+    is_lo = rec_type == b"LO"
+    is_li = rec_type == b"LI"
+    is_lt = rec_type == b"LT"
+
+    # Schedules
+    # ---------
+    # Ignore any schedules that are transaction type delete
+    bs_lines = np.flatnonzero(is_bs)
+    bs_starts = starts[bs_lines]
+    bs_kept = np.isin(field_bytes(buf, bs_starts, 2, 1), [b"N", b"R"])
+
+    schedule_ids = _categorical(schedule_id_bytes(buf, bs_starts))
+
+    # Days run, one digit per day from Monday
+    days_run = (buf[bs_starts[:, None] + 21 + np.arange(7)]
+                .astype(np.int8) - ord("0"))
+
+    kept_starts = bs_starts[bs_kept]
+    schedules_df = pd.DataFrame({
+        "schedule_id": schedule_ids[bs_kept],
+        "train_uid": _categorical(field_bytes(buf, kept_starts, 3, 6)),
+        # P - permanent, O - overlay, N - new STP, C - cancellation
+        "stp_indicator": _categorical(field_bytes(buf, kept_starts, 79, 1)),
+        "start_date": _cif_dates(field_bytes(buf, kept_starts, 9, 6)),
+        "end_date": _cif_dates(field_bytes(buf, kept_starts, 15, 6))})
+    for i, day in enumerate(DAY_COLS):
+        schedules_df[day] = days_run[bs_kept, i]
+
+    # Stops
+    # -----
+    # Give each location record the schedule started by the last BS
+    # record before it (a forward fill of the schedule id)
+    loc_lines = np.flatnonzero(is_lo | is_li | is_lt)
+    bs_pos = np.searchsorted(bs_lines, loc_lines, side="right") - 1
+
+    # Keep location records which come after a new or revised BS record
+    # and before the terminating LT record of that journey
+    lt_before = np.concatenate([[0], np.cumsum(is_lt)])
+    in_journey = bs_pos >= 0
+    bs_line = bs_lines[np.maximum(bs_pos, 0)]
+    in_journey &= bs_kept[np.maximum(bs_pos, 0)]
+    in_journey &= lt_before[loc_lines] == lt_before[bs_line + 1]
+    loc_lines = loc_lines[in_journey]
+    bs_pos = bs_pos[in_journey]
+    loc_starts = starts[loc_lines]
+
+    # Field positions differ by record type. LO is the origin, LI are
+    # intermediate stops and LT is the terminus.
+    # NB times can end on a H sometimes which indicates a half minute,
+    # this is kept as 30 seconds
+    loc_lo = is_lo[loc_lines]
+    loc_li = is_li[loc_lines]
+    dep_offset = np.where(loc_lo, 10, 15)
+    act_offset = np.select([loc_lo, loc_li], [29, 42], 25)
+
+    # Times are converted to seconds since midnight of the day the train
+    # starts, so times after midnight carry on past 24:00
+    # The LT public arrival time has four characters, the fifth is the
+    # platform, so it is blanked rather than read as a half minute
+    time_fields = field_bytes(buf, loc_starts, dep_offset, 5)
+    is_loc_lt = ~(loc_lo | loc_li)
+    time_fields.view(np.uint8).reshape(-1, 5)[is_loc_lt, 4] = ord(" ")
+    departure_secs = wrap_after_midnight(cif_times_to_seconds(time_fields),
+                                         bs_pos)
+
+    stops_df = pd.DataFrame({
+        "schedule_id": schedule_ids[bs_pos],
+        "departure_time": departure_secs,
+        "tiploc_code": _categorical(field_bytes(buf, loc_starts, 2, 8)),
+        "activity_type": _categorical(
+            field_bytes(buf, loc_starts, act_offset, 12))})
+
+    return schedules_df, stops_df
+
+
+def line_starts(buf: np.ndarray) -> np.ndarray:
+    """Gets the byte offset of the start of every line in a buffer."""
+    starts = np.concatenate([[0], np.flatnonzero(buf == ord("\n")) + 1])
+    return starts[starts < len(buf)]
+
+
+def _parse_mca_chunk(mca_file: str, start: int, end: int, skip_header: bool):
+    """Parses the schedules and stops in a byte range of an mca file.
+
+    Args:
+        mca_file (str): path to the mca file.
+        start (int): byte offset of the first line of the chunk.
+        end (int): byte offset just after the last line of the chunk.
+        skip_header (bool): whether the first line is the file header.
+
+    Returns:
+        Tuple[pd.DataFrame, pd.DataFrame]: schedules and stops, see
+            `extract_mca`.
+    """
+    buf = np.asarray(np.memmap(mca_file, dtype=np.uint8, mode="r"))
+    chunk = buf[start:end]
+    starts = line_starts(chunk)
+    if skip_header:
+        starts = starts[1:]
+    return parse_mca_lines(chunk, starts)
+
+
+def _mca_chunk_bounds(mca_file: str, n_chunks: int) -> List[int]:
+    """Splits an mca file into byte ranges which each start on a BS record.
+
+    Schedules never span two chunks, so each chunk can be parsed on its
+    own and give the same records as parsing the whole file.
+
+    Args:
+        mca_file (str): path to the mca file.
+        n_chunks (int): number of chunks wanted.
+
+    Returns:
+        list: byte offsets of the chunk boundaries, starting at 0 and
+            ending at the file size. There may be fewer chunks than asked
+            for if the file has few schedules.
+    """
+    with open(mca_file, "rb") as mca_data:
+        with mmap.mmap(mca_data.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            bounds = [0]
+            for i in range(1, n_chunks):
+                target = max(size * i // n_chunks, bounds[-1])
+                # Start of the next BS record after the target
+                found = mm.find(b"\nBS", target)
+                if found == -1:
+                    break
+                if found + 1 > bounds[-1]:
+                    bounds.append(found + 1)
+    bounds.append(size)
+    return bounds
+
+
+def _concat_categoricals(dfs: List[pd.DataFrame]) -> pd.DataFrame:
+    """Concatenates parsed chunks, keeping the categorical columns.
+
+    Categories are combined in order of first appearance, as they would
+    be from parsing the whole file at once.
+    """
+    result = pd.concat(dfs, ignore_index=True)
+    for col in dfs[0].columns:
+        if isinstance(dfs[0][col].dtype, pd.CategoricalDtype):
+            result[col] = union_categoricals([df[col] for df in dfs])
+    return result
+
+
+def extract_mca(mca_file: str,
+                n_workers: int = 1) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """Extract data from the mca file.
 
     The logic for this extraction is as follows:
@@ -216,119 +946,46 @@ def extract_mca(mca_file: str) -> Tuple[List[List], List[List]]:
         * CR = changes en route. Doesnt contain any arrival / departure times.
 
     Process:
-    * Starts by finding all the schedules within the file.
-    * Extract relevant information into the journey dataframe, and then copy
-    unique_id
-    * onto all trips within that journey.
+    * Memory maps the file and finds the start of every line.
+    * Finds the record type of every line with array operations.
+    * Slices the fixed-width fields of the BS, LO, LI and LT records
+    into columns.
+    * Carries the schedule id of each BS record forward onto the
+    location records of that journey.
+
+    With more than one worker the file is split into byte ranges that
+    start on BS records, each range is parsed in a separate process and
+    the results are concatenated in file order. The output is the same
+    as with a single worker.
 
     Args:
-        mca_file (_type_): _description_
-
+        mca_file (str): path to the mca file.
+        n_workers (int, optional): number of processes to parse with.
+            Defaults to 1.
 
     Returns:
-        schedules (list): list of lists containing schedule information
-            ready for dataframe
-        stops (list): list of lists containing stop information
-            ready for dataframe
+        schedules (pd.DataFrame): schedule_id, train_uid, stp_indicator,
+            start_date, end_date and a 0/1 column for each day of the week
+            the schedule runs.
+        stops (pd.DataFrame): schedule_id, departure_time, tiploc_code
+            and activity_type for each location record. Departure times
+            are int32 seconds since midnight of the day the train starts,
+            see `wrap_after_midnight`, and -1 where there is none.
     """
-    # Create a flag that specifies when we have found a new journey
-    journey = False
-
-    # Store schedule information
-    schedules = []
-    # Store stop information
-    stops = []
-
-    with open(mca_file, 'r') as mca_data:
-        # Skip the header
-        next(mca_data)
-        for line in mca_data:
-            # A schedule is started by a record beginning with BS.
-            # Other entries exist but are not needed for our purpose.
-            # Schedules are then further broken down by transaction type
-            # (N - new, R - revised, D - delete)
-            # Ignore any that are transaction type delete.
-            if line[0:3] == 'BSN' or line[0:3] == 'BSR':
-                # Switch flag on as we have found a journey
-                journey = True
-
-            # Get unique ID for schedule
-            # ID in dataset is not actually unique as same train has several
-            # schedules with different dates and calendars. Create ID from
-            # these variables.
-                schedule_id = (line[3:9]
-                               + line[9:15]
-                               + line[15:21]
-                               + line[21:28])
-
-            # Extract start and end date of service (yymmdd)
-                start_date = line[9:15].strip()
-                end_date = line[15:21].strip()
-
-            # Extract the calender information for this journey
-            # i.e. what days of the week it runs
-            # Only interested in weekdays for the timebeing.
-                monday = int(line[21].strip())
-                tuesday = int(line[22].strip())
-                wednesday = int(line[23].strip())
-                thursday = int(line[24].strip())
-                friday = int(line[25].strip())
-
-            # Store data to be added to the dataframe
-                schedules.append([schedule_id,
-                                  start_date,
-                                  end_date,
-                                  monday,
-                                  tuesday,
-                                  wednesday,
-                                  thursday,
-                                  friday])
-
-            # Skip as this is all we need to do for an entry starting
-            # with BS
-                continue
-
-        # If we have found a new journey, go through the lines that are
-        # part of this jounrey and give them the schedule id.
-
-        # Journeys split into origin (LO), stops (LI) and terminus (LT)
-        # CR (changes en route) and BX (extra schedule details) can be
-        # ignored as not relevant to our purpose.
-
-        # If station has a departure time extract time, tiploc_code and
-        # activity type.
-
-        # NB times can end on a H sometimes which indicates a half minute
-        # Rather than rounding up and down, just ignoring this for the moment
-        # and taking only first four characters (hh:mm)
-
-            if journey:
-                if line[0:2] == 'LO':
-                    departure_time = line[10:14].strip()
-                    tiploc_code = line[2:10].strip()
-                    activity_type = line[29:41].strip()
-
-                elif line[0:2] == 'LI':
-                    departure_time = line[15:19].strip()
-                    tiploc_code = line[2:10].strip()
-                    activity_type = line[42:54].strip()
-
-                elif line[0:2] == 'LT':
-                    departure_time = line[15:19].strip()
-                    tiploc_code = line[2:10].strip()
-                    activity_type = line[25:37].strip()
-
-                # As we know that LT signifies the last stop in a journey
-                # and we have extracted everything we need we now switch the
-                # flag off
-                    journey = False
-                else:
-                    # Skipping BR and CX
-                    continue
-
-                # Store data to be added to dataframe
-                stops.append([schedule_id,
-                              departure_time,
-                              tiploc_code,
-                              activity_type])
-    return schedules, stops
+    if n_workers <= 1:
+        return _parse_mca_chunk(mca_file, 0, None, skip_header=True)
+
+    bounds = _mca_chunk_bounds(mca_file, n_workers)
+    n_chunks = len(bounds) - 1
+    logger.info(f"Parsing {mca_file} in {n_chunks} chunks")
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        chunks = list(executor.map(_parse_mca_chunk,
+                                   [mca_file] * n_chunks,
+                                   bounds[:-1],
+                                   bounds[1:],
+                                   [True] + [False] * (n_chunks - 1)))
+
+    schedules_df = _concat_categoricals([chunk[0] for chunk in chunks])
+    stops_df = _concat_categoricals([chunk[1] for chunk in chunks])
+    return schedules_df, stops_df
@@ -0,0 +1,253 @@
+"""Benchmarks of the stages of the bus and train timetable pipelines.
+
+Each stage is run on the synthetic timetables from `synthetic_timetables`
+in a fresh process, so its peak memory is not hidden by memory used by
+earlier stages. The results have, for each stage, the time taken, the
+throughput in MB and records of the file it parses per second, and the
+peak resident memory of the process. Stages that parse with more than one
+process, e.g. `extract_mca` with several workers, report the larger of
+the peak memory of the stage's process and of its largest worker.
+"""
+# Core imports
+import os
+import sys
+import time
+import shutil
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Third party imports
+import numpy as np
+import pandas as pd
+
+# Module imports
+import time_table_utils as ttu
+import bus_feeds as bf
+import duckdb_counts as dc
+from stop_hour_counts import StopDayHourCounts
+from gtfs_cache import GTFSParquetCache
+
+# Peak memory is read with the resource module, which is not on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Create logger
+logger = logging.getLogger(__name__)
+
+
+def _peak_rss_mb() -> float:
+    """Gets the peak resident memory of this process, or of its largest
+    child process if that is more, in MB. NaN where it can't be read."""
+    if resource is None:
+        return np.nan
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Bytes on macOS, kilobytes elsewhere
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def _train_departures(inputs: dict, params: dict):
+    """Parses and cleans the mca file as in the train pipeline."""
+    schedules_df, stops_df = ttu.extract_mca(inputs["mca"]["path"],
+                                             n_workers=params["mca_workers"])
+    schedules_df = schedules_df.drop_duplicates(subset=["schedule_id"])
+    stops_df = stops_df[
+        (stops_df["activity_type"] == "T")
+        & (stops_df["departure_time"] >= params["early_hour"] * 3600)
+        & (stops_df["departure_time"] < params["late_hour"] * 3600)]
+    return schedules_df, stops_df
+
+
+def msn_parse(inputs: dict, params: dict):
+    """Parses the msn file."""
+    ttu.extract_msn_data(inputs["msn"]["path"])
+
+
+def mca_parse(inputs: dict, params: dict):
+    """Parses the mca file."""
+    ttu.extract_mca(inputs["mca"]["path"], n_workers=params["mca_workers"])
+
+
+def train_counts_pandas(inputs: dict, params: dict):
+    """Counts train departures per station, day and hour with pandas, from
+    the mca file."""
+    schedules_df, stops_df = _train_departures(inputs, params)
+    train_timetable_df = stops_df.merge(schedules_df, on="schedule_id",
+                                        how="left")
+    StopDayHourCounts.from_departures(
+        train_timetable_df["tiploc_code"],
+        train_timetable_df["departure_time"],
+        train_timetable_df[ttu.DAY_COLS].to_numpy(),
+        early_hour=params["early_hour"],
+        late_hour=params["late_hour"])
+
+
+def train_counts_duckdb(inputs: dict, params: dict):
+    """Counts train departures per station, day and hour with DuckDB, from
+    the mca file."""
+    schedules_df, stops_df = _train_departures(inputs, params)
+    con = dc.create_connection(os.path.join(params["work_dir"], "duckdb_tmp"),
+                               threads=params["duckdb_threads"],
+                               memory_limit=params["duckdb_memory_limit"])
+    dc.load_cif_departures(con, schedules_df, stops_df)
+    dc.stop_day_hour_counts(con, early_hour=params["early_hour"],
+                            late_hour=params["late_hour"])
+    con.close()
+
+
+def stop_times_read(inputs: dict, params: dict):
+    """Streams the GTFS stop times, keeping the hour window."""
+    with ttu.open_gtfs_file(inputs["gtfs"]["path"],
+                            "stop_times") as stop_times_file:
+        ttu.read_stop_times(stop_times_file,
+                            early_hour=params["early_hour"],
+                            late_hour=params["late_hour"])
+
+
+def bus_departures(inputs: dict, params: dict):
+    """Loads the bus departures: the stop times, the frequency based trips
+    expanded into journeys, the service calendar and duplicate trips."""
+    bf.load_departures(inputs["gtfs"]["path"],
+                       early_hour=params["early_hour"],
+                       late_hour=params["late_hour"])
+
+
+def _bus_counts(gtfs_path: str, params: dict, gtfs_cache=None):
+    """Counts bus departures per stop, day and hour with pandas."""
+    stop_times_df, service_rows, service_calendar, _ = bf.load_departures(
+        gtfs_path,
+        early_hour=params["early_hour"],
+        late_hour=params["late_hour"],
+        gtfs_cache=gtfs_cache)
+    StopDayHourCounts.from_departures(
+        stop_times_df["stop_id"],
+        stop_times_df["departure_time"],
+        service_calendar.day_flags,
+        early_hour=params["early_hour"],
+        late_hour=params["late_hour"],
+        service_rows=service_rows)
+
+
+def bus_counts_pandas(inputs: dict, params: dict):
+    """Counts bus departures per stop, day and hour with pandas, from the
+    GTFS files."""
+    _bus_counts(inputs["gtfs"]["path"], params)
+
+
+def gtfs_cache_build(inputs: dict, params: dict):
+    """Builds the Parquet cache of the GTFS stop times and trips, from
+    scratch."""
+    cache_dir = os.path.join(params["work_dir"], "gtfs_cache")
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    GTFSParquetCache(inputs["gtfs"]["path"], cache_dir)
+
+
+def bus_counts_parquet_cache(inputs: dict, params: dict):
+    """Counts bus departures per stop, day and hour with pandas, through
+    the Parquet cache, which is built first if needed."""
+    gtfs_path = inputs["gtfs"]["path"]
+    gtfs_cache = GTFSParquetCache(gtfs_path,
+                                  os.path.join(params["work_dir"],
+                                               "gtfs_cache"))
+    _bus_counts(gtfs_path, params, gtfs_cache=gtfs_cache)
+
+
+def bus_counts_duckdb(inputs: dict, params: dict):
+    """Counts bus departures per stop, day and hour with DuckDB, from the
+    GTFS files."""
+    con = dc.create_connection(os.path.join(params["work_dir"], "duckdb_tmp"),
+                               threads=params["duckdb_threads"],
+                               memory_limit=params["duckdb_memory_limit"])
+    dc.load_gtfs_departures(con, inputs["gtfs"]["path"],
+                            early_hour=params["early_hour"],
+                            late_hour=params["late_hour"])
+    dc.stop_day_hour_counts(con, early_hour=params["early_hour"],
+                            late_hour=params["late_hour"])
+    con.close()
+
+
+# Each stage, and the input its throughput is measured on
+STAGES = {"msn_parse": (msn_parse, "msn"),
+          "mca_parse": (mca_parse, "mca"),
+          "train_counts_pandas": (train_counts_pandas, "mca"),
+          "train_counts_duckdb": (train_counts_duckdb, "mca"),
+          "stop_times_read": (stop_times_read, "stop_times"),
+          "bus_departures": (bus_departures, "stop_times"),
+          "bus_counts_pandas": (bus_counts_pandas, "stop_times"),
+          "gtfs_cache_build": (gtfs_cache_build, "stop_times"),
+          "bus_counts_parquet_cache": (bus_counts_parquet_cache,
+                                       "stop_times"),
+          "bus_counts_duckdb": (bus_counts_duckdb, "stop_times")}
+
+
+def _run_stage(stage: str, inputs: dict, params: dict) -> dict:
+    """Runs a stage and measures it, in the process it is called in."""
+    stage_func, _ = STAGES[stage]
+    start_rss_mb = _peak_rss_mb()
+    start = time.perf_counter()
+    stage_func(inputs, params)
+    return {"seconds": time.perf_counter() - start,
+            "start_rss_mb": start_rss_mb,
+            "peak_rss_mb": _peak_rss_mb()}
+
+
+def run_benchmarks(inputs: dict,
+                   params: dict,
+                   stages: list = None,
+                   repeats: int = 1) -> pd.DataFrame:
+    """Runs the stages, each in a fresh process, and measures them.
+
+    Args:
+        inputs (dict): the timetable files, as returned by
+            `synthetic_timetables.write_cif` and `write_gtfs` combined.
+        params (dict): early_hour, late_hour, mca_workers, duckdb_threads,
+            duckdb_memory_limit and work_dir, a folder for the Parquet
+            cache and DuckDB's temporary files.
+        stages (list, optional): names of the stages to run, from
+            `STAGES`. Defaults to every stage.
+        repeats (int, optional): times to run each stage. Defaults to 1.
+
+    Returns:
+        pd.DataFrame: for each run of a stage, the seconds taken, the MB and
+            records of its input, the MB and records parsed per second and
+            the peak resident memory in MB, as well as the memory used by
+            the process before the stage started.
+    """
+    if stages is None:
+        stages = list(STAGES)
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError(f"""{unknown} are not benchmark stages, should be
+                         from {list(STAGES)}""")
+    os.makedirs(params["work_dir"], exist_ok=True)
+
+    # A new spawned process per run, so memory isn't shared with, or left
+    # over from, other runs
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for stage in stages:
+        _, input_key = STAGES[stage]
+        for repeat in range(repeats):
+            logger.info(f"Running {stage}, run {repeat + 1} of {repeats}")
+            with ProcessPoolExecutor(max_workers=1,
+                                     mp_context=context) as executor:
+                result = executor.submit(_run_stage, stage, inputs,
+                                         params).result()
+            results.append({"stage": stage,
+                            "run": repeat + 1,
+                            "input": input_key,
+                            "input_mb": inputs[input_key]["bytes"] / 1e6,
+                            "records": inputs[input_key]["records"],
+                            **result})
+
+    results_df = pd.DataFrame(results)
+    results_df["mb_per_sec"] = (results_df["input_mb"]
+                                / results_df["seconds"])
+    results_df["records_per_sec"] = (results_df["records"]
+                                     / results_df["seconds"])
+    return results_df[["stage", "run", "input", "input_mb", "records",
+                       "seconds", "mb_per_sec", "records_per_sec",
+                       "start_rss_mb", "peak_rss_mb"]]
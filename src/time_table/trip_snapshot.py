@@ -0,0 +1,375 @@
+"""Trip level snapshot of the bus timetable for incremental refreshes.
+
+The national bus timetable is published every week, and most trips in it
+are the same as the week before. `TripSnapshot` hashes the content of
+every trip: the stops and departure times in the hours counted, and the
+days of the week it runs. The hashes and each trip's departures are saved
+together with the stop, day and hour counts they give, and the settings
+they were loaded with. On the next refresh with the same settings only the
+trips whose hashes were added or removed change the counts, the rest are
+carried over from the previous counts.
+
+Trips are matched on their content rather than their trip_id, so trips
+that are renumbered between vintages but otherwise unchanged are not
+counted again.
+"""
+# Core imports
+import os
+import logging
+
+# Third party imports
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# Module imports
+import time_table_utils as ttu
+from stop_hour_counts import StopDayHourCounts
+
+# Create logger
+logger = logging.getLogger(__name__)
+
+
+def _match_keys(hashes: np.ndarray) -> pd.MultiIndex:
+    """Numbers repeats of each hash, so identical trips are matched one
+    to one between vintages."""
+    repeat = pd.Series(hashes).groupby(hashes).cumcount().to_numpy()
+    return pd.MultiIndex.from_arrays([hashes, repeat])
+
+
+class TripSnapshot:
+    """Hashes and departures of each trip in one vintage of the timetable.
+
+    Args:
+        vintage (str): identifies the timetable, e.g. its download date.
+        trip_hash (np.ndarray): uint64 hash of each trip.
+        trip_days (np.ndarray): days of the week each trip runs, as bits
+            from `ttu.DAY_BITS`.
+        dep_trip (np.ndarray): trip of each departure, as a position in
+            `trip_hash`.
+        dep_stop (np.ndarray): stop of each departure, as a position in
+            `stop_ids`.
+        dep_secs (np.ndarray): departure times in seconds since midnight.
+        stop_ids (np.ndarray): unique stop ids.
+        early_hour (int): first hour of the departures kept.
+        late_hour (int): hour the departures kept end, not included.
+        counts (StopDayHourCounts, optional): counts of every trip, saved
+            with the snapshot as the base for the next refresh.
+        settings (str, optional): settings the trips were loaded with, e.g.
+            the agencies, that a refresh has to match to use `counts`.
+    """
+
+    def __init__(self, vintage, trip_hash, trip_days, dep_trip, dep_stop,
+                 dep_secs, stop_ids, early_hour, late_hour, counts=None,
+                 settings=""):
+        self.vintage = str(vintage)
+        self.trip_hash = np.asarray(trip_hash, dtype=np.uint64)
+        self.trip_days = np.asarray(trip_days, dtype=np.uint8)
+        self.dep_trip = np.asarray(dep_trip, dtype=np.int32)
+        self.dep_stop = np.asarray(dep_stop, dtype=np.int32)
+        self.dep_secs = np.asarray(dep_secs, dtype=np.int32)
+        self.stop_ids = np.asarray(stop_ids)
+        self.early_hour = int(early_hour)
+        self.late_hour = int(late_hour)
+        self.counts_base = counts
+        self.settings = str(settings)
+
+    @classmethod
+    def from_departures(cls,
+                        vintage: str,
+                        trip_ids: pd.Series,
+                        stop_ids: pd.Series,
+                        departure_secs: pd.Series,
+                        service_rows: np.ndarray,
+                        day_flags: np.ndarray,
+                        early_hour: int,
+                        late_hour: int):
+        """Builds the snapshot from the stop times.
+
+        Args:
+            vintage (str): identifies the timetable.
+            trip_ids (pd.Series): trip of each departure.
+            stop_ids (pd.Series): stop of each departure.
+            departure_secs (pd.Series): departure times in seconds since
+                midnight.
+            service_rows (np.ndarray): row in `day_flags` of each
+                departure's service, -1 where it is missing, as returned by
+                `ttu.trip_service_rows`.
+            day_flags (np.ndarray): 0/1 with one row per service and a
+                column for each day of the week from Monday.
+            early_hour (int): first hour of the window kept.
+            late_hour (int): hour the window ends, not included.
+
+        Returns:
+            TripSnapshot: the snapshot. Departures outside the window, or
+                with no service, are left out.
+        """
+        service_rows = np.asarray(service_rows)
+        departure_secs = np.asarray(departure_secs)
+        hours = departure_secs // 3600
+        keep = ((service_rows >= 0)
+                & (hours >= early_hour) & (hours < late_hour))
+
+        dep_trip, trip_uniques = pd.factorize(np.asarray(trip_ids)[keep])
+        dep_stop, stop_uniques = pd.factorize(np.asarray(stop_ids)[keep])
+
+        # Every departure of a trip has the trip's service
+        trip_service = np.empty(len(trip_uniques), dtype=np.int64)
+        trip_service[dep_trip] = service_rows[keep]
+        trip_days = ttu.day_bits(day_flags)[trip_service]
+
+        trip_hash = ttu.trip_hashes(dep_trip,
+                                    np.asarray(stop_uniques)[dep_stop],
+                                    departure_secs[keep],
+                                    trip_days)
+        return cls(vintage, trip_hash, trip_days, dep_trip, dep_stop,
+                   departure_secs[keep], np.asarray(stop_uniques),
+                   early_hour, late_hour)
+
+    @classmethod
+    def concat(cls, snapshots: list, vintage: str):
+        """Joins snapshots, e.g. of regional feeds, into one.
+
+        A trip can be published in the feeds of more than one region, e.g.
+        when it crosses a boundary. Trips are matched on their hashes, and
+        each is kept as many times as it is in any one snapshot, so shared
+        trips and stops are not counted twice.
+
+        Args:
+            snapshots (list): TripSnapshots for the same hours.
+            vintage (str): identifies the joined timetable.
+
+        Returns:
+            TripSnapshot: the joined snapshot.
+        """
+        windows = {(snapshot.early_hour, snapshot.late_hour)
+                   for snapshot in snapshots}
+        if len(windows) != 1:
+            raise ValueError(f"""Snapshots for different hours, {windows},
+                             can not be joined""")
+        early_hour, late_hour = windows.pop()
+
+        stop_ids = pd.Index(np.concatenate(
+            [snapshot.stop_ids for snapshot in snapshots])).unique()
+        trip_offsets = np.cumsum(
+            [0] + [len(snapshot.trip_hash) for snapshot in snapshots])
+
+        trip_hash = np.concatenate([s.trip_hash for s in snapshots])
+        trip_days = np.concatenate([s.trip_days for s in snapshots])
+        dep_trip = np.concatenate(
+            [snapshot.dep_trip + offset
+             for snapshot, offset in zip(snapshots, trip_offsets)])
+        dep_stop = np.concatenate(
+            [stop_ids.get_indexer(snapshot.stop_ids)[snapshot.dep_stop]
+             for snapshot in snapshots])
+        dep_secs = np.concatenate([s.dep_secs for s in snapshots])
+
+        # Keep the first of each repeat of a hash across the snapshots
+        keys = pd.MultiIndex.from_arrays(
+            [trip_hash,
+             np.concatenate([_match_keys(s.trip_hash).get_level_values(1)
+                             for s in snapshots])])
+        kept = ~keys.duplicated()
+        new_trip = np.cumsum(kept) - 1
+        rows = kept[dep_trip]
+        logger.info(f"{(~kept).sum()} trips are in more than one snapshot")
+
+        return cls(vintage, trip_hash[kept], trip_days[kept],
+                   new_trip[dep_trip[rows]], dep_stop[rows], dep_secs[rows],
+                   np.asarray(stop_ids), early_hour, late_hour)
+
+    @staticmethod
+    def path(out_dir: str) -> str:
+        """Gets the path the latest snapshot is saved at.
+
+        Args:
+            out_dir (str): folder for the snapshot.
+
+        Returns:
+            str: path of the npz file.
+        """
+        return os.path.join(out_dir, "trip_snapshot.npz")
+
+    def save(self, path: str):
+        """Saves the snapshot, with its counts if it has them, to a
+        compressed npz file.
+
+        Args:
+            path (str): path of the npz file.
+        """
+        logger.info(f"Saving trip snapshot to {path}")
+        counts = {}
+        if self.counts_base is not None:
+            matrix = self.counts_base.counts
+            counts = {"counts_data": matrix.data,
+                      "counts_indices": matrix.indices,
+                      "counts_indptr": matrix.indptr,
+                      "counts_shape": matrix.shape,
+                      "counts_stop_ids": self.counts_base.stop_ids.astype(str)}
+        np.savez_compressed(path,
+                            **counts,
+                            settings=self.settings,
+                            vintage=self.vintage,
+                            trip_hash=self.trip_hash,
+                            trip_days=self.trip_days,
+                            dep_trip=self.dep_trip,
+                            dep_stop=self.dep_stop,
+                            dep_secs=self.dep_secs,
+                            stop_ids=self.stop_ids.astype(str),
+                            window=[self.early_hour, self.late_hour])
+
+    @classmethod
+    def load(cls, path: str):
+        """Loads a snapshot saved with `save`.
+
+        Args:
+            path (str): path of the npz file.
+
+        Returns:
+            TripSnapshot: the snapshot.
+        """
+        with np.load(path) as saved:
+            early_hour, late_hour = saved["window"]
+            counts = None
+            if "counts_data" in saved:
+                counts = StopDayHourCounts(
+                    sparse.csr_matrix((saved["counts_data"],
+                                       saved["counts_indices"],
+                                       saved["counts_indptr"]),
+                                      shape=tuple(saved["counts_shape"])),
+                    saved["counts_stop_ids"], early_hour, late_hour)
+            return cls(saved["vintage"].item(), saved["trip_hash"],
+                       saved["trip_days"], saved["dep_trip"],
+                       saved["dep_stop"], saved["dep_secs"],
+                       saved["stop_ids"], early_hour, late_hour,
+                       counts=counts, settings=saved["settings"].item())
+
+    def counts(self, trips: np.ndarray = None) -> StopDayHourCounts:
+        """Counts departures per stop, day of the week and hour.
+
+        Args:
+            trips (np.ndarray, optional): bool for each trip, to count only
+                some of the trips. Defaults to every trip.
+
+        Returns:
+            StopDayHourCounts: the counts.
+        """
+        rows = (np.ones(len(self.dep_trip), dtype=bool) if trips is None
+                else np.asarray(trips)[self.dep_trip])
+        trip_flags = (self.trip_days[:, None] & ttu.DAY_BITS) > 0
+        return StopDayHourCounts.from_departures(
+            self.stop_ids[self.dep_stop[rows]],
+            self.dep_secs[rows],
+            trip_flags,
+            self.early_hour,
+            self.late_hour,
+            service_rows=self.dep_trip[rows])
+
+    def departures(self, day: str):
+        """Gets the departures of the trips that run on a day of the week.
+
+        Args:
+            day (str): day of the week, e.g. "wednesday".
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: stop id and departure time in
+                seconds since midnight of each departure.
+        """
+        day_bit = ttu.DAY_BITS[ttu.DAY_COLS.index(day.lower())]
+        rows = (self.trip_days[self.dep_trip] & day_bit) > 0
+        return self.stop_ids[self.dep_stop[rows]], self.dep_secs[rows]
+
+    def diff(self, previous):
+        """Finds the trips added and removed since a previous snapshot.
+
+        Args:
+            previous (TripSnapshot): snapshot of an earlier vintage.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: bool for each trip in this
+                snapshot that is not in `previous`, and for each trip in
+                `previous` that is not in this snapshot.
+        """
+        keys = _match_keys(self.trip_hash)
+        previous_keys = _match_keys(previous.trip_hash)
+        added = ~keys.isin(previous_keys)
+        removed = ~previous_keys.isin(keys)
+        return added, removed
+
+    def update_counts(self,
+                      previous,
+                      previous_counts: StopDayHourCounts
+                      ) -> StopDayHourCounts:
+        """Updates the counts of a previous vintage to this one.
+
+        Only the departures of trips that were added or removed are
+        counted, and the counts of the unchanged trips are carried over.
+
+        Args:
+            previous (TripSnapshot): snapshot of the previous vintage.
+            previous_counts (StopDayHourCounts): counts of the previous
+                vintage.
+
+        Returns:
+            StopDayHourCounts: the counts for this vintage, the same as
+                `counts()` would give.
+        """
+        window = (self.early_hour, self.late_hour)
+        if (previous.early_hour, previous.late_hour) != window:
+            raise ValueError(f"""The previous snapshot is for the hours
+                             {previous.early_hour}-{previous.late_hour},
+                             not {window[0]}-{window[1]}""")
+
+        added, removed = self.diff(previous)
+        logger.info(f"{added.sum()} trips added and {removed.sum()} trips "
+                    f"removed since {previous.vintage}")
+        return (previous_counts
+                .add(self.counts(added))
+                .add(previous.counts(removed), sign=-1))
+
+    def refresh_counts(self, out_dir: str,
+                       settings: str = "") -> StopDayHourCounts:
+        """Gets the counts, updating the last saved vintage where possible.
+
+        The counts saved inside the last snapshot in `out_dir` are updated
+        with `update_counts`. Counts saved elsewhere, e.g. by the duckdb
+        engine, are never used as the base. Everything is counted when the
+        snapshot is missing, is in an older format without its counts, or
+        was saved for different hours or settings.
+
+        The counts are kept with this snapshot, so saving it afterwards
+        makes them the base of the next refresh.
+
+        Args:
+            out_dir (str): folder of the snapshot.
+            settings (str, optional): settings the trips were loaded with,
+                e.g. the agencies, kept with this snapshot. Defaults to "".
+
+        Returns:
+            StopDayHourCounts: the counts for this vintage.
+        """
+        self.settings = str(settings)
+        self.counts_base = self._refreshed_counts(self.path(out_dir))
+        return self.counts_base
+
+    def _refreshed_counts(self, snapshot_path: str) -> StopDayHourCounts:
+        """Updates the counts saved in a snapshot, or counts every trip."""
+        if not os.path.exists(snapshot_path):
+            return self.counts()
+
+        try:
+            previous = self.load(snapshot_path)
+        except KeyError:
+            logger.info(f"{snapshot_path} is in an older format, counting "
+                        "every trip")
+            return self.counts()
+        same_window = ((previous.early_hour, previous.late_hour)
+                       == (self.early_hour, self.late_hour))
+        if previous.counts_base is None or not same_window:
+            return self.counts()
+        if previous.settings != self.settings:
+            logger.info(f"{snapshot_path} was saved with other settings, "
+                        "counting every trip")
+            return self.counts()
+
+        return self.update_counts(previous, previous.counts_base)
@@ -0,0 +1,83 @@
+"""Tests for the scenario engine in scenario_mods.
+
+Run from the repo root, as the modules read config.yaml from there.
+"""
+# Core imports
+import os
+import sys
+
+# Third party imports
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import Point, box
+
+# Appending the src folder to path so that we can import its modules
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import scenario_mods as sm  # noqa E402
+
+
+@pytest.fixture
+def engine():
+    """A baseline of two LAs, a grid of centroids and three stops."""
+    la_geo_df = gpd.GeoDataFrame(
+        {"LAD11NM": ["A", "B"]},
+        geometry=[box(0, 0, 5000, 5000), box(5000, 0, 10000, 5000)],
+        crs=sm.DEFAULT_CRS)
+
+    x, y = np.meshgrid(np.arange(125, 10000, 250), np.arange(125, 5000, 250))
+    x, y = x.ravel(), y.ravel()
+    pop_df = pd.DataFrame({"LAD11NM": np.where(x < 5000, "A", "B"),
+                           "pop_count": 100})
+    pop_geo_df = gpd.GeoDataFrame(pop_df,
+                                  geometry=gpd.points_from_xy(x, y),
+                                  crs=sm.DEFAULT_CRS)
+
+    stops_geo_df = gpd.GeoDataFrame(
+        {"capacity_type": ["low", "high", "low"]},
+        geometry=[Point(1000, 1000), Point(7000, 2000), Point(3000, 3000)],
+        crs=sm.DEFAULT_CRS)
+
+    return sm.ScenarioEngine(pop_geo_df, stops_geo_df, la_geo_df, "LAD11NM")
+
+
+def test_remove_baseline_stop(engine):
+    """Removing a baseline stop takes its buffer off the reach counts."""
+    delta_df = pd.DataFrame({"easting": [3000],
+                             "northing": [3000],
+                             "capacity_type": ["low"],
+                             "action": ["remove"]})
+    scenario_reach, changed_oas = engine.apply_delta(delta_df)
+
+    assert len(changed_oas) > 0
+    assert (scenario_reach[changed_oas]
+            == engine.baseline_reach[changed_oas] - 1).all()
+
+
+def test_phantom_removal_raises(engine):
+    """A removal next to a real stop, but not at it, is an error and does
+    not lower the reach counts."""
+    delta_df = pd.DataFrame({"easting": [3000, 3010, 1000],
+                             "northing": [3000, 3000, 1000],
+                             "capacity_type": ["low", "low", "high"],
+                             "action": ["remove", "remove", "remove"]})
+    with pytest.raises(ValueError, match="not in the baseline") as err:
+        engine.apply_delta(delta_df)
+
+    # The stop with the wrong location and the one with the wrong
+    # capacity type are listed, the real stop isn't
+    assert "'easting': 3010" in str(err.value)
+    assert "'capacity_type': 'high'" in str(err.value)
+    assert str(err.value).count("'action'") == 2
+
+
+def test_repeated_removal_raises(engine):
+    """A baseline stop can only be removed once."""
+    delta_df = pd.DataFrame({"easting": [3000, 3000],
+                             "northing": [3000, 3000],
+                             "capacity_type": ["low", "low"],
+                             "action": ["remove", "remove"]})
+    with pytest.raises(ValueError, match="not in the baseline"):
+        engine.apply_delta(delta_df)